@@ -0,0 +1,243 @@
+# benchmarks/bench_e2e.py
+# Benchmark end-to-end: chạy worker thật (cào thread, tải ảnh, render PDF, ghi DB) với server giả lập
+# XenForo (benchmarks/fake_xenforo.py), không cần mạng hay cookie thật.
+#
+# Chạy: python benchmarks/bench_e2e.py [--threads 20] [--questions 30] [--latency-ms 20] [--error-rate 0.02]
+#       python benchmarks/bench_e2e.py --output baseline.json
+#       python benchmarks/bench_e2e.py --baseline baseline.json   # so sánh, exit code 1 nếu chậm đi
+#
+# Kết quả: threads/phút, requests/giây, bytes/giây, p50/p95 thời gian mỗi job và peak RSS.
+
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Metric -> True nếu càng cao càng tốt
+METRICS = {
+    'threads_per_min': True,
+    'requests_per_sec': True,
+    'bytes_per_sec': True,
+    'job_latency_p50': False,
+    'job_latency_p95': False,
+    'peak_rss_mb': False,
+}
+
+def percentile(values, q: float) -> float:
+    """Percentile theo nearest-rank (values không rỗng)."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def peak_rss_mb():
+    """Peak RSS của process hiện tại (MB), None nếu không đo được."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux trả về KB, macOS trả về bytes
+    return rss / 1024 / 1024 if platform.system() == 'Darwin' else rss / 1024
+
+def start_server(args) -> (subprocess.Popen, int):
+    """Chạy fake_xenforo.py trong process riêng, trả về (process, port)."""
+    process = subprocess.Popen(
+        [
+            sys.executable, os.path.join(REPO_ROOT, 'benchmarks', 'fake_xenforo.py'),
+            '--port', '0',
+            '--questions', str(args.questions),
+            '--questions-jitter', str(args.questions_jitter),
+            '--latency-ms', str(args.latency_ms),
+            '--error-rate', str(args.error_rate),
+            '--image-kb', str(args.image_kb),
+            '--seed', str(args.seed),
+        ],
+        stdout=subprocess.PIPE, text=True
+    )
+    line = process.stdout.readline().strip()
+    if not line.startswith('READY '):
+        process.kill()
+        raise RuntimeError(f"Server giả lập không khởi động được: {line!r}")
+    return process, int(line.split()[1])
+
+def configure(port: int, save_directory: str, args):
+    """
+    Trỏ config tới server giả lập (phải gọi trước khi import các module của scraper,
+    vì một số default được đọc từ config lúc import).
+    """
+    try:
+        import config
+    except ImportError:
+        config = types.ModuleType('config')
+        sys.modules['config'] = config
+    
+    config.FORUM_URL = f"http://127.0.0.1:{port}/forums/bench.1/"
+    config.COOKIES = {'xf_user': 'bench'}
+    config.SAVE_DIRECTORY = save_directory
+    config.DELAY_BETWEEN_REQUESTS = args.delay
+    config.GENERATE_PDF = not args.no_pdf
+    config.STORAGE_BUDGET_GB = None
+    for name, default in (('PDF_FONT_PATH', None), ('MAX_COMMENTS_PER_QUESTION', 5), ('THREAD_LIMIT', 10)):
+        if not hasattr(config, name):
+            setattr(config, name, default)
+    return config
+
+def server_stats(port: int, path: str = '__stats') -> dict:
+    import requests
+    return requests.get(f"http://127.0.0.1:{port}/{path}", timeout=5).json()
+
+def run_benchmark(args) -> dict:
+    """Chạy worker trên `args.threads` threads giả lập và thu thập metrics."""
+    server, port = start_server(args)
+    temp_dir = tempfile.mkdtemp(prefix='bench_e2e_')
+    try:
+        configure(port, os.path.join(temp_dir, 'downloaded_images'), args)
+        
+        from database.models import DatabaseManager, ThreadStatus
+        from library.library_manager import LibraryManager
+        from queue_system.worker import QueueWorker
+        from main import setup_session
+        
+        db_manager = DatabaseManager(os.path.join(temp_dir, 'bench.db'))
+        library = LibraryManager(db_manager)
+        for i in range(args.threads):
+            library.add_thread(f"http://127.0.0.1:{port}/threads/bench-thread.{i + 1}/", f"Bench thread {i + 1}")
+        
+        worker = QueueWorker(db_manager, setup_session())
+        server_stats(port, '__reset')
+        
+        latencies = []
+        output = None if args.verbose else open(os.devnull, 'w')
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            if output:
+                stack.enter_context(output)
+                stack.enter_context(contextlib.redirect_stdout(output))
+                stack.enter_context(contextlib.redirect_stderr(output))
+            while True:
+                job_start = time.perf_counter()
+                if not worker.process_queue_once():
+                    break
+                latencies.append(time.perf_counter() - job_start)
+        elapsed = time.perf_counter() - start
+        
+        traffic = server_stats(port)
+        statuses = {status.value: len(library.get_all_threads(status=status)) for status in ThreadStatus}
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {
+            'threads': args.threads,
+            'questions': args.questions,
+            'questions_jitter': args.questions_jitter,
+            'latency_ms': args.latency_ms,
+            'error_rate': args.error_rate,
+            'image_kb': args.image_kb,
+            'delay': args.delay,
+            'pdf': not args.no_pdf,
+            'seed': args.seed,
+        },
+        'metrics': {
+            'wall_time': elapsed,
+            'threads_per_min': len(latencies) / elapsed * 60 if elapsed else 0,
+            'requests_per_sec': traffic['requests'] / elapsed if elapsed else 0,
+            'bytes_per_sec': traffic['bytes'] / elapsed if elapsed else 0,
+            'job_latency_p50': percentile(latencies, 50) if latencies else None,
+            'job_latency_p95': percentile(latencies, 95) if latencies else None,
+            'peak_rss_mb': peak_rss_mb(),
+        },
+        'traffic': traffic,
+        'statuses': statuses,
+    }
+
+def compare(result: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    In bảng so sánh với baseline.
+    
+    Returns:
+        True nếu có metric chậm/tệ hơn baseline quá `tolerance` (tỉ lệ, vd 0.1 = 10%)
+    """
+    if baseline.get('params') != result['params']:
+        print("(!) Tham số benchmark khác với baseline, kết quả so sánh chỉ mang tính tham khảo")
+    
+    regressed = False
+    print(f"\n  {'Metric':<20} {'Baseline':>14} {'Hiện tại':>14} {'Thay đổi':>10}")
+    for name, higher_is_better in METRICS.items():
+        old, new = baseline['metrics'].get(name), result['metrics'].get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > tolerance:
+            flag = '  ✗ chậm đi'
+            regressed = True
+        print(f"  {name:<20} {old:>14,.3f} {new:>14,.3f} {change:>+9.1%}{flag}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark end-to-end worker với server XenForo giả lập')
+    parser.add_argument('--threads', type=int, default=20, help='Số threads đưa vào queue')
+    parser.add_argument('--questions', type=int, default=30, help='Số câu hỏi mỗi thread')
+    parser.add_argument('--questions-jitter', type=int, default=0, help='Số câu hỏi dao động ±N theo thread')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Độ trễ trung bình mỗi request của server (ms)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Tỉ lệ JSON API trả về 503 (0-1)')
+    parser.add_argument('--image-kb', type=int, default=50, help='Kích thước mỗi ảnh (KB)')
+    parser.add_argument('--delay', type=float, default=0.0, help='DELAY_BETWEEN_REQUESTS dùng khi benchmark (giây)')
+    parser.add_argument('--no-pdf', action='store_true', help='Tắt render PDF (GENERATE_PDF = False)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed của server giả lập')
+    parser.add_argument('--output', help='Ghi kết quả ra file JSON')
+    parser.add_argument('--baseline', help='File JSON kết quả cũ để so sánh')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Ngưỡng chậm đi cho phép khi so sánh (0.1 = 10%%)')
+    parser.add_argument('--verbose', action='store_true', help='Hiện log của worker')
+    args = parser.parse_args()
+    
+    print(f"[*] Benchmark {args.threads} threads x {args.questions} câu, latency {args.latency_ms} ms, "
+          f"error rate {args.error_rate:.0%}, ảnh {args.image_kb} KB...")
+    result = run_benchmark(args)
+    metrics = result['metrics']
+    
+    print(f"\n[*] Kết quả ({metrics['wall_time']:.2f}s, status: {result['statuses']}):")
+    print(f"  threads/phút:     {metrics['threads_per_min']:>12,.1f}")
+    print(f"  requests/giây:    {metrics['requests_per_sec']:>12,.1f}  ({result['traffic']['requests']} requests, "
+          f"{result['traffic']['errors']} lỗi giả lập)")
+    print(f"  bytes/giây:       {metrics['bytes_per_sec'] / 1024 / 1024:>12,.2f} MB/s")
+    if metrics['job_latency_p50'] is not None:
+        print(f"  job latency p50:  {metrics['job_latency_p50']:>12,.2f}s")
+        print(f"  job latency p95:  {metrics['job_latency_p95']:>12,.2f}s")
+    if metrics['peak_rss_mb'] is not None:
+        print(f"  peak RSS:         {metrics['peak_rss_mb']:>12,.1f} MB")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n[*] Đã ghi kết quả: {args.output}")
+    
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
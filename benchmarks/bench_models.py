@@ -0,0 +1,105 @@
+# benchmarks/bench_models.py
+# Benchmark đọc threads từ DB: tốc độ (rows/giây) và bộ nhớ cho mỗi 100k rows
+#
+# Chạy: python benchmarks/bench_models.py [--rows 100000] [--batch-size 500]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.models import DatabaseManager
+from library.library_manager import LibraryManager
+
+def create_library(db_path: str, rows: int) -> DatabaseManager:
+    """Tạo DB tạm với `rows` threads giả lập."""
+    db_manager = DatabaseManager(db_path)
+    statuses = ['completed', 'completed', 'completed', 'partial', 'failed', 'pending']
+    with db_manager.get_connection() as conn:
+        conn.executemany("""
+            INSERT INTO threads (url, title, status, folder_path, pdf_path, total_questions,
+                                 created_at, updated_at, completed_at, course)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            (
+                f"https://fuoverflow.com/threads/csi{i % 50:03d}-fa25-re.{i}/",
+                f"CSI{i % 50:03d} FA25 RE {i}",
+                statuses[i % len(statuses)],
+                f"csi{i % 50:03d}-fa25-re.{i}",
+                f"csi{i % 50:03d}-fa25-re.{i}/csi{i % 50:03d}-fa25-re.{i}.pdf",
+                50,
+                '2025-10-01 08:00:00',
+                '2025-10-01 08:05:00',
+                '2025-10-01T08:05:00.123456',
+                f"CSI{i % 50:03d}"
+            )
+            for i in range(rows)
+        ))
+        conn.commit()
+    return db_manager
+
+def measure_speed(label: str, iterate, rows: int):
+    """Đo thời gian duyệt hết library và in rows/giây."""
+    start = time.perf_counter()
+    count = iterate()
+    elapsed = time.perf_counter() - start
+    assert count == rows, f"{label}: đọc được {count}/{rows} rows"
+    print(f"  {label:<42} {rows / elapsed:>12,.0f} rows/s  ({elapsed:.2f}s)")
+
+def measure_memory(label: str, load, rows: int):
+    """Đo bộ nhớ giữ toàn bộ kết quả trong list, quy đổi ra MB / 100k rows."""
+    tracemalloc.start()
+    data = load()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(data) == rows
+    print(f"  {label:<42} {current / rows * 100_000 / 1024 / 1024:>9.1f} MB / 100k rows")
+    del data
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark đọc threads (models + iter_threads)')
+    parser.add_argument('--rows', type=int, default=100_000, help='Số threads giả lập')
+    parser.add_argument('--batch-size', type=int, default=500, help='Batch size của iter_threads')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory(prefix='bench_models_') as temp_dir:
+        print(f"[*] Tạo library giả lập {args.rows:,} threads...")
+        db_manager = create_library(os.path.join(temp_dir, 'bench.db'), args.rows)
+        library = LibraryManager(db_manager)
+        
+        def iter_raw():
+            return sum(1 for _ in library.iter_threads(batch_size=args.batch_size, raw=True))
+        
+        def iter_models():
+            return sum(1 for _ in library.iter_threads(batch_size=args.batch_size))
+        
+        def iter_models_with_timestamps():
+            count = 0
+            for thread in library.iter_threads(batch_size=args.batch_size):
+                thread.created_at, thread.updated_at, thread.completed_at
+                count += 1
+            return count
+        
+        print("\n[*] Tốc độ duyệt toàn bộ library:")
+        measure_speed("iter_threads(raw=True)", iter_raw, args.rows)
+        measure_speed("iter_threads() -> Thread", iter_models, args.rows)
+        measure_speed("iter_threads() -> Thread + đọc timestamps", iter_models_with_timestamps, args.rows)
+        
+        print("\n[*] Bộ nhớ khi giữ toàn bộ kết quả:")
+        measure_memory("raw tuples", lambda: list(library.iter_threads(batch_size=args.batch_size, raw=True)), args.rows)
+        measure_memory("Thread objects", lambda: list(library.iter_threads(batch_size=args.batch_size)), args.rows)
+        
+        def load_models_with_timestamps():
+            threads = list(library.iter_threads(batch_size=args.batch_size))
+            for thread in threads:
+                thread.created_at, thread.updated_at, thread.completed_at
+            return threads
+        
+        measure_memory("Thread objects (đã parse timestamps)", load_models_with_timestamps, args.rows)
+
+if __name__ == "__main__":
+    main()
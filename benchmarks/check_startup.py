@@ -0,0 +1,121 @@
+# benchmarks/check_startup.py
+# Kiểm tra thời gian khởi động của các lệnh CLI chỉ đọc DB (mặc định: `main.py stats`) bằng `python -X importtime`.
+#
+# Chạy: python benchmarks/check_startup.py [--budget-ms 60] [--runs 5] [--command stats] [--command "list --limit 1"]
+#
+# Thất bại (exit code 1) nếu:
+#   - thời gian import (median, tính từ sau khi interpreter khởi động xong) vượt --budget-ms, hoặc
+#   - lệnh import một module nặng chỉ cần cho việc cào/render (requests, bs4, fpdf, PIL, tqdm...).
+
+import os
+import re
+import sys
+import shlex
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Module không được import bởi các lệnh chỉ đọc DB
+HEAVY_MODULES = ('requests', 'urllib3', 'bs4', 'fpdf', 'PIL', 'tqdm', 'fontTools')
+
+_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+# config.py tối thiểu khi repo chưa có config.py (vd: chạy trên CI)
+_FALLBACK_CONFIG = """FORUM_URL = 'https://fuoverflow.com/forums/example.1/'
+COOKIES = {}
+SAVE_DIRECTORY = 'downloaded_images'
+DELAY_BETWEEN_REQUESTS = 1
+GENERATE_PDF = True
+"""
+
+def parse_importtime(stderr: str):
+    """
+    Đọc output của -X importtime.
+    
+    Returns:
+        Tuple (tổng thời gian import của script tính bằng ms, set các module top-level đã import,
+        list (cumulative_us, tên module) của các import cấp cao nhất)
+    """
+    total_us = 0
+    modules = set()
+    top_level = []
+    after_startup = False
+    for line in stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        cumulative, indent, name = int(match.group(2)), len(match.group(3)), match.group(4)
+        if not after_startup:
+            # `site` là import cuối cùng của interpreter trước khi chạy script
+            after_startup = indent == 1 and name == 'site'
+            continue
+        modules.add(name.split('.')[0])
+        # Import cấp cao nhất: indent = 1 khoảng trắng
+        if indent == 1:
+            total_us += cumulative
+            top_level.append((cumulative, name))
+    return total_us / 1000, modules, top_level
+
+def run_command(command: str, work_dir: str, env: dict):
+    """Chạy `python -X importtime main.py <command>`, trả về stderr."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', os.path.join(REPO_ROOT, 'main.py')] + shlex.split(command),
+        cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"`main.py {command}` lỗi (exit code {result.returncode}):\n{result.stderr[-2000:]}")
+    return result.stderr
+
+def main():
+    parser = argparse.ArgumentParser(description='Kiểm tra thời gian khởi động của các lệnh CLI chỉ đọc DB')
+    parser.add_argument('--command', action='append',
+                        help='Lệnh cần kiểm tra (lặp lại được, mặc định: stats)')
+    parser.add_argument('--budget-ms', type=float, default=60,
+                        help='Thời gian import tối đa cho phép (ms, median của các lần chạy)')
+    parser.add_argument('--runs', type=int, default=5, help='Số lần chạy mỗi lệnh')
+    args = parser.parse_args()
+    commands = args.command or ['stats']
+    
+    # DB tạm trong thư mục làm việc riêng; dùng config.py của repo nếu có
+    work_dir = tempfile.mkdtemp(prefix='check_startup_')
+    env = dict(os.environ)
+    if not os.path.exists(os.path.join(REPO_ROOT, 'config.py')):
+        with open(os.path.join(work_dir, 'config.py'), 'w', encoding='utf-8') as f:
+            f.write(_FALLBACK_CONFIG)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [work_dir, REPO_ROOT, env.get('PYTHONPATH')]))
+    
+    failed = False
+    try:
+        for command in commands:
+            # Lần đầu tạo DB (không tính)
+            run_command(command, work_dir, env)
+            samples = []
+            for _ in range(max(1, args.runs)):
+                total_ms, modules, top_level = parse_importtime(run_command(command, work_dir, env))
+                samples.append(total_ms)
+            median_ms = statistics.median(samples)
+            heavy = sorted(m for m in HEAVY_MODULES if m in modules)
+            
+            ok = median_ms <= args.budget_ms and not heavy
+            mark = '✓' if ok else '✗'
+            print(f"{mark} main.py {command}: import {median_ms:.1f} ms (budget {args.budget_ms:g} ms, "
+                  f"min {min(samples):.1f} / max {max(samples):.1f})")
+            if heavy:
+                print(f"  (!) Import module nặng: {', '.join(heavy)}")
+            if not ok:
+                failed = True
+                print("  Các import tốn thời gian nhất (lần chạy cuối):")
+                for cumulative, name in sorted(top_level, reverse=True)[:10]:
+                    print(f"    {cumulative / 1000:>8.1f} ms  {name}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
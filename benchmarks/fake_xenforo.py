@@ -0,0 +1,172 @@
+# benchmarks/fake_xenforo.py
+# Server HTTP giả lập XenForo (FUO) cho benchmark offline: trang thread, JSON API của media item và ảnh
+#
+# Chạy: python benchmarks/fake_xenforo.py [--port 0] [--questions 30] [--latency-ms 20] [--error-rate 0.02]
+# Khi sẵn sàng, server in ra "READY <port>" (port 0 = chọn port trống).
+#
+# Endpoints:
+#   /threads/<slug>.<id>/                   Trang thread có `questions` media links
+#   /media/item.<id>/?_xfResponseType=json  JSON {"html": {"content": ...}} với title, ảnh và comments
+#   /data/<id>.png                          Ảnh (hỗ trợ Range để tải tiếp)
+#   /__stats                                Số request / bytes / lỗi đã phục vụ (JSON)
+#   /__reset                                Đặt lại bộ đếm
+
+import io
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+CSRF_TOKEN = 'bench-token'
+
+COMMENTS = ['A la dap an', 'Đáp án B nhé', 'chọn A', 'câu này khó quá', 'ans: C', 'A']
+
+def make_image(size_kb: int, seed: int) -> bytes:
+    """Tạo ảnh PNG nhiễu (khó nén) có kích thước xấp xỉ size_kb."""
+    rng = random.Random(seed)
+    side = max(8, int((size_kb * 1024 / 3) ** 0.5))
+    img = Image.frombytes('RGB', (side, side), bytes(rng.getrandbits(8) for _ in range(side * side * 3)))
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
+
+class Stats:
+    """Bộ đếm request/bytes dùng chung giữa các luồng của server."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+            self.errors = 0
+    
+    def record(self, size: int, error: bool):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            self.errors += int(error)
+    
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'requests': self.requests, 'bytes': self.bytes, 'errors': self.errors}
+
+def make_handler(args, image: bytes, stats: Stats):
+    """Tạo request handler với cấu hình của server."""
+    
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def log_message(self, *_):
+            pass
+        
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path == '/__stats':
+                return self._send(200, json.dumps(stats.snapshot()).encode(), 'application/json', count=False)
+            if path == '/__reset':
+                stats.reset()
+                return self._send(200, b'{}', 'application/json', count=False)
+            
+            # Độ trễ mạng giả lập (phân phối đều quanh latency_ms)
+            if args.latency_ms > 0:
+                time.sleep(random.uniform(0.5, 1.5) * args.latency_ms / 1000)
+            
+            match = re.match(r'/threads/[^/]*?\.?(\d+)/?$', path)
+            if match:
+                return self._thread_page(int(match.group(1)))
+            
+            match = re.match(r'/media/item\.(\d+)/?$', path)
+            if match:
+                if random.random() < args.error_rate:
+                    return self._send(503, b'{}', 'application/json', error=True)
+                return self._media_json(match.group(1))
+            
+            if path.startswith('/data/'):
+                return self._image()
+            
+            # Trang bất kỳ khác (vd: làm mới CSRF token)
+            return self._send(200, f'<html data-csrf="{CSRF_TOKEN}"></html>'.encode(), 'text/html')
+        
+        def _thread_page(self, thread_id: int):
+            questions = args.questions
+            if args.questions_jitter:
+                questions += random.Random(thread_id).randint(-args.questions_jitter, args.questions_jitter)
+            links = ''.join(
+                f'<a data-lb-sidebar-href="/media/image-png.{thread_id * 10000 + i}/?lightbox=1">'
+                f'<span class="file-name">image.png</span></a>'
+                for i in range(max(0, questions))
+            )
+            body = f'<html data-csrf="{CSRF_TOKEN}"><body>{links}</body></html>'.encode()
+            self._send(200, body, 'text/html')
+        
+        def _media_json(self, media_id: str):
+            rng = random.Random(media_id)
+            comments = ''.join(
+                f'<div class="comment-body"><div class="bbWrapper">{rng.choice(COMMENTS)}</div></div>'
+                for _ in range(rng.randint(0, args.max_comments))
+            )
+            html = (f'<div class="p-title-value">Question {media_id}</div>'
+                    f'<div class="attachedImage"><img src="/data/{media_id}.png"></div>{comments}')
+            self._send(200, json.dumps({'html': {'content': html}}).encode(), 'application/json')
+        
+        def _image(self):
+            range_header = self.headers.get('Range')
+            if range_header:
+                start = int(range_header.split('=')[1].split('-')[0])
+                body = image[start:]
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{len(image) - 1}/{len(image)}')
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                stats.record(len(body), False)
+                return
+            self._send(200, image, 'image/png')
+        
+        def _send(self, code: int, body: bytes, content_type: str, error: bool = False, count: bool = True):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            if count:
+                stats.record(len(body), error)
+    
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description='Server giả lập XenForo cho benchmark')
+    parser.add_argument('--port', type=int, default=0, help='Port lắng nghe (0 = port trống bất kỳ)')
+    parser.add_argument('--questions', type=int, default=30, help='Số câu hỏi (media) mỗi thread')
+    parser.add_argument('--questions-jitter', type=int, default=0, help='Số câu hỏi dao động ±N theo thread')
+    parser.add_argument('--max-comments', type=int, default=5, help='Số comments tối đa mỗi câu hỏi')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Độ trễ trung bình mỗi request (ms)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Tỉ lệ JSON API trả về 503 (0-1)')
+    parser.add_argument('--image-kb', type=int, default=50, help='Kích thước ảnh (KB)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed cho ảnh và lỗi ngẫu nhiên')
+    args = parser.parse_args()
+    
+    random.seed(args.seed)
+    image = make_image(args.image_kb, args.seed)
+    stats = Stats()
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(args, image, stats))
+    server.daemon_threads = True
+    print(f"READY {server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -3,44 +3,212 @@
 import sqlite3
 import os
 from datetime import datetime
-from typing import Optional, List, Dict
-from dataclasses import dataclass
+from typing import Optional, List, Dict, Tuple
 from enum import Enum
 
+def fold_search_text(text: str) -> str:
+    """
+    Chuẩn hóa text trước khi đưa vào/tìm trong search index.
+    
+    Tokenizer unicode61 đã bỏ dấu thanh, nhưng 'đ' là một chữ cái riêng
+    (không phải 'd' + dấu) nên cần đổi tay để "dap an" khớp với "đáp án".
+    """
+    return text.replace('đ', 'd').replace('Đ', 'D')
+
 class ThreadStatus(Enum):
     """Trạng thái của thread trong queue"""
     PENDING = "pending"
     PROCESSING = "processing"
     COMPLETED = "completed"
+    PARTIAL = "partial"  # Hoàn thành nhưng thiếu một số media items
     FAILED = "failed"
 
-@dataclass
-class Thread:
-    """Model đại diện cho một thread (đề thi)"""
-    id: Optional[int]
-    url: str
-    title: str
-    status: ThreadStatus
-    folder_path: Optional[str] = None
-    pdf_path: Optional[str] = None
-    total_questions: int = 0
-    created_at: Optional[datetime] = None
-    updated_at: Optional[datetime] = None
-    completed_at: Optional[datetime] = None
-    error_message: Optional[str] = None
+# Thứ tự cột khi SELECT (query luôn liệt kê tên cột, không phụ thuộc thứ tự cột trong bảng)
+THREAD_COLUMNS = (
+    'id', 'url', 'title', 'status', 'folder_path', 'pdf_path', 'total_questions',
+    'created_at', 'updated_at', 'completed_at', 'error_message',
+    'priority', 'not_before', 'retry_count', 'course',
+    'file_count', 'image_count', 'image_bytes', 'pdf_bytes', 'stats_updated_at',
+    'last_accessed_at', 'last_checked_at', 'change_score', 'forum_id'
+)
+THREAD_SELECT = f"SELECT {', '.join(THREAD_COLUMNS)} FROM threads"
+
+MEDIA_ITEM_COLUMNS = (
+    'id', 'thread_id', 'media_id', 'filename', 'image_path', 'image_url',
+    'title', 'comments_json', 'question_order', 'evicted_at', 'preview_path', 'comment_count'
+)
+MEDIA_ITEM_SELECT = f"SELECT {', '.join(MEDIA_ITEM_COLUMNS)} FROM media_items"
+
+FORUM_COLUMNS = ('id', 'url', 'base_url', 'title', 'min_interval', 'last_claimed_at', 'created_at')
+FORUM_SELECT = f"SELECT {', '.join(FORUM_COLUMNS)} FROM forums"
+
+# Tra status theo value bằng dict (nhanh hơn gọi ThreadStatus(value) cho mỗi row)
+_STATUS_BY_VALUE = {status.value: status for status in ThreadStatus}
+
+def _lazy_timestamp(slot: str) -> property:
+    """
+    Property cho cột timestamp: giữ nguyên chuỗi từ DB, chỉ parse sang datetime
+    ở lần truy cập đầu tiên (rồi cache lại trong slot).
+    """
+    def getter(self) -> Optional[datetime]:
+        value = getattr(self, slot)
+        if value is None or isinstance(value, datetime):
+            return value
+        value = datetime.fromisoformat(value) if value else None
+        setattr(self, slot, value)
+        return value
+    
+    def setter(self, value):
+        setattr(self, slot, value)
+    
+    return property(getter, setter)
+
+class _SlottedModel:
+    """Base cho các model dùng __slots__: __repr__/__eq__ giống dataclass."""
+    __slots__ = ()
+    _fields: tuple = ()
+    
+    def __repr__(self) -> str:
+        values = ', '.join(f"{name}={getattr(self, name)!r}" for name in self._fields)
+        return f"{type(self).__name__}({values})"
+    
+    def __eq__(self, other) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self._fields)
 
-@dataclass
-class MediaItem:
+class Thread(_SlottedModel):
+    """
+    Model đại diện cho một thread (đề thi).
+    
+    Dùng __slots__ thay cho @dataclass để giảm bộ nhớ khi đọc nhiều rows;
+    created_at/updated_at/completed_at chỉ được parse khi truy cập.
+    """
+    __slots__ = (
+        'id', 'url', 'title', 'status', 'folder_path', 'pdf_path', 'total_questions',
+        '_created_at', '_updated_at', '_completed_at', 'error_message',
+        'priority', 'not_before', 'retry_count', 'course',
+        'file_count', 'image_count', 'image_bytes', 'pdf_bytes', 'stats_updated_at',
+        'last_accessed_at', 'last_checked_at', 'change_score', 'forum_id'
+    )
+    _fields = THREAD_COLUMNS
+    
+    created_at = _lazy_timestamp('_created_at')
+    updated_at = _lazy_timestamp('_updated_at')
+    completed_at = _lazy_timestamp('_completed_at')
+    
+    def __init__(
+        self,
+        id: Optional[int],
+        url: str,
+        title: str,
+        status: ThreadStatus,
+        folder_path: Optional[str] = None,
+        pdf_path: Optional[str] = None,
+        total_questions: int = 0,
+        created_at=None,  # datetime hoặc chuỗi ISO từ DB
+        updated_at=None,
+        completed_at=None,
+        error_message: Optional[str] = None,
+        priority: int = 0,  # Càng lớn càng được xử lý trước
+        not_before: int = 0,  # Epoch seconds: chưa được xử lý trước thời điểm này
+        retry_count: int = 0,  # Số lần tự động retry sau khi thất bại
+        course: Optional[str] = None,  # Mã môn học (vd: 'CSI106'), lấy từ slug URL
+        file_count: Optional[int] = None,  # Thống kê dung lượng thư mục (None = chưa quét)
+        image_count: Optional[int] = None,
+        image_bytes: Optional[int] = None,
+        pdf_bytes: Optional[int] = None,
+        stats_updated_at: Optional[str] = None,
+        last_accessed_at: Optional[str] = None,  # Lần cuối thread được xem/render (cho LRU eviction)
+        last_checked_at: Optional[int] = None,  # Epoch seconds: lần cào gần nhất thành công (cho `watch`)
+        change_score: float = 1.0,  # 0..1: thread thay đổi thường xuyên thế nào (cao = kiểm tra lại sớm)
+        forum_id: Optional[int] = None  # Forum chứa thread (queue riêng)
+    ):
+        self.id = id
+        self.url = url
+        self.title = title
+        self.status = status
+        self.folder_path = folder_path
+        self.pdf_path = pdf_path
+        self.total_questions = total_questions
+        self._created_at = created_at
+        self._updated_at = updated_at
+        self._completed_at = completed_at
+        self.error_message = error_message
+        self.priority = priority
+        self.not_before = not_before
+        self.retry_count = retry_count
+        self.course = course
+        self.file_count = file_count
+        self.image_count = image_count
+        self.image_bytes = image_bytes
+        self.pdf_bytes = pdf_bytes
+        self.stats_updated_at = stats_updated_at
+        self.last_accessed_at = last_accessed_at
+        self.last_checked_at = last_checked_at
+        self.change_score = change_score
+        self.forum_id = forum_id
+
+class MediaItem(_SlottedModel):
     """Model đại diện cho một media item (câu hỏi)"""
-    id: Optional[int]
-    thread_id: int
-    media_id: str
-    filename: Optional[str] = None
-    image_path: Optional[str] = None
-    image_url: Optional[str] = None
-    title: Optional[str] = None
-    comments_json: Optional[str] = None
-    question_order: int = 0
+    __slots__ = MEDIA_ITEM_COLUMNS
+    _fields = MEDIA_ITEM_COLUMNS
+    
+    def __init__(
+        self,
+        id: Optional[int],
+        thread_id: int,
+        media_id: str,
+        filename: Optional[str] = None,
+        image_path: Optional[str] = None,
+        image_url: Optional[str] = None,
+        title: Optional[str] = None,
+        comments_json: Optional[str] = None,
+        question_order: int = 0,
+        evicted_at: Optional[str] = None,  # Ảnh gốc đã bị xóa để giải phóng dung lượng (None = còn trên đĩa)
+        preview_path: Optional[str] = None,  # Bản thu nhỏ giữ lại khi evict (relative path)
+        comment_count: Optional[int] = None  # Tổng số comments forum hiển thị (kể cả các trang sau)
+    ):
+        self.id = id
+        self.thread_id = thread_id
+        self.media_id = media_id
+        self.filename = filename
+        self.image_path = image_path
+        self.image_url = image_url
+        self.title = title
+        self.comments_json = comments_json
+        self.question_order = question_order
+        self.evicted_at = evicted_at
+        self.preview_path = preview_path
+        self.comment_count = comment_count
+
+class Forum(_SlottedModel):
+    """
+    Model đại diện cho một forum (môn học) hoặc một site nguồn.
+    
+    Mỗi forum có base URL (tính một lần khi thêm), rate budget và hàng đợi threads riêng;
+    worker lấy job xen kẽ giữa các forum.
+    """
+    __slots__ = FORUM_COLUMNS
+    _fields = FORUM_COLUMNS
+    
+    def __init__(
+        self,
+        id: Optional[int],
+        url: str,
+        base_url: str,
+        title: Optional[str] = None,
+        min_interval: Optional[float] = None,  # Giây giữa hai request của forum (None = config.DELAY_BETWEEN_REQUESTS)
+        last_claimed_at: Optional[float] = None,  # Epoch seconds: lần cuối worker lấy job của forum này
+        created_at: Optional[str] = None
+    ):
+        self.id = id
+        self.url = url
+        self.base_url = base_url
+        self.title = title
+        self.min_interval = min_interval
+        self.last_claimed_at = last_claimed_at
+        self.created_at = created_at
 
 class DatabaseManager:
     """Quản lý database SQLite cho FuOverflow Scraper"""
@@ -53,6 +221,9 @@ class DatabaseManager:
             db_path: Đường dẫn đến file database SQLite
         """
         self.db_path = db_path
+        self.fts_enabled = False
+        # ID các thread trùng đã bị gộp khi migrate lúc khởi tạo (main.py báo cho người dùng)
+        self.merged_thread_ids: List[int] = []
         self.init_database()
     
     def get_connection(self):
@@ -64,6 +235,20 @@ class DatabaseManager:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             
+            # Bảng forums: forum (môn học) hoặc site nguồn của threads.
+            # url = URL forum đã chuẩn hóa, hoặc base URL cho threads không rõ forum
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS forums (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT UNIQUE NOT NULL,
+                    base_url TEXT NOT NULL,
+                    title TEXT,
+                    min_interval REAL,
+                    last_claimed_at REAL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
             # Bảng threads
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS threads (
@@ -77,10 +262,50 @@ class DatabaseManager:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     completed_at TIMESTAMP,
-                    error_message TEXT
+                    error_message TEXT,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    not_before INTEGER NOT NULL DEFAULT 0,
+                    retry_count INTEGER NOT NULL DEFAULT 0,
+                    course TEXT,
+                    file_count INTEGER,
+                    image_count INTEGER,
+                    image_bytes INTEGER,
+                    pdf_bytes INTEGER,
+                    stats_updated_at TIMESTAMP,
+                    last_accessed_at TIMESTAMP,
+                    xf_thread_id INTEGER,
+                    last_checked_at INTEGER,
+                    change_score REAL NOT NULL DEFAULT 1.0,
+                    forum_id INTEGER REFERENCES forums(id),
+                    xf_host TEXT
                 )
             """)
             
+            # Migrate DB cũ: thêm các cột mới (query dùng THREAD_COLUMNS nên thứ tự cột không quan trọng)
+            added = self._ensure_columns(cursor, 'threads', [
+                ('priority', 'INTEGER NOT NULL DEFAULT 0'),
+                ('not_before', 'INTEGER NOT NULL DEFAULT 0'),
+                ('retry_count', 'INTEGER NOT NULL DEFAULT 0'),
+                ('course', 'TEXT'),
+                ('file_count', 'INTEGER'),
+                ('image_count', 'INTEGER'),
+                ('image_bytes', 'INTEGER'),
+                ('pdf_bytes', 'INTEGER'),
+                ('stats_updated_at', 'TIMESTAMP'),
+                ('last_accessed_at', 'TIMESTAMP'),
+                ('xf_thread_id', 'INTEGER'),
+                ('last_checked_at', 'INTEGER'),
+                ('change_score', 'REAL NOT NULL DEFAULT 1.0'),
+                ('forum_id', 'INTEGER REFERENCES forums(id)'),
+                ('xf_host', 'TEXT'),
+            ])
+            if 'course' in added:
+                self._backfill_thread_courses(cursor)
+            if 'last_checked_at' in added:
+                self._backfill_last_checked(cursor)
+            if 'forum_id' in added:
+                self._backfill_thread_forums(cursor)
+            
             # Bảng media_items
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS media_items (
@@ -94,65 +319,513 @@ class DatabaseManager:
                     comments_json TEXT,
                     question_order INTEGER DEFAULT 0,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    evicted_at TIMESTAMP,
+                    preview_path TEXT,
+                    comment_count INTEGER,
                     FOREIGN KEY (thread_id) REFERENCES threads(id) ON DELETE CASCADE,
                     UNIQUE(thread_id, media_id)
                 )
             """)
+            self._ensure_columns(cursor, 'media_items', [
+                ('evicted_at', 'TIMESTAMP'),
+                ('preview_path', 'TEXT'),
+                ('comment_count', 'INTEGER'),
+            ])
+            
+            # Bảng download_manifest: ảnh đã tải xong (keyed theo thread + media_id)
+            # Là nguồn dữ liệu duy nhất để quyết định skip khi cào lại một thread
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS download_manifest (
+                    media_id TEXT NOT NULL,
+                    thread_id INTEGER NOT NULL,
+                    file_path TEXT NOT NULL,
+                    file_size INTEGER NOT NULL,
+                    sha256 TEXT,
+                    image_url TEXT,
+                    title TEXT,
+                    comments_json TEXT,
+                    comment_count INTEGER,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (thread_id, media_id),
+                    FOREIGN KEY (thread_id) REFERENCES threads(id) ON DELETE CASCADE
+                )
+            """)
+            self._ensure_columns(cursor, 'download_manifest', [
+                ('comment_count', 'INTEGER'),
+            ])
+            self._migrate_manifest_key(cursor)
+            
+            # Bảng failed_items: media items lỗi trong lần cào gần nhất của thread
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS failed_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    thread_id INTEGER NOT NULL,
+                    media_id TEXT NOT NULL,
+                    error_kind TEXT NOT NULL,
+                    error_message TEXT,
+                    attempts INTEGER DEFAULT 1,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (thread_id) REFERENCES threads(id) ON DELETE CASCADE,
+                    UNIQUE(thread_id, media_id)
+                )
+            """)
+            
+            # Bảng comments: comments đã tách riêng, kèm đáp án trích được (A/B/C/D...)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS comments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    media_item_id INTEGER NOT NULL,
+                    thread_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    body TEXT NOT NULL,
+                    answer TEXT,
+                    FOREIGN KEY (media_item_id) REFERENCES media_items(id) ON DELETE CASCADE,
+                    UNIQUE(media_item_id, position)
+                )
+            """)
+            
+            # Bảng answer_votes: số phiếu của từng đáp án theo media item (trigger cập nhật)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS answer_votes (
+                    media_item_id INTEGER NOT NULL,
+                    answer TEXT NOT NULL,
+                    votes INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (media_item_id, answer)
+                )
+            """)
+            
+            # Bảng answer_consensus: đáp án được chọn nhiều nhất của mỗi câu hỏi
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS answer_consensus (
+                    media_item_id INTEGER PRIMARY KEY,
+                    thread_id INTEGER NOT NULL,
+                    total_votes INTEGER NOT NULL,
+                    top_answer TEXT NOT NULL,
+                    top_votes INTEGER NOT NULL,
+                    agreement REAL NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            self._create_answer_triggers(cursor)
+            
+            # Bảng queue_counters: số threads theo status (trigger cập nhật),
+            # để get_queue_stats không phải GROUP BY toàn bảng threads
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS queue_counters (
+                    status TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._create_queue_counter_triggers(cursor)
+            cursor.execute("SELECT 1 FROM queue_counters LIMIT 1")
+            if cursor.fetchone() is None:
+                # Lần đầu (hoặc DB cũ): đếm lại từ bảng threads
+                self.rebuild_queue_counters(cursor)
+            
+            # Bảng file_checks: kết quả `verify` gần nhất của từng file (ảnh/PDF),
+            # kèm size + mtime để lần verify sau bỏ qua các file không thay đổi
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS file_checks (
+                    file_path TEXT PRIMARY KEY,
+                    thread_id INTEGER NOT NULL,
+                    media_id TEXT,
+                    file_size INTEGER,
+                    mtime_ns INTEGER,
+                    sha256 TEXT,
+                    status TEXT NOT NULL,
+                    error_message TEXT,
+                    checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (thread_id) REFERENCES threads(id) ON DELETE CASCADE
+                )
+            """)
+            
+            # Bảng job_timings: span thời gian của từng stage trong job và từng HTTP request
+            # (ghi theo lô bởi scraper/timing.py, đọc bởi `perf`)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS job_timings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    thread_id INTEGER,
+                    stage TEXT NOT NULL,
+                    url_class TEXT,
+                    status INTEGER,
+                    bytes INTEGER,
+                    duration_ms REAL NOT NULL,
+                    started_at REAL NOT NULL,
+                    FOREIGN KEY (thread_id) REFERENCES threads(id) ON DELETE CASCADE
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_timings_started ON job_timings(started_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_timings_thread ON job_timings(thread_id)")
             
             # Indexes để tăng tốc độ query
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_threads_url ON threads(url)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_threads_status ON threads(status)")
+            # Index cho iter_threads(course=...): keyset theo id trong từng môn học
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_threads_course ON threads(course, id)")
+            # Index cho claim query theo từng forum (xem QueueManager.claim_next_pending)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_threads_forum_queue
+                ON threads(forum_id, status, priority DESC, not_before, created_at)
+            """)
+            # Index cho `watch`: threads đã cào xong theo lần kiểm tra gần nhất
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_threads_checked ON threads(status, last_checked_at)")
+            # Index cho claim query: status = ? AND not_before <= ? ORDER BY priority DESC, not_before, created_at
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_threads_queue
+                ON threads(status, priority DESC, not_before, created_at)
+            """)
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_items_thread ON media_items(thread_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_consensus_thread ON answer_consensus(thread_id)")
+            
+            # Bảng media_search (FTS5): full-text index cho title + comments của media items
+            # rowid = media_items.id; remove_diacritics để tìm được cả khi gõ không dấu
+            try:
+                cursor.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS media_search USING fts5(
+                        title,
+                        comments,
+                        course UNINDEXED,
+                        thread_id UNINDEXED,
+                        question_order UNINDEXED,
+                        tokenize = 'unicode61 remove_diacritics 2'
+                    )
+                """)
+                self.fts_enabled = True
+            except sqlite3.OperationalError:
+                # SQLite được build không có FTS5 -> bỏ qua tính năng search
+                self.fts_enabled = False
+            
+            # Khóa chuẩn của thread (host + thread ID của XenForo): mỗi thread chỉ có một row
+            # dù được thêm bằng nhiều biến thể URL. DB cũ: gộp các row trùng trước khi tạo index;
+            # index cũ chỉ theo thread ID (chặn thread cùng ID của site khác) được thay bằng index mới
+            if 'xf_thread_id' in added or 'xf_host' in added:
+                cursor.execute("DROP INDEX IF EXISTS idx_threads_xf_thread_id")
+                self.merged_thread_ids += self._migrate_thread_keys(cursor)
+            cursor.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_threads_xf_key
+                ON threads(xf_host, xf_thread_id) WHERE xf_thread_id IS NOT NULL
+            """)
+            # Host bỏ tiền tố www.: DB có forum / thread lưu host www. -> gộp về host không www.
+            cursor.execute("""
+                SELECT 1 FROM threads WHERE xf_host LIKE 'www.%'
+                UNION ALL SELECT 1 FROM forums WHERE base_url LIKE '%://www.%'
+                LIMIT 1
+            """)
+            if cursor.fetchone():
+                self._migrate_forum_hosts(cursor)
+                self.merged_thread_ids += self._migrate_thread_keys(cursor)
             
             conn.commit()
     
+    def _ensure_columns(self, cursor: sqlite3.Cursor, table: str, columns: List[tuple]):
+        """
+        Thêm các cột còn thiếu vào bảng đã có (migrate DB tạo từ phiên bản cũ).
+        
+        Args:
+            cursor: Cursor của connection đang mở
+            table: Tên bảng
+            columns: List (tên cột, định nghĩa cột), theo thứ tự cần thêm
+        
+        Returns:
+            List tên các cột vừa được thêm
+        """
+        cursor.execute(f"PRAGMA table_info({table})")
+        existing = {row[1] for row in cursor.fetchall()}
+        added = []
+        for name, definition in columns:
+            if name not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                added.append(name)
+        return added
+    
+    def _migrate_manifest_key(self, cursor: sqlite3.Cursor):
+        """
+        DB cũ: download_manifest có khóa chính là media_id nên cùng một media ở hai thread
+        (hoặc hai site) ghi đè lẫn nhau. Tạo lại bảng với khóa (thread_id, media_id),
+        giữ nguyên các row hiện có. Không làm gì nếu bảng đã đúng khóa.
+        """
+        cursor.execute("PRAGMA table_info(download_manifest)")
+        if {row[1]: row[5] for row in cursor.fetchall()}.get('thread_id'):
+            return
+        columns = ('media_id, thread_id, file_path, file_size, sha256, image_url, title, '
+                   'comments_json, comment_count, updated_at')
+        cursor.execute("ALTER TABLE download_manifest RENAME TO download_manifest_old")
+        cursor.execute("""
+            CREATE TABLE download_manifest (
+                media_id TEXT NOT NULL,
+                thread_id INTEGER NOT NULL,
+                file_path TEXT NOT NULL,
+                file_size INTEGER NOT NULL,
+                sha256 TEXT,
+                image_url TEXT,
+                title TEXT,
+                comments_json TEXT,
+                comment_count INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (thread_id, media_id),
+                FOREIGN KEY (thread_id) REFERENCES threads(id) ON DELETE CASCADE
+            )
+        """)
+        cursor.execute(f"INSERT INTO download_manifest ({columns}) SELECT {columns} FROM download_manifest_old")
+        cursor.execute("DROP TABLE download_manifest_old")
+    
+    def _backfill_thread_courses(self, cursor: sqlite3.Cursor):
+        """Điền cột course cho các threads có sẵn (chạy một lần khi migrate)."""
+        from library.thread_utils import extract_course_code
+        
+        cursor.execute("SELECT id, url, title FROM threads")
+        updates = [
+            (extract_course_code(url, title), thread_id)
+            for thread_id, url, title in cursor.fetchall()
+        ]
+        cursor.executemany("UPDATE threads SET course = ? WHERE id = ?", updates)
+    
+    def _backfill_last_checked(self, cursor: sqlite3.Cursor):
+        """Lấy completed_at làm lần kiểm tra đầu tiên của các threads đã cào xong (chạy một lần khi migrate)."""
+        cursor.execute("SELECT id, completed_at FROM threads WHERE completed_at IS NOT NULL")
+        updates = []
+        for thread_id, completed_at in cursor.fetchall():
+            try:
+                updates.append((int(datetime.fromisoformat(completed_at).timestamp()), thread_id))
+            except (TypeError, ValueError):
+                continue
+        cursor.executemany("UPDATE threads SET last_checked_at = ? WHERE id = ?", updates)
+    
+    def _backfill_thread_forums(self, cursor: sqlite3.Cursor):
+        """
+        Gán forum cho các threads có sẵn (chạy một lần khi migrate).
+        
+        URL thread không cho biết forum chứa nó, nên mỗi site (base URL) có một forum
+        mặc định; `crawl <forum_url>` sau đó sẽ gán threads mới vào đúng forum.
+        """
+        from library.thread_utils import get_base_url
+        
+        cursor.execute("SELECT id, url FROM threads WHERE forum_id IS NULL")
+        rows = cursor.fetchall()
+        forum_ids: Dict[str, int] = {}
+        updates = []
+        for thread_id, url in rows:
+            base_url = get_base_url(url)
+            if base_url not in forum_ids:
+                cursor.execute("""
+                    INSERT INTO forums (url, base_url, title) VALUES (?, ?, ?)
+                    ON CONFLICT(url) DO NOTHING
+                """, (base_url, base_url, base_url.split('://', 1)[-1]))
+                cursor.execute("SELECT id FROM forums WHERE url = ?", (base_url,))
+                forum_ids[base_url] = cursor.fetchone()[0]
+            updates.append((forum_ids[base_url], thread_id))
+        cursor.executemany("UPDATE threads SET forum_id = ? WHERE id = ?", updates)
+    
+    def _migrate_forum_hosts(self, cursor: sqlite3.Cursor):
+        """
+        Bỏ tiền tố www. khỏi URL / base URL của forums (chạy một lần khi migrate). Forum
+        trùng với một forum đã có sau khi bỏ www. được gộp vào forum đó (chuyển threads sang).
+        """
+        from library.thread_utils import get_base_url, normalize_url
+        
+        cursor.execute("SELECT id, url FROM forums WHERE base_url LIKE '%://www.%'")
+        for forum_id, url in cursor.fetchall():
+            new_url = normalize_url(url)
+            cursor.execute("SELECT id FROM forums WHERE url = ? AND id != ?", (new_url, forum_id))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute("UPDATE threads SET forum_id = ? WHERE forum_id = ?", (row[0], forum_id))
+                cursor.execute("DELETE FROM forums WHERE id = ?", (forum_id,))
+            else:
+                cursor.execute("UPDATE forums SET url = ?, base_url = ? WHERE id = ?",
+                               (new_url, get_base_url(new_url), forum_id))
+    
+    def _migrate_thread_keys(self, cursor: sqlite3.Cursor) -> List[int]:
+        """
+        Điền xf_host, xf_thread_id + URL chuẩn cho các threads có sẵn và gộp các row trùng
+        thread (cùng host + thread ID nhưng khác biến thể URL). Chạy một lần khi migrate.
+        
+        Row được giữ lại: status tốt nhất (completed > partial > processing > pending > failed),
+        rồi nhiều câu hỏi hơn, rồi ID nhỏ nhất; priority lấy giá trị lớn nhất của nhóm.
+        Ảnh đã tải (download_manifest, file_checks) và job_timings của các row bị gộp được
+        chuyển sang row giữ lại; media items, comments, failed_items của chúng bị xóa
+        (foreign key không bật nên không có cascade).
+        
+        Returns:
+            List ID các row đã bị gộp (đã xóa)
+        """
+        from library.thread_utils import canonical_thread_key, normalize_url
+        
+        status_rank = {'completed': 0, 'partial': 1, 'processing': 2, 'pending': 3, 'failed': 4}
+        cursor.execute("SELECT id, url, status, total_questions, priority FROM threads")
+        groups: Dict[Tuple[str, int], List[tuple]] = {}
+        for row in cursor.fetchall():
+            key = canonical_thread_key(row[1])
+            if key is not None:
+                groups.setdefault(key, []).append(row)
+        
+        merged = []
+        updates = []
+        for key, rows in groups.items():
+            rows.sort(key=lambda r: (status_rank.get(r[2], len(status_rank)), -(r[3] or 0), r[0]))
+            survivor = rows[0]
+            losers = [r[0] for r in rows[1:]]
+            updates.append((normalize_url(survivor[1]), *key, max(r[4] or 0 for r in rows), survivor[0]))
+            if not losers:
+                continue
+            merged.extend(losers)
+            marks = ','.join('?' * len(losers))
+            for table in ('download_manifest', 'file_checks', 'job_timings'):
+                cursor.execute(f"UPDATE OR IGNORE {table} SET thread_id = ? WHERE thread_id IN ({marks})",
+                               [survivor[0]] + losers)
+            # Media đã có trong manifest của row giữ lại: bỏ entry trùng của row bị gộp
+            cursor.execute(f"DELETE FROM download_manifest WHERE thread_id IN ({marks})", losers)
+            # Xóa comments trước media_items: trigger cập nhật answer_votes / answer_consensus
+            cursor.execute(f"DELETE FROM comments WHERE thread_id IN ({marks})", losers)
+            cursor.execute(f"""
+                DELETE FROM answer_consensus WHERE media_item_id IN
+                    (SELECT id FROM media_items WHERE thread_id IN ({marks}))
+            """, losers)
+            if self.fts_enabled:
+                cursor.execute(f"""
+                    DELETE FROM media_search WHERE rowid IN
+                        (SELECT id FROM media_items WHERE thread_id IN ({marks}))
+                """, losers)
+            for table in ('media_items', 'failed_items'):
+                cursor.execute(f"DELETE FROM {table} WHERE thread_id IN ({marks})", losers)
+            cursor.execute(f"DELETE FROM threads WHERE id IN ({marks})", losers)
+        
+        cursor.executemany(
+            "UPDATE threads SET url = ?, xf_host = ?, xf_thread_id = ?, priority = ? WHERE id = ?", updates
+        )
+        return merged
+    
+    def _create_queue_counter_triggers(self, cursor: sqlite3.Cursor):
+        """Tạo các trigger giữ queue_counters khớp với bảng threads (insert/update status/delete)."""
+        increment = """
+            INSERT INTO queue_counters (status, count) VALUES (NEW.status, 1)
+            ON CONFLICT(status) DO UPDATE SET count = count + 1;
+        """
+        decrement = """
+            UPDATE queue_counters SET count = count - 1 WHERE status = OLD.status;
+        """
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_threads_count_insert AFTER INSERT ON threads
+            BEGIN {increment} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_threads_count_delete AFTER DELETE ON threads
+            BEGIN {decrement} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_threads_count_update AFTER UPDATE OF status ON threads
+            WHEN OLD.status IS NOT NEW.status
+            BEGIN {decrement} {increment} END
+        """)
+    
+    def rebuild_queue_counters(self, cursor: Optional[sqlite3.Cursor] = None) -> Dict[str, int]:
+        """
+        Đếm lại queue_counters từ bảng threads (GROUP BY toàn bảng, chỉ dùng khi cần sửa).
+        
+        Args:
+            cursor: Cursor của connection đang mở (None = tự mở connection và commit)
+        
+        Returns:
+            Dict {status: count} sau khi đếm lại
+        """
+        if cursor is None:
+            with self.get_connection() as conn:
+                counts = self.rebuild_queue_counters(conn.cursor())
+                conn.commit()
+                return counts
+        
+        cursor.execute("DELETE FROM queue_counters")
+        cursor.execute("""
+            INSERT INTO queue_counters (status, count)
+            SELECT status, COUNT(*) FROM threads GROUP BY status
+        """)
+        cursor.execute("SELECT status, count FROM queue_counters")
+        return dict(cursor.fetchall())
+    
+    def _create_answer_triggers(self, cursor: sqlite3.Cursor):
+        """
+        Tạo các trigger giữ answer_votes và answer_consensus luôn khớp với bảng comments.
+        
+        comments --(insert/delete/update answer)--> answer_votes (+1/-1)
+        answer_votes --(mọi thay đổi)--> tính lại answer_consensus của đúng media item đó
+        """
+        vote_up = """
+            INSERT INTO answer_votes (media_item_id, answer, votes) VALUES (NEW.media_item_id, NEW.answer, 1)
+            ON CONFLICT(media_item_id, answer) DO UPDATE SET votes = votes + 1;
+        """
+        vote_down = """
+            UPDATE answer_votes SET votes = votes - 1
+            WHERE media_item_id = OLD.media_item_id AND answer = OLD.answer;
+            DELETE FROM answer_votes
+            WHERE media_item_id = OLD.media_item_id AND answer = OLD.answer AND votes <= 0;
+        """
+        cursor.executescript(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_comments_insert AFTER INSERT ON comments
+            WHEN NEW.answer IS NOT NULL
+            BEGIN {vote_up} END;
+            
+            CREATE TRIGGER IF NOT EXISTS trg_comments_delete AFTER DELETE ON comments
+            WHEN OLD.answer IS NOT NULL
+            BEGIN {vote_down} END;
+            
+            CREATE TRIGGER IF NOT EXISTS trg_comments_answer_remove AFTER UPDATE OF answer ON comments
+            WHEN OLD.answer IS NOT NULL
+            BEGIN {vote_down} END;
+            
+            CREATE TRIGGER IF NOT EXISTS trg_comments_answer_add AFTER UPDATE OF answer ON comments
+            WHEN NEW.answer IS NOT NULL
+            BEGIN {vote_up} END;
+        """)
+        
+        for event, ref in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_answer_votes_{event.lower()} AFTER {event} ON answer_votes
+                BEGIN
+                    DELETE FROM answer_consensus WHERE media_item_id = {ref}.media_item_id;
+                    INSERT INTO answer_consensus
+                        (media_item_id, thread_id, total_votes, top_answer, top_votes, agreement)
+                    SELECT v.media_item_id, m.thread_id, SUM(v.votes),
+                           (SELECT answer FROM answer_votes
+                            WHERE media_item_id = v.media_item_id AND votes > 0
+                            ORDER BY votes DESC, answer ASC LIMIT 1),
+                           MAX(v.votes), CAST(MAX(v.votes) AS REAL) / SUM(v.votes)
+                    FROM answer_votes v
+                    JOIN media_items m ON m.id = v.media_item_id
+                    WHERE v.media_item_id = {ref}.media_item_id AND v.votes > 0
+                    GROUP BY v.media_item_id;
+                END
+            """)
+    
     def thread_from_row(self, row: tuple) -> Thread:
         """
         Chuyển đổi row từ DB thành Thread object.
         
         Args:
-            row: Tuple từ cursor.fetchone() hoặc fetchall()
+            row: Tuple theo thứ tự THREAD_COLUMNS (query bằng THREAD_SELECT)
         
         Returns:
-            Thread object
+            Thread object (timestamps được parse khi truy cập)
         """
-        return Thread(
-            id=row[0],
-            url=row[1],
-            title=row[2],
-            status=ThreadStatus(row[3]),
-            folder_path=row[4],
-            pdf_path=row[5],
-            total_questions=row[6],
-            created_at=datetime.fromisoformat(row[7]) if row[7] else None,
-            updated_at=datetime.fromisoformat(row[8]) if row[8] else None,
-            completed_at=datetime.fromisoformat(row[9]) if row[9] else None,
-            error_message=row[10]
-        )
+        return Thread(row[0], row[1], row[2], _STATUS_BY_VALUE[row[3]], *row[4:])
     
     def media_item_from_row(self, row: tuple) -> MediaItem:
         """
         Chuyển đổi row từ DB thành MediaItem object.
         
         Args:
-            row: Tuple từ cursor.fetchone() hoặc fetchall()
+            row: Tuple theo thứ tự MEDIA_ITEM_COLUMNS (query bằng MEDIA_ITEM_SELECT)
         
         Returns:
             MediaItem object
         """
-        return MediaItem(
-            id=row[0],
-            thread_id=row[1],
-            media_id=row[2],
-            filename=row[3],
-            image_path=row[4],
-            image_url=row[5],
-            title=row[6],
-            comments_json=row[7],
-            question_order=row[8]
-        )
+        return MediaItem(*row)
+    
+    def forum_from_row(self, row: tuple) -> Forum:
+        """Chuyển đổi row từ DB (theo thứ tự FORUM_COLUMNS) thành Forum object."""
+        return Forum(*row)
     
-    def save_media_items(self, thread_id: int, media_items_data: List[Dict]):
+    def save_media_items(self, thread_id: int, media_items_data: List[Dict]) -> int:
         """
         Lưu danh sách media items vào DB.
         
@@ -166,37 +839,197 @@ class DatabaseManager:
                     'image_url': 'https://...',
                     'title': 'Q1',
                     'comments': ['A', 'B'],  # List comments
+                    'comment_count': 2,  # Tổng số comments forum hiển thị (optional)
                     'question_order': 1
                 }, ...]
+        
+        Returns:
+            Số câu hỏi thay đổi nội dung (mới, đổi title/comments hoặc bị xóa),
+            dùng để `watch` biết thread có thay đổi sau lần cào lại hay không
         """
         import json
         
         with self.get_connection() as conn:
             cursor = conn.cursor()
             
-            # Xóa media items cũ của thread này (nếu có) để tránh duplicate
-            cursor.execute("DELETE FROM media_items WHERE thread_id = ?", (thread_id,))
+            # Media items hiện có của thread (media_id -> row) để chỉ ghi những gì thay đổi:
+            # id của media item được giữ nguyên nên comments/consensus/search index
+            # chỉ phải cập nhật cho các câu hỏi thực sự đổi nội dung
+            cursor.execute("""
+                SELECT id, media_id, filename, image_path, image_url, title, comments_json, question_order,
+                       comment_count
+                FROM media_items WHERE thread_id = ?
+            """, (thread_id,))
+            existing = {row[1]: row for row in cursor.fetchall()}
+            
+            course = self._thread_course(cursor, thread_id) if self.fts_enabled else None
+            seen = set()
+            content_changes = 0
             
-            # Insert media items mới
             for item in media_items_data:
-                comments_json = json.dumps(item.get('comments', []), ensure_ascii=False)
-                
-                cursor.execute("""
-                    INSERT INTO media_items 
-                    (thread_id, media_id, filename, image_path, image_url, title, comments_json, question_order)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    thread_id,
-                    str(item['media_id']),
+                media_id = str(item['media_id'])
+                comments = item.get('comments', [])
+                values = (
                     item.get('filename'),
                     item.get('image_path'),
                     item.get('image_url'),
                     item.get('title'),
-                    comments_json,
-                    item.get('question_order', 0)
-                ))
+                    json.dumps(comments, ensure_ascii=False),
+                    item.get('question_order', 0),
+                    item.get('comment_count')
+                )
+                seen.add(media_id)
+                old = existing.get(media_id)
+                
+                if old is None:
+                    cursor.execute("""
+                        INSERT INTO media_items 
+                        (thread_id, media_id, filename, image_path, image_url, title, comments_json,
+                         question_order, comment_count)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, (thread_id, media_id) + values)
+                    item_id = cursor.lastrowid
+                elif tuple(old[2:]) != values:
+                    item_id = old[0]
+                    cursor.execute("""
+                        UPDATE media_items
+                        SET filename = ?, image_path = ?, image_url = ?, title = ?,
+                            comments_json = ?, question_order = ?, comment_count = ?
+                        WHERE id = ?
+                    """, values + (item_id,))
+                else:
+                    # Không có gì thay đổi
+                    continue
+                
+                if old is None or old[6] != values[4]:
+                    self._sync_comments(cursor, thread_id, item_id, comments)
+                if old is None or old[5] != values[3] or old[6] != values[4]:
+                    content_changes += 1
+                
+                # Cập nhật search index trong cùng transaction
+                if self.fts_enabled:
+                    cursor.execute("DELETE FROM media_search WHERE rowid = ?", (item_id,))
+                    cursor.execute("""
+                        INSERT INTO media_search (rowid, title, comments, course, thread_id, question_order)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, (
+                        item_id,
+                        fold_search_text(item.get('title') or ''),
+                        fold_search_text('\n'.join(comments)),
+                        course,
+                        thread_id,
+                        item.get('question_order', 0)
+                    ))
+            
+            # Xóa media items không còn trong thread
+            for media_id, row in existing.items():
+                if media_id in seen:
+                    continue
+                cursor.execute("DELETE FROM comments WHERE media_item_id = ?", (row[0],))
+                if self.fts_enabled:
+                    cursor.execute("DELETE FROM media_search WHERE rowid = ?", (row[0],))
+                cursor.execute("DELETE FROM media_items WHERE id = ?", (row[0],))
+                content_changes += 1
             
             conn.commit()
+            return content_changes
+    
+    def _sync_comments(self, cursor: sqlite3.Cursor, thread_id: int, media_item_id: int, comments: List[str]):
+        """
+        Đồng bộ bảng comments của một media item với danh sách comments mới.
+        
+        Comments trên forum chủ yếu được thêm vào cuối, nên chỉ xóa/insert phần khác
+        nhau sau đoạn đầu trùng khớp. Trigger trên bảng comments tự cập nhật
+        answer_votes và answer_consensus.
+        """
+        from library.answer_utils import extract_answer_choice
+        
+        cursor.execute("""
+            SELECT body FROM comments WHERE media_item_id = ? ORDER BY position
+        """, (media_item_id,))
+        old_bodies = [row[0] for row in cursor.fetchall()]
+        
+        common = 0
+        for old_body, new_body in zip(old_bodies, comments):
+            if old_body != new_body:
+                break
+            common += 1
+        
+        if common < len(old_bodies):
+            cursor.execute("""
+                DELETE FROM comments WHERE media_item_id = ? AND position >= ?
+            """, (media_item_id, common))
+        
+        cursor.executemany("""
+            INSERT INTO comments (media_item_id, thread_id, position, body, answer)
+            VALUES (?, ?, ?, ?, ?)
+        """, [
+            (media_item_id, thread_id, position, body, extract_answer_choice(body))
+            for position, body in enumerate(comments[common:], start=common)
+        ])
+    
+    def _thread_course(self, cursor: sqlite3.Cursor, thread_id: int) -> Optional[str]:
+        """Lấy mã môn học của thread."""
+        cursor.execute("SELECT course FROM threads WHERE id = ?", (thread_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    
+    def rebuild_search_index(self, batch_size: int = 1000) -> int:
+        """
+        Xây lại toàn bộ search index từ bảng media_items (backfill cho library cũ).
+        
+        Args:
+            batch_size: Số media items insert mỗi lần
+        
+        Returns:
+            Số media items đã được index
+        
+        Raises:
+            RuntimeError: Nếu SQLite không hỗ trợ FTS5
+        """
+        import json
+        
+        if not self.fts_enabled:
+            raise RuntimeError("SQLite hiện tại không hỗ trợ FTS5, không thể tạo search index.")
+        
+        total = 0
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM media_search")
+            
+            read_cursor = conn.cursor()
+            read_cursor.execute("""
+                SELECT m.id, m.thread_id, m.title, m.comments_json, m.question_order, t.course
+                FROM media_items m
+                JOIN threads t ON t.id = m.thread_id
+            """)
+            while True:
+                rows = read_cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                
+                batch = []
+                for item_id, thread_id, title, comments_json, question_order, course in rows:
+                    try:
+                        comments = json.loads(comments_json) if comments_json else []
+                    except ValueError:
+                        comments = []
+                    batch.append((
+                        item_id, fold_search_text(title or ''), fold_search_text('\n'.join(comments)),
+                        course, thread_id, question_order
+                    ))
+                
+                cursor.executemany("""
+                    INSERT INTO media_search (rowid, title, comments, course, thread_id, question_order)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, batch)
+                total += len(batch)
+            
+            # Gộp các segment của FTS5 để query nhanh hơn
+            cursor.execute("INSERT INTO media_search (media_search) VALUES ('optimize')")
+            conn.commit()
+        
+        return total
     
     def get_media_items_by_thread(self, thread_id: int) -> List[MediaItem]:
         """
@@ -210,13 +1043,438 @@ class DatabaseManager:
         """
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM media_items 
+            cursor.execute(f"""
+                {MEDIA_ITEM_SELECT} 
                 WHERE thread_id = ? 
                 ORDER BY question_order ASC
             """, (thread_id,))
             rows = cursor.fetchall()
             
             return [self.media_item_from_row(row) for row in rows]
-
-
+    
+    def get_download_manifest(self, thread_id: int) -> Dict[str, Dict]:
+        """
+        Lấy manifest các ảnh đã tải xong của một thread (một query theo index thread_id).
+        
+        Args:
+            thread_id: ID của thread
+        
+        Returns:
+            Dict media_id -> {'file_path', 'file_size', 'sha256', 'image_url', 'title', 'comments', 'comment_count'}
+        """
+        import json
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT media_id, file_path, file_size, sha256, image_url, title, comments_json, comment_count
+                FROM download_manifest
+                WHERE thread_id = ?
+            """, (thread_id,))
+            rows = cursor.fetchall()
+        
+        manifest = {}
+        for media_id, file_path, file_size, sha256, image_url, title, comments_json, comment_count in rows:
+            manifest[media_id] = {
+                'file_path': file_path,
+                'file_size': file_size,
+                'sha256': sha256,
+                'image_url': image_url,
+                'title': title,
+                'comments': json.loads(comments_json) if comments_json else [],
+                'comment_count': comment_count
+            }
+        return manifest
+    
+    def save_manifest_entry(self, thread_id: int, media_id: str, entry: Dict) -> Optional[str]:
+        """
+        Ghi (hoặc cập nhật) một entry trong download manifest ngay khi ảnh tải xong.
+        Nếu ảnh từng bị evict, media item được đánh dấu là đã có lại ảnh gốc.
+        
+        Args:
+            thread_id: ID của thread
+            media_id: Media ID từ FUO
+            entry: Dict chứa 'file_path' (relative), 'file_size', 'sha256',
+                'image_url', 'title', 'comments', 'comment_count'
+        
+        Returns:
+            preview_path (relative) của bản thu nhỏ không còn cần nữa, None nếu không có
+        """
+        import json
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO download_manifest
+                (media_id, thread_id, file_path, file_size, sha256, image_url, title, comments_json,
+                 comment_count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(thread_id, media_id) DO UPDATE SET
+                    file_path = excluded.file_path,
+                    file_size = excluded.file_size,
+                    sha256 = excluded.sha256,
+                    image_url = excluded.image_url,
+                    title = excluded.title,
+                    comments_json = excluded.comments_json,
+                    comment_count = excluded.comment_count,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (
+                str(media_id),
+                thread_id,
+                entry['file_path'],
+                entry['file_size'],
+                entry.get('sha256'),
+                entry.get('image_url'),
+                entry.get('title'),
+                json.dumps(entry.get('comments', []), ensure_ascii=False),
+                entry.get('comment_count')
+            ))
+            
+            cursor.execute("""
+                SELECT id, preview_path FROM media_items
+                WHERE thread_id = ? AND media_id = ? AND evicted_at IS NOT NULL
+            """, (thread_id, str(media_id)))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute(
+                    "UPDATE media_items SET evicted_at = NULL, preview_path = NULL WHERE id = ?", (row[0],)
+                )
+            conn.commit()
+            return row[1] if row else None
+    
+    def mark_media_items_evicted(self, evicted: List[Tuple[int, Optional[str]]]):
+        """
+        Đánh dấu các media items đã bị xóa ảnh gốc (giữ lại manifest để tải lại khi cần).
+        
+        Args:
+            evicted: List các tuple (media_items.id, preview_path hoặc None)
+        """
+        evicted_at = datetime.now().isoformat()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE media_items SET evicted_at = ?, preview_path = ? WHERE id = ?",
+                [(evicted_at, preview_path, item_id) for item_id, preview_path in evicted]
+            )
+            conn.commit()
+    
+    def get_failed_items(self, thread_id: int) -> Dict[str, Dict]:
+        """
+        Lấy các media items lỗi của một thread.
+        
+        Args:
+            thread_id: ID của thread
+        
+        Returns:
+            Dict media_id -> {'media_id', 'error_kind', 'error_message', 'attempts'}
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT media_id, error_kind, error_message, attempts
+                FROM failed_items
+                WHERE thread_id = ?
+                ORDER BY id ASC
+            """, (thread_id,))
+            rows = cursor.fetchall()
+        
+        return {
+            media_id: {
+                'media_id': media_id,
+                'error_kind': error_kind,
+                'error_message': error_message,
+                'attempts': attempts
+            }
+            for media_id, error_kind, error_message, attempts in rows
+        }
+    
+    def save_failed_items(self, thread_id: int, failed_items: List[Dict]):
+        """
+        Ghi lại danh sách media items lỗi của lần cào mới nhất (thay thế danh sách cũ).
+        
+        Args:
+            thread_id: ID của thread
+            failed_items: List các dict chứa 'media_id', 'error_kind',
+                'error_message', 'attempts'
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM failed_items WHERE thread_id = ?", (thread_id,))
+            cursor.executemany("""
+                INSERT INTO failed_items (thread_id, media_id, error_kind, error_message, attempts)
+                VALUES (?, ?, ?, ?, ?)
+            """, [
+                (
+                    thread_id,
+                    str(item['media_id']),
+                    item['error_kind'],
+                    item.get('error_message'),
+                    item.get('attempts', 1)
+                )
+                for item in failed_items
+            ])
+            conn.commit()
+    
+    def clear_failed_items(self, thread_id: int) -> int:
+        """
+        Xóa danh sách media items lỗi của thread (để lần cào sau thử lại tất cả).
+        
+        Returns:
+            Số items đã xóa
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM failed_items WHERE thread_id = ?", (thread_id,))
+            conn.commit()
+            return cursor.rowcount
+    
+    def delete_manifest_entries(self, thread_id: int, media_ids: List[str]) -> int:
+        """
+        Xóa các entry trong download manifest để lần cào sau tải lại những ảnh này.
+        
+        Args:
+            thread_id: ID của thread
+            media_ids: List media ID cần tải lại
+        
+        Returns:
+            Số entries đã xóa
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "DELETE FROM download_manifest WHERE thread_id = ? AND media_id = ?",
+                [(thread_id, str(media_id)) for media_id in media_ids]
+            )
+            conn.commit()
+            return cursor.rowcount
+    
+    def get_verify_targets(self) -> List[Dict]:
+        """
+        Lấy danh sách file mà library tham chiếu tới: ảnh của media items (trừ ảnh đã evict)
+        và PDF của threads.
+        
+        Returns:
+            List các dict: thread_id, media_id (None với PDF), file_path (relative),
+            expected_size và sha256 (từ download manifest, None nếu không có)
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT m.thread_id, m.media_id, m.image_path, d.file_size, d.sha256
+                FROM media_items m
+                LEFT JOIN download_manifest d
+                    ON d.thread_id = m.thread_id AND d.media_id = m.media_id AND d.file_path = m.image_path
+                WHERE m.image_path IS NOT NULL AND m.evicted_at IS NULL
+                UNION ALL
+                SELECT id, NULL, pdf_path, NULL, NULL
+                FROM threads
+                WHERE pdf_path IS NOT NULL
+            """)
+            rows = cursor.fetchall()
+        
+        return [{
+            'thread_id': thread_id,
+            'media_id': media_id,
+            'file_path': file_path,
+            'expected_size': expected_size,
+            'sha256': sha256
+        } for thread_id, media_id, file_path, expected_size, sha256 in rows]
+    
+    def get_file_checks(self) -> Dict[str, Dict]:
+        """
+        Lấy kết quả verify đã lưu.
+        
+        Returns:
+            Dict file_path -> {'file_size', 'mtime_ns', 'sha256', 'status', 'error_message'}
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT file_path, file_size, mtime_ns, sha256, status, error_message
+                FROM file_checks
+            """)
+            rows = cursor.fetchall()
+        
+        return {
+            file_path: {
+                'file_size': file_size,
+                'mtime_ns': mtime_ns,
+                'sha256': sha256,
+                'status': status,
+                'error_message': error_message
+            }
+            for file_path, file_size, mtime_ns, sha256, status, error_message in rows
+        }
+    
+    def save_file_checks(self, checks: List[Dict]):
+        """
+        Ghi (hoặc cập nhật) kết quả verify của các file.
+        
+        Args:
+            checks: List các dict chứa 'file_path', 'thread_id', 'media_id', 'file_size',
+                'mtime_ns', 'sha256', 'status', 'error_message'
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO file_checks
+                (file_path, thread_id, media_id, file_size, mtime_ns, sha256, status, error_message, checked_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(file_path) DO UPDATE SET
+                    thread_id = excluded.thread_id,
+                    media_id = excluded.media_id,
+                    file_size = excluded.file_size,
+                    mtime_ns = excluded.mtime_ns,
+                    sha256 = excluded.sha256,
+                    status = excluded.status,
+                    error_message = excluded.error_message,
+                    checked_at = CURRENT_TIMESTAMP
+            """, [
+                (
+                    check['file_path'],
+                    check['thread_id'],
+                    check['media_id'],
+                    check['file_size'],
+                    check['mtime_ns'],
+                    check['sha256'],
+                    check['status'],
+                    check['error_message']
+                )
+                for check in checks
+            ])
+            conn.commit()
+    
+    def save_job_timings(self, rows: List[tuple]):
+        """
+        Ghi một lô span vào bảng job_timings.
+        
+        Args:
+            rows: List các tuple (thread_id, stage, url_class, status, bytes, duration_ms, started_at)
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO job_timings (thread_id, stage, url_class, status, bytes, duration_ms, started_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            conn.commit()
+    
+    def get_job_timings(self, since: float) -> List[Dict]:
+        """
+        Lấy các span bắt đầu từ thời điểm `since` (epoch seconds).
+        
+        Returns:
+            List các dict chứa 'thread_id', 'stage', 'url_class', 'status', 'bytes', 'duration_ms'
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT thread_id, stage, url_class, status, bytes, duration_ms
+                FROM job_timings
+                WHERE started_at >= ?
+            """, (since,))
+            return [
+                {
+                    'thread_id': row[0],
+                    'stage': row[1],
+                    'url_class': row[2],
+                    'status': row[3],
+                    'bytes': row[4],
+                    'duration_ms': row[5]
+                }
+                for row in cursor.fetchall()
+            ]
+    
+    def prune_job_timings(self, before: float) -> int:
+        """
+        Xóa các span bắt đầu trước thời điểm `before` (epoch seconds).
+        
+        Returns:
+            Số span đã xóa
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM job_timings WHERE started_at < ?", (before,))
+            conn.commit()
+            return cursor.rowcount
+    
+    def get_answer_consensus(self, thread_id: int) -> Dict[str, Dict]:
+        """
+        Lấy đáp án tổng hợp (đã tính sẵn) của các câu hỏi trong thread.
+        
+        Args:
+            thread_id: ID của thread
+        
+        Returns:
+            Dict {media_id: {'total_votes', 'top_answer', 'top_votes', 'agreement', 'votes'}},
+            chỉ gồm các câu hỏi có ít nhất một comment chọn đáp án
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT m.media_id, c.total_votes, c.top_answer, c.top_votes, c.agreement
+                FROM answer_consensus c
+                JOIN media_items m ON m.id = c.media_item_id
+                WHERE c.thread_id = ?
+            """, (thread_id,))
+            consensus = {
+                row[0]: {
+                    'total_votes': row[1],
+                    'top_answer': row[2],
+                    'top_votes': row[3],
+                    'agreement': row[4],
+                    'votes': {}
+                }
+                for row in cursor.fetchall()
+            }
+            
+            cursor.execute("""
+                SELECT m.media_id, v.answer, v.votes
+                FROM answer_votes v
+                JOIN media_items m ON m.id = v.media_item_id
+                WHERE m.thread_id = ?
+                ORDER BY v.answer
+            """, (thread_id,))
+            for media_id, answer, votes in cursor.fetchall():
+                if media_id in consensus:
+                    consensus[media_id]['votes'][answer] = votes
+            
+            return consensus
+    
+    def rebuild_comments(self) -> int:
+        """
+        Tách lại bảng comments (và answer consensus) từ comments_json của tất cả
+        media items (backfill cho library cũ hoặc sau khi đổi cách trích đáp án).
+        
+        Returns:
+            Số comments đã được tách
+        """
+        import json
+        from library.answer_utils import extract_answer_choice
+        
+        total = 0
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM answer_votes")
+            cursor.execute("DELETE FROM comments")
+            cursor.execute("DELETE FROM answer_consensus")
+            
+            read_cursor = conn.cursor()
+            read_cursor.execute("SELECT id, thread_id, comments_json FROM media_items")
+            for item_id, thread_id, comments_json in read_cursor:
+                try:
+                    comments = json.loads(comments_json) if comments_json else []
+                except ValueError:
+                    comments = []
+                cursor.executemany("""
+                    INSERT INTO comments (media_item_id, thread_id, position, body, answer)
+                    VALUES (?, ?, ?, ?, ?)
+                """, [
+                    (item_id, thread_id, position, body, extract_answer_choice(body))
+                    for position, body in enumerate(comments)
+                ])
+                total += len(comments)
+            
+            conn.commit()
+        
+        return total
@@ -0,0 +1,95 @@
+# library/answer_utils.py
+
+import re
+from collections import Counter
+from typing import Dict, Iterable, Optional
+
+# Các lựa chọn đáp án hợp lệ trong đề trắc nghiệm
+ANSWER_CHOICES = 'ABCDEF'
+
+# Comment chỉ gồm một chữ cái: "A", "b.", "(C)", "D !!"
+_ONLY_CHOICE = re.compile(r'^\(?([A-F])\)?[\s.,:;!)\-]*$', re.IGNORECASE)
+
+# Từ khóa đứng trước đáp án: "đáp án B", "dap an: c", "chọn D", "ans A", "key: B", "câu này là C"
+_KEYWORD_CHOICE = re.compile(
+    r'(?<!\w)(?:đáp\s*án|dap\s*an|đa|chọn|chon|ans(?:wer)?|key|là|la)\s*[:=\-]?\s*\(?([A-F])\)?(?!\w)',
+    re.IGNORECASE
+)
+
+# Comment mở đầu bằng đáp án: "A la dap an", "B nhé", "C. vì ..." (chỉ chữ hoa, tránh "a lot")
+# (?!\w) hiểu Unicode: chữ cái đầu của từ tiếng Việt ("Bàn", "Cả") không phải đáp án
+_LEADING_CHOICE = re.compile(r'^\(?([A-F])\)?(?!\w)(?:[.,:;!)\-]|\s+(?=\S))')
+
+def extract_answer_choice(comment: str) -> Optional[str]:
+    """
+    Trích đáp án (A/B/C/D...) mà một comment chọn.
+    
+    Args:
+        comment: Nội dung comment
+    
+    Returns:
+        Chữ cái đáp án viết hoa, None nếu comment không chọn đáp án rõ ràng
+    
+    Ví dụ (chạy: python -m doctest library/answer_utils.py):
+    
+    >>> extract_answer_choice('đáp án: B')
+    'B'
+    >>> extract_answer_choice('A la dap an')
+    'A'
+    >>> extract_answer_choice('câu này là C nhé')
+    'C'
+    >>> extract_answer_choice('chọn cả hai') is None
+    True
+    >>> extract_answer_choice('la bàn') is None
+    True
+    >>> extract_answer_choice('Đáp ứng yêu cầu') is None
+    True
+    >>> extract_answer_choice('Bàn luận thêm') is None
+    True
+    """
+    text = (comment or '').strip()
+    if not text:
+        return None
+    
+    for pattern in (_ONLY_CHOICE, _KEYWORD_CHOICE, _LEADING_CHOICE):
+        match = pattern.search(text)
+        if match:
+            return match.group(1).upper()
+    return None
+
+def summarize_answers(comments: Iterable[str]) -> Optional[Dict]:
+    """
+    Tổng hợp đáp án từ danh sách comments (dùng khi không có summary trong DB).
+    
+    Args:
+        comments: List nội dung comments
+    
+    Returns:
+        Dict cùng format với DatabaseManager.get_answer_consensus, None nếu không có phiếu nào
+    """
+    votes = Counter(
+        answer for answer in (extract_answer_choice(c) for c in comments) if answer
+    )
+    if not votes:
+        return None
+    
+    total_votes = sum(votes.values())
+    # Hòa phiếu -> chọn chữ cái nhỏ hơn (giống thứ tự trong DB)
+    top_answer, top_votes = min(votes.items(), key=lambda kv: (-kv[1], kv[0]))
+    return {
+        'total_votes': total_votes,
+        'top_answer': top_answer,
+        'top_votes': top_votes,
+        'agreement': top_votes / total_votes,
+        'votes': dict(sorted(votes.items()))
+    }
+
+def format_consensus(summary: Optional[Dict]) -> str:
+    """
+    Chuỗi mô tả ngắn của summary, vd: "B - 7/10 phiếu (70%) | A: 2, B: 7, C: 1".
+    """
+    if not summary:
+        return "Chưa có đáp án nào được chọn"
+    votes = ', '.join(f"{answer}: {count}" for answer, count in summary['votes'].items())
+    return (f"{summary['top_answer']} - {summary['top_votes']}/{summary['total_votes']} phiếu "
+            f"({summary['agreement']:.0%}) | {votes}")
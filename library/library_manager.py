@@ -1,9 +1,15 @@
 # library/library_manager.py
 
-from typing import Optional, List
+import sqlite3
+from typing import Optional, List, Dict, Iterator, Iterable, Tuple
 from datetime import datetime
-from database.models import DatabaseManager, Thread, ThreadStatus
-from library.thread_utils import normalize_url
+from database.models import (
+    DatabaseManager, Thread, ThreadStatus, Forum, THREAD_SELECT, FORUM_SELECT, fold_search_text
+)
+from library.thread_utils import normalize_url, canonical_thread_key, extract_course_code, get_base_url
+
+# Rowid lớn nhất của SQLite: cursor ban đầu khi duyệt từ thread mới nhất
+_MAX_ROWID = 2 ** 63 - 1
 
 class LibraryManager:
     """Quản lý library (thư viện threads)"""
@@ -21,24 +27,32 @@ class LibraryManager:
         """
         Kiểm tra thread đã có trong library chưa.
         
+        URL thread được so theo (host, thread ID của XenForo) nên mọi biến thể URL
+        (page-2, #post-..., ?query, http/https, slug đã đổi) đều khớp cùng một thread,
+        còn thread cùng ID trên site khác thì không.
+        Không cần truy cập mạng.
+        
         Args:
             url: URL của thread
         
         Returns:
             Thread object nếu có, None nếu chưa có
         """
-        normalized_url = normalize_url(url)
+        key = canonical_thread_key(url)
         
         with self.db.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM threads WHERE url = ?", (normalized_url,))
+            if key is not None:
+                cursor.execute(f"{THREAD_SELECT} WHERE xf_host = ? AND xf_thread_id = ?", key)
+            else:
+                cursor.execute(f"{THREAD_SELECT} WHERE url = ?", (normalize_url(url),))
             row = cursor.fetchone()
             
             if row:
                 return self.db.thread_from_row(row)
             return None
     
-    def add_thread(self, url: str, title: str = None) -> Thread:
+    def add_thread(self, url: str, title: str = None, priority: int = 0, forum_id: Optional[int] = None) -> Thread:
         """
         Thêm thread vào library (với status = pending).
         Nếu đã tồn tại, return thread hiện có.
@@ -46,6 +60,8 @@ class LibraryManager:
         Args:
             url: URL của thread
             title: Tiêu đề của thread (nếu không có sẽ dùng URL)
+            priority: Độ ưu tiên trong queue (càng lớn càng được xử lý trước)
+            forum_id: Forum chứa thread (None = forum mặc định của site trong URL)
         
         Returns:
             Thread object
@@ -64,19 +80,95 @@ class LibraryManager:
             if not title or title == normalized_url:
                 title = normalized_url
         
+        if forum_id is None:
+            forum_id = self.get_or_create_forum(get_base_url(normalized_url)).id
+        
+        xf_host, xf_thread_id = canonical_thread_key(normalized_url) or (None, None)
+        
         with self.db.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO threads (url, title, status)
-                VALUES (?, ?, ?)
-            """, (normalized_url, title, ThreadStatus.PENDING.value))
+            try:
+                cursor.execute("""
+                    INSERT INTO threads (url, title, status, priority, course, xf_host, xf_thread_id, forum_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (
+                    normalized_url, title, ThreadStatus.PENDING.value, priority,
+                    extract_course_code(normalized_url, title), xf_host, xf_thread_id, forum_id
+                ))
+            except sqlite3.IntegrityError:
+                # Process khác vừa thêm cùng thread
+                conn.rollback()
+                existing = self.check_thread_exists(normalized_url)
+                if existing:
+                    return existing
+                raise
             conn.commit()
             
             thread_id = cursor.lastrowid
-            cursor.execute("SELECT * FROM threads WHERE id = ?", (thread_id,))
+            cursor.execute(f"{THREAD_SELECT} WHERE id = ?", (thread_id,))
             row = cursor.fetchone()
             return self.db.thread_from_row(row)
     
+    def get_or_create_forum(self, url: str, title: Optional[str] = None) -> Forum:
+        """
+        Lấy forum theo URL, thêm mới nếu chưa có. Base URL được tính một lần lúc thêm.
+        
+        Args:
+            url: URL forum (vd: https://fuoverflow.com/forums/csi106.123/) hoặc base URL của site
+            title: Tên forum (None = giữ tên hiện có / dùng host)
+        
+        Returns:
+            Forum object
+        """
+        normalized_url = normalize_url(url)
+        base_url = get_base_url(normalized_url)
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO forums (url, base_url, title) VALUES (?, ?, ?)
+                ON CONFLICT(url) DO NOTHING
+            """, (normalized_url, base_url, title or base_url.split('://', 1)[-1]))
+            if title and not cursor.rowcount:
+                cursor.execute("UPDATE forums SET title = ? WHERE url = ?", (title, normalized_url))
+            conn.commit()
+            cursor.execute(f"{FORUM_SELECT} WHERE url = ?", (normalized_url,))
+            return self.db.forum_from_row(cursor.fetchone())
+    
+    def get_forum(self, forum_id: int) -> Optional[Forum]:
+        """Lấy forum theo ID (None nếu không có)."""
+        with self.db.get_connection() as conn:
+            row = conn.execute(f"{FORUM_SELECT} WHERE id = ?", (forum_id,)).fetchone()
+            return self.db.forum_from_row(row) if row else None
+    
+    def get_forums(self) -> List[Forum]:
+        """Lấy tất cả forums theo thứ tự thêm vào."""
+        with self.db.get_connection() as conn:
+            return [self.db.forum_from_row(row) for row in conn.execute(f"{FORUM_SELECT} ORDER BY id")]
+    
+    def update_forum(self, forum: Forum):
+        """Cập nhật tên và rate budget (min_interval) của forum."""
+        with self.db.get_connection() as conn:
+            conn.execute(
+                "UPDATE forums SET title = ?, min_interval = ? WHERE id = ?",
+                (forum.title, forum.min_interval, forum.id)
+            )
+            conn.commit()
+    
+    def get_forum_queue_stats(self) -> Dict[int, Dict[str, int]]:
+        """
+        Số threads theo status của từng forum.
+        
+        Returns:
+            Dict {forum_id: {status: count}}
+        """
+        stats: Dict[int, Dict[str, int]] = {}
+        with self.db.get_connection() as conn:
+            for forum_id, status, count in conn.execute(
+                "SELECT forum_id, status, COUNT(*) FROM threads GROUP BY forum_id, status"
+            ):
+                stats.setdefault(forum_id, {})[status] = count
+        return stats
+    
     def get_thread_by_id(self, thread_id: int) -> Optional[Thread]:
         """
         Lấy thread theo ID.
@@ -89,7 +181,7 @@ class LibraryManager:
         """
         with self.db.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM threads WHERE id = ?", (thread_id,))
+            cursor.execute(f"{THREAD_SELECT} WHERE id = ?", (thread_id,))
             row = cursor.fetchone()
             
             if row:
@@ -115,20 +207,83 @@ class LibraryManager:
             cursor = conn.cursor()
             
             if status:
-                query = "SELECT * FROM threads WHERE status = ? ORDER BY created_at DESC"
+                query = f"{THREAD_SELECT} WHERE status = ? ORDER BY created_at DESC"
                 params = (status.value,)
             else:
-                query = "SELECT * FROM threads ORDER BY created_at DESC"
+                query = f"{THREAD_SELECT} ORDER BY created_at DESC"
                 params = ()
             
             if limit:
-                query += f" LIMIT {limit}"
+                query += " LIMIT ?"
+                params += (limit,)
             
             cursor.execute(query, params)
             rows = cursor.fetchall()
             
             return [self.db.thread_from_row(row) for row in rows]
     
+    def iter_threads(
+        self,
+        after_id: int = 0,
+        status: Optional[ThreadStatus] = None,
+        course: Optional[str] = None,
+        batch_size: int = 500,
+        raw: bool = False,
+        newest_first: bool = False
+    ) -> Iterator[Thread]:
+        """
+        Duyệt threads theo id tăng dần (keyset pagination), đọc từng batch.
+        
+        Mỗi batch là một query `WHERE id > <id cuối của batch trước>` dùng index
+        nên bộ nhớ không phụ thuộc vào số threads trong library, và không bị
+        chậm dần như OFFSET.
+        
+        Args:
+            after_id: Chỉ lấy threads có id > after_id (cursor của trang trước)
+            status: Filter theo status (None = tất cả)
+            course: Filter theo mã môn học (vd: 'CSI106')
+            batch_size: Số rows đọc mỗi lần query
+            raw: True = trả về tuple theo THREAD_COLUMNS thay vì Thread object
+                (fast path cho export/batch, không tạo object cho từng row)
+            newest_first: Duyệt theo id giảm dần (thread mới thêm trước); after_id khi đó
+                là cursor theo chiều ngược lại (chỉ lấy threads có id < after_id)
+        
+        Yields:
+            Thread objects (hoặc tuple nếu raw=True)
+        """
+        conditions = ["id < ?" if newest_first else "id > ?"]
+        filters = []
+        if status:
+            conditions.append("status = ?")
+            filters.append(status.value)
+        if course:
+            conditions.append("course = ?")
+            filters.append(course.upper())
+        
+        order = 'DESC' if newest_first else 'ASC'
+        query = f"{THREAD_SELECT} WHERE {' AND '.join(conditions)} ORDER BY id {order} LIMIT ?"
+        last_id = (after_id or _MAX_ROWID) if newest_first else after_id
+        
+        # Một connection cho cả lần duyệt; mỗi batch fetchall xong mới yield
+        # nên không giữ read transaction trong lúc caller xử lý dữ liệu
+        conn = self.db.get_connection()
+        try:
+            while True:
+                rows = conn.execute(query, [last_id] + filters + [batch_size]).fetchall()
+                
+                if raw:
+                    yield from rows
+                else:
+                    thread_from_row = self.db.thread_from_row
+                    for row in rows:
+                        yield thread_from_row(row)
+                
+                if len(rows) < batch_size:
+                    return
+                last_id = rows[-1][0]
+        finally:
+            conn.close()
+    
     def update_thread(self, thread: Thread):
         """
         Cập nhật thông tin thread trong database.
@@ -142,7 +297,8 @@ class LibraryManager:
                 UPDATE threads 
                 SET title = ?, status = ?, folder_path = ?, pdf_path = ?,
                     total_questions = ?, updated_at = CURRENT_TIMESTAMP,
-                    completed_at = ?, error_message = ?
+                    completed_at = ?, error_message = ?,
+                    priority = ?, not_before = ?, retry_count = ?
                 WHERE id = ?
             """, (
                 thread.title,
@@ -152,8 +308,205 @@ class LibraryManager:
                 thread.total_questions,
                 thread.completed_at.isoformat() if thread.completed_at else None,
                 thread.error_message,
+                thread.priority,
+                thread.not_before,
+                thread.retry_count,
                 thread.id
             ))
             conn.commit()
+    
+    def search_media(self, query: str, course: Optional[str] = None, limit: int = 20) -> List[Dict]:
+        """
+        Tìm câu hỏi theo nội dung title + comments (full-text search, xếp hạng bm25).
+        
+        Args:
+            query: Từ khóa cần tìm (hỗ trợ cú pháp FTS5: "cụm từ", OR, NOT, prefix*)
+            course: Chỉ tìm trong một môn học (vd: 'CSI106')
+            limit: Số kết quả tối đa
+        
+        Returns:
+            List các dict: thread_id, thread_title, question_order, media_id,
+            image_path, snippet, score (càng nhỏ càng liên quan)
+        
+        Raises:
+            RuntimeError: Nếu SQLite không hỗ trợ FTS5
+        """
+        if not self.db.fts_enabled:
+            raise RuntimeError("SQLite hiện tại không hỗ trợ FTS5, không thể tìm kiếm.")
+        
+        sql = """
+            SELECT s.thread_id, t.title, s.question_order, m.media_id, m.image_path,
+                   snippet(media_search, -1, '[', ']', '…', 12), s.rank
+            FROM media_search s
+            JOIN media_items m ON m.id = s.rowid
+            JOIN threads t ON t.id = m.thread_id
+            WHERE media_search MATCH ?
+        """
+        if course:
+            sql += " AND s.course = ?"
+        sql += " ORDER BY s.rank LIMIT ?"
+        
+        def run(match: str) -> list:
+            params = [match] + ([course.upper()] if course else []) + [limit]
+            with self.db.get_connection() as conn:
+                return conn.execute(sql, params).fetchall()
+        
+        query = fold_search_text(query)
+        try:
+            rows = run(query)
+        except sqlite3.OperationalError:
+            # Query có ký tự đặc biệt của FTS5 -> tìm theo từng từ (quote từng token)
+            tokens = ['"' + token.replace('"', '""') + '"' for token in query.split()]
+            if not tokens:
+                return []
+            rows = run(' '.join(tokens))
+        
+        return [{
+            'thread_id': row[0],
+            'thread_title': row[1],
+            'question_order': row[2],
+            'media_id': row[3],
+            'image_path': row[4],
+            'snippet': row[5],
+            'score': row[6]
+        } for row in rows]
+    
+    def is_search_index_empty(self) -> bool:
+        """True nếu đã có media items nhưng search index chưa được build (library cũ)."""
+        with self.db.get_connection() as conn:
+            has_items = conn.execute("SELECT 1 FROM media_items LIMIT 1").fetchone()
+            has_index = conn.execute("SELECT 1 FROM media_search LIMIT 1").fetchone()
+        return bool(has_items) and not has_index
+    
+    def save_storage_stats(self, stats_list: Iterable[Tuple[int, Dict[str, int]]]) -> int:
+        """
+        Lưu thống kê dung lượng (file_count, image_count, image_bytes, pdf_bytes) của threads.
+        
+        Args:
+            stats_list: Iterable các tuple (thread_id, stats) từ library.storage
+        
+        Returns:
+            Số threads đã cập nhật
+        """
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                UPDATE threads
+                SET file_count = ?, image_count = ?, image_bytes = ?, pdf_bytes = ?,
+                    stats_updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, [
+                (stats['file_count'], stats['image_count'], stats['image_bytes'], stats['pdf_bytes'], thread_id)
+                for thread_id, stats in stats_list
+            ])
+            conn.commit()
+            return cursor.rowcount
+    
+    def get_storage_summary(self, by_course: bool = False) -> List[Dict]:
+        """
+        Tổng hợp dung lượng library từ các cột thống kê (không đụng tới ổ đĩa).
+        
+        Args:
+            by_course: True = nhóm theo mã môn học
+        
+        Returns:
+            List các dict: course (None nếu không nhóm), threads, scanned, files,
+            images, image_bytes, pdf_bytes. Khi nhóm theo môn, sắp xếp theo dung lượng giảm dần
+        """
+        group = "GROUP BY course ORDER BY SUM(COALESCE(image_bytes, 0) + COALESCE(pdf_bytes, 0)) DESC" \
+            if by_course else ""
+        with self.db.get_connection() as conn:
+            rows = conn.execute(f"""
+                SELECT {'course' if by_course else 'NULL'},
+                       COUNT(*), COUNT(stats_updated_at),
+                       COALESCE(SUM(file_count), 0), COALESCE(SUM(image_count), 0),
+                       COALESCE(SUM(image_bytes), 0), COALESCE(SUM(pdf_bytes), 0)
+                FROM threads
+                WHERE folder_path IS NOT NULL
+                {group}
+            """).fetchall()
+        
+        return [{
+            'course': row[0],
+            'threads': row[1],
+            'scanned': row[2],
+            'files': row[3],
+            'images': row[4],
+            'image_bytes': row[5],
+            'pdf_bytes': row[6]
+        } for row in rows]
+    
+    def get_largest_threads(self, limit: int) -> List[Dict]:
+        """
+        Lấy các threads chiếm nhiều dung lượng nhất (theo thống kê đã lưu).
+        
+        Args:
+            limit: Số threads
+        
+        Returns:
+            List các dict: id, title, course, image_count, image_bytes, pdf_bytes, total_bytes
+        """
+        with self.db.get_connection() as conn:
+            rows = conn.execute("""
+                SELECT id, title, course, image_count, image_bytes, pdf_bytes,
+                       COALESCE(image_bytes, 0) + COALESCE(pdf_bytes, 0) AS total_bytes
+                FROM threads
+                WHERE stats_updated_at IS NOT NULL
+                ORDER BY total_bytes DESC
+                LIMIT ?
+            """, (limit,)).fetchall()
+        
+        return [{
+            'id': row[0],
+            'title': row[1],
+            'course': row[2],
+            'image_count': row[3],
+            'image_bytes': row[4],
+            'pdf_bytes': row[5],
+            'total_bytes': row[6]
+        } for row in rows]
+    
+    def touch_thread(self, thread_id: int):
+        """
+        Ghi lại thời điểm thread được truy cập (xem/render), dùng cho LRU eviction.
+        
+        Args:
+            thread_id: ID của thread
+        """
+        with self.db.get_connection() as conn:
+            conn.execute(
+                "UPDATE threads SET last_accessed_at = ? WHERE id = ?",
+                (datetime.now().isoformat(), thread_id)
+            )
+            conn.commit()
+    
+    def get_eviction_candidates(self) -> List[Dict]:
+        """
+        Lấy các threads completed còn ảnh gốc trên đĩa, theo thứ tự LRU
+        (lần truy cập hoặc hoàn thành gần nhất, cũ nhất trước).
+        
+        Returns:
+            List các dict: id, title, folder_path, pdf_path, image_bytes
+        """
+        with self.db.get_connection() as conn:
+            rows = conn.execute("""
+                SELECT id, title, folder_path, pdf_path, COALESCE(image_bytes, 0)
+                FROM threads
+                WHERE status = ? AND pdf_path IS NOT NULL
+                  AND EXISTS (
+                      SELECT 1 FROM media_items
+                      WHERE media_items.thread_id = threads.id
+                        AND image_path IS NOT NULL AND evicted_at IS NULL
+                  )
+                ORDER BY MAX(COALESCE(last_accessed_at, ''), COALESCE(completed_at, '')) ASC, id ASC
+            """, (ThreadStatus.COMPLETED.value,)).fetchall()
+        
+        return [{
+            'id': row[0],
+            'title': row[1],
+            'folder_path': row[2],
+            'pdf_path': row[3],
+            'image_bytes': row[4]
+        } for row in rows]
 
 
@@ -0,0 +1,102 @@
+# library/perf.py
+
+import re
+import time
+from collections import defaultdict
+from typing import Dict, List
+from database.models import DatabaseManager
+from scraper.timing import percentile
+
+# Thứ tự hiển thị các stage trong báo cáo (stage lạ được xếp sau)
+STAGE_ORDER = ('job', 'discover', 'rate_limit', 'media_json', 'image_download',
+               'export', 'persist_media', 'render', 'persist')
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_since(text: str) -> float:
+    """
+    Đổi khoảng thời gian dạng '30m', '12h', '1d', '2w' (số không đơn vị = giây) thành giây.
+    
+    Raises:
+        ValueError: Nếu không đúng định dạng
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*', text.lower())
+    if not match:
+        raise ValueError(f"Khoảng thời gian không hợp lệ: {text!r} (vd: 30m, 12h, 1d, 2w)")
+    return float(match.group(1)) * _UNITS[match.group(2) or 's']
+
+def _distribution(durations: List[float]) -> Dict:
+    durations.sort()
+    return {
+        'count': len(durations),
+        'p50': percentile(durations, 50),
+        'p95': percentile(durations, 95),
+        'p99': percentile(durations, 99),
+        'total': sum(durations)
+    }
+
+def build_perf_report(db_manager: DatabaseManager, since_seconds: float, top: int = 10) -> Dict:
+    """
+    Tổng hợp bảng job_timings trong khoảng thời gian gần đây.
+    
+    Args:
+        db_manager: DatabaseManager instance
+        since_seconds: Chỉ tính các span bắt đầu trong `since_seconds` giây gần nhất
+        top: Số threads chậm nhất cần liệt kê
+    
+    Returns:
+        Dict chứa:
+            - spans: Tổng số span
+            - stages: List dict (stage, count, p50, p95, p99, total) - thời gian tính bằng ms
+            - http: List dict (url_class, count, p50, p95, p99, total, bytes, errors)
+            - slowest: List dict (thread_id, jobs, max_ms, stages {stage: tổng ms})
+    """
+    spans = db_manager.get_job_timings(time.time() - since_seconds)
+    
+    by_stage = defaultdict(list)
+    by_url_class = defaultdict(list)
+    http_bytes = defaultdict(int)
+    http_errors = defaultdict(int)
+    thread_stages = defaultdict(lambda: defaultdict(float))
+    thread_jobs = defaultdict(list)
+    
+    for span in spans:
+        if span['stage'] == 'http':
+            url_class = span['url_class'] or 'other'
+            by_url_class[url_class].append(span['duration_ms'])
+            http_bytes[url_class] += span['bytes'] or 0
+            if span['status'] is not None and span['status'] >= 400:
+                http_errors[url_class] += 1
+            continue
+        by_stage[span['stage']].append(span['duration_ms'])
+        if span['thread_id'] is not None:
+            thread_stages[span['thread_id']][span['stage']] += span['duration_ms']
+            if span['stage'] == 'job':
+                thread_jobs[span['thread_id']].append(span['duration_ms'])
+    
+    order = {stage: i for i, stage in enumerate(STAGE_ORDER)}
+    stages = [
+        dict(stage=stage, **_distribution(durations))
+        for stage, durations in sorted(by_stage.items(), key=lambda kv: (order.get(kv[0], len(order)), kv[0]))
+    ]
+    http = [
+        dict(url_class=url_class, bytes=http_bytes[url_class], errors=http_errors[url_class],
+             **_distribution(durations))
+        for url_class, durations in sorted(by_url_class.items(), key=lambda kv: -len(kv[1]))
+    ]
+    
+    slowest = sorted(thread_jobs.items(), key=lambda kv: max(kv[1]), reverse=True)[:top]
+    return {
+        'spans': len(spans),
+        'stages': stages,
+        'http': http,
+        'slowest': [
+            {
+                'thread_id': thread_id,
+                'jobs': len(jobs),
+                'max_ms': max(jobs),
+                'stages': dict(thread_stages[thread_id])
+            }
+            for thread_id, jobs in slowest
+        ]
+    }
@@ -0,0 +1,245 @@
+# library/retention.py
+
+import os
+import json
+import requests
+from typing import Dict, List, Optional, Tuple
+from PIL import Image
+from database.models import DatabaseManager, Thread
+from library.library_manager import LibraryManager
+from library.storage import scan_thread_folder
+from library.thread_utils import get_host
+from library.verifier import OK, CORRUPT, deep_check_file
+from scraper.downloader import download_file
+from scraper.rate_limiter import get_rate_limiter
+from scraper.scraper import get_absolute_path, make_relative_path
+import config
+
+# Hậu tố của bản thu nhỏ giữ lại khi evict (vd: image_200.png -> image_200.preview.jpg)
+PREVIEW_SUFFIX = '.preview.jpg'
+
+def get_storage_budget() -> Optional[int]:
+    """Lấy giới hạn dung lượng (bytes) từ config.STORAGE_BUDGET_GB, None = không giới hạn."""
+    budget_gb = getattr(config, 'STORAGE_BUDGET_GB', None)
+    if not budget_gb:
+        return None
+    return int(float(budget_gb) * 1024 ** 3)
+
+def make_preview(image_path: str) -> Optional[str]:
+    """
+    Tạo bản thu nhỏ (JPEG) của ảnh, cạnh dài tối đa config.STORAGE_PREVIEW_MAX_PX.
+    
+    Args:
+        image_path: Đường dẫn tuyệt đối của ảnh gốc
+    
+    Returns:
+        Đường dẫn tuyệt đối của bản thu nhỏ, None nếu không tạo được hoặc không nhỏ hơn ảnh gốc
+    """
+    max_px = getattr(config, 'STORAGE_PREVIEW_MAX_PX', 1024)
+    preview_path = os.path.splitext(image_path)[0] + PREVIEW_SUFFIX
+    try:
+        with Image.open(image_path) as img:
+            img.thumbnail((max_px, max_px))
+            img.convert('RGB').save(preview_path, 'JPEG', quality=70, optimize=True)
+        # Ảnh gốc vốn đã nhỏ -> bản thu nhỏ không tiết kiệm được gì
+        if os.path.getsize(preview_path) >= os.path.getsize(image_path):
+            os.remove(preview_path)
+            return None
+        return preview_path
+    except Exception as e:
+        print(f"    (!) Không tạo được bản thu nhỏ cho {os.path.basename(image_path)}: {e}")
+        return None
+
+def _verify_pdf(db_manager: DatabaseManager, thread_id: int, pdf_path: str) -> bool:
+    """Kiểm tra sâu PDF của thread trước khi xóa ảnh gốc (ghi kết quả vào file_checks)."""
+    abs_pdf = get_absolute_path(pdf_path)
+    try:
+        stat = os.stat(abs_pdf)
+    except OSError:
+        return False
+    digest, error = deep_check_file(abs_pdf)
+    db_manager.save_file_checks([{
+        'file_path': pdf_path,
+        'thread_id': thread_id,
+        'media_id': None,
+        'file_size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': digest,
+        'status': CORRUPT if error else OK,
+        'error_message': error
+    }])
+    return error is None
+
+def evict_thread(
+    db_manager: DatabaseManager,
+    library_manager: LibraryManager,
+    thread_id: int,
+    pdf_path: str,
+    folder_path: str,
+    keep_previews: bool = False
+) -> Optional[int]:
+    """
+    Xóa ảnh gốc của một thread completed sau khi xác nhận PDF còn nguyên vẹn.
+    
+    Manifest được giữ lại nên khi cào lại/render lại, ảnh được tải lại từ FUO.
+    
+    Args:
+        db_manager: DatabaseManager instance
+        library_manager: LibraryManager instance
+        thread_id: ID của thread
+        pdf_path: PDF của thread (relative path)
+        folder_path: Thư mục của thread (relative path)
+        keep_previews: Giữ lại bản thu nhỏ của từng ảnh
+    
+    Returns:
+        Số bytes đã giải phóng, None nếu bỏ qua vì PDF không hợp lệ
+    """
+    if not _verify_pdf(db_manager, thread_id, pdf_path):
+        print(f"    (!) Bỏ qua thread ID {thread_id}: PDF không tồn tại hoặc bị hỏng")
+        return None
+    
+    abs_folder = get_absolute_path(folder_path)
+    before = scan_thread_folder(abs_folder)
+    
+    evicted = []
+    for item in db_manager.get_media_items_by_thread(thread_id):
+        if item.evicted_at or not item.image_path:
+            continue
+        abs_image = get_absolute_path(item.image_path)
+        preview_path = None
+        if keep_previews and os.path.exists(abs_image):
+            preview_path = make_relative_path(make_preview(abs_image))
+        try:
+            os.remove(abs_image)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"    (!) Không xóa được {item.image_path}: {e}")
+            continue
+        evicted.append((item.id, preview_path))
+    
+    db_manager.mark_media_items_evicted(evicted)
+    after = scan_thread_folder(abs_folder)
+    library_manager.save_storage_stats([(thread_id, after)])
+    return (before['image_bytes'] + before['pdf_bytes']) - (after['image_bytes'] + after['pdf_bytes'])
+
+def enforce_storage_budget(
+    db_manager: DatabaseManager,
+    library_manager: LibraryManager,
+    budget_bytes: Optional[int] = None,
+    keep_previews: Optional[bool] = None,
+    dry_run: bool = False
+) -> Optional[Dict]:
+    """
+    Evict ảnh gốc của các threads ít dùng nhất (LRU) cho đến khi library nằm trong giới hạn.
+    
+    Dung lượng được tính từ thống kê trong bảng threads (xem `du`), không duyệt ổ đĩa.
+    
+    Args:
+        db_manager: DatabaseManager instance
+        library_manager: LibraryManager instance
+        budget_bytes: Giới hạn (bytes), mặc định từ config.STORAGE_BUDGET_GB
+        keep_previews: Giữ bản thu nhỏ, mặc định config.STORAGE_KEEP_PREVIEWS
+        dry_run: Chỉ liệt kê các threads sẽ bị evict
+    
+    Returns:
+        Dict chứa 'budget', 'usage_before', 'usage_after', 'evicted' (list thread ID);
+        None nếu không đặt giới hạn
+    """
+    if budget_bytes is None:
+        budget_bytes = get_storage_budget()
+    if budget_bytes is None:
+        return None
+    if keep_previews is None:
+        keep_previews = getattr(config, 'STORAGE_KEEP_PREVIEWS', False)
+    
+    summary = library_manager.get_storage_summary()
+    usage = sum(row['image_bytes'] + row['pdf_bytes'] for row in summary)
+    report = {'budget': budget_bytes, 'usage_before': usage, 'usage_after': usage, 'evicted': []}
+    if usage <= budget_bytes:
+        return report
+    
+    for candidate in library_manager.get_eviction_candidates():
+        if usage <= budget_bytes:
+            break
+        if dry_run:
+            freed = candidate['image_bytes']
+        else:
+            freed = evict_thread(
+                db_manager, library_manager, candidate['id'],
+                candidate['pdf_path'], candidate['folder_path'], keep_previews
+            )
+            if freed is None:
+                continue
+        usage -= freed
+        report['evicted'].append(candidate['id'])
+    
+    report['usage_after'] = usage
+    return report
+
+def load_question_data(
+    session: Optional[requests.Session],
+    db_manager: DatabaseManager,
+    thread: Thread
+) -> Tuple[List[Dict], int, int]:
+    """
+    Dựng lại dữ liệu câu hỏi của thread từ DB để render PDF, tải lại ảnh đã bị evict.
+    
+    Ảnh tải lại được ghi vào manifest (media item hết trạng thái evicted); nếu không tải
+    được thì dùng bản thu nhỏ (nếu có).
+    
+    Args:
+        session: requests.Session với cookies (None = không tải lại, chỉ dùng bản thu nhỏ)
+        db_manager: DatabaseManager instance
+        thread: Thread cần render
+    
+    Returns:
+        Tuple (all_question_data, số ảnh đã tải lại, số ảnh không tải lại được)
+    """
+    all_question_data = []
+    restored = failed = 0
+    for item in db_manager.get_media_items_by_thread(thread.id):
+        comments = json.loads(item.comments_json) if item.comments_json else []
+        image_local_path = get_absolute_path(item.image_path)
+        
+        if item.image_path and (item.evicted_at or not os.path.exists(image_local_path)):
+            download = None
+            if session and item.image_url:
+                get_rate_limiter(session, key=get_host(thread.url)).wait()
+                try:
+                    headers = session.headers.copy()
+                    headers['Referer'] = thread.url
+                    download = download_file(session, item.image_url, image_local_path, headers=headers)
+                except Exception as e:
+                    print(f"    (!) Không tải lại được ảnh media ID {item.media_id}: {e}")
+            
+            if download:
+                preview_path = db_manager.save_manifest_entry(thread.id, item.media_id, {
+                    'file_path': item.image_path,
+                    'file_size': download['size'],
+                    'sha256': download['sha256'],
+                    'image_url': item.image_url,
+                    'title': item.title,
+                    'comments': comments,
+                    # Giữ số comments để lần cào lại vẫn bỏ qua được các trang comments không đổi
+                    'comment_count': item.comment_count
+                })
+                if preview_path:
+                    try:
+                        os.remove(get_absolute_path(preview_path))
+                    except OSError:
+                        pass
+                restored += 1
+            else:
+                failed += 1
+                image_local_path = get_absolute_path(item.preview_path)
+        
+        all_question_data.append({
+            'media_id': item.media_id,
+            'title': item.title,
+            'image_url': item.image_url,
+            'image_local_path': image_local_path,
+            'comments': comments,
+            'comment_count': item.comment_count
+        })
+    return all_question_data, restored, failed
@@ -0,0 +1,68 @@
+# library/storage.py
+
+import os
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+# Đuôi file được tính là ảnh đề thi
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp'}
+
+# Các cột thống kê dung lượng trong bảng threads
+STORAGE_STAT_FIELDS = ('file_count', 'image_count', 'image_bytes', 'pdf_bytes')
+
+def scan_thread_folder(folder_path: Optional[str]) -> Dict[str, int]:
+    """
+    Thống kê dung lượng thư mục của một thread bằng một lần os.scandir.
+    
+    Scraper lưu ảnh, comments.json và PDF phẳng trong thư mục thread nên không cần duyệt đệ quy.
+    
+    Args:
+        folder_path: Đường dẫn tuyệt đối của thư mục thread
+    
+    Returns:
+        Dict chứa 'file_count', 'image_count', 'image_bytes', 'pdf_bytes'
+        (toàn 0 nếu thư mục không tồn tại)
+    """
+    stats = dict.fromkeys(STORAGE_STAT_FIELDS, 0)
+    if not folder_path:
+        return stats
+    
+    try:
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                size = entry.stat(follow_symlinks=False).st_size
+                stats['file_count'] += 1
+                ext = os.path.splitext(entry.name)[1].lower()
+                if ext in IMAGE_EXTENSIONS:
+                    stats['image_count'] += 1
+                    stats['image_bytes'] += size
+                elif ext == '.pdf':
+                    stats['pdf_bytes'] += size
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return stats
+
+def scan_thread_folders(
+    folders: Iterable[Tuple[int, Optional[str]]],
+    jobs: int = 8
+) -> Iterator[Tuple[int, Dict[str, int]]]:
+    """
+    Quét song song thư mục của nhiều threads (I/O-bound nên dùng thread pool).
+    
+    Args:
+        folders: Iterable các tuple (thread_id, đường dẫn tuyệt đối của thư mục)
+        jobs: Số luồng quét đồng thời
+    
+    Yields:
+        Tuple (thread_id, stats) theo đúng thứ tự đầu vào
+    """
+    # Import tại chỗ: main.py import module này cho mọi lệnh, kể cả các lệnh không quét thư mục
+    from concurrent.futures import ThreadPoolExecutor
+    
+    def scan(item: Tuple[int, Optional[str]]) -> Tuple[int, Dict[str, int]]:
+        thread_id, folder_path = item
+        return thread_id, scan_thread_folder(folder_path)
+    
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='scandir') as executor:
+        yield from executor.map(scan, folders)
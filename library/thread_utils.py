@@ -2,7 +2,13 @@
 
 import re
 from urllib.parse import urlparse
-from typing import Dict
+from typing import Dict, Optional, Tuple
+
+# /threads/[slug].[id]/... hoặc /threads/[id]/... (slug có thể bị bỏ hoặc đổi tên)
+_THREAD_PATH = re.compile(r'/threads/(?:([^/]*)\.)?(\d+)(?:/|$)')
+
+# Base URL khi không suy ra được từ URL nào (URL không hợp lệ và config.FORUM_URL cũng vậy)
+DEFAULT_BASE_URL = 'https://fuoverflow.com'
 
 def extract_thread_info_from_url(url: str) -> Dict[str, str]:
     """
@@ -26,12 +32,12 @@ def extract_thread_info_from_url(url: str) -> Dict[str, str]:
     
     # Extract thread ID và slug từ path
     # Pattern: /threads/[slug].[id]/
-    match = re.search(r'/threads/([^/]+)\.(\d+)/?', parsed.path)
+    match = _THREAD_PATH.search(parsed.path)
     
     if match:
         slug = match.group(1)
         thread_id = match.group(2)
-        full_slug = f"{slug}.{thread_id}"
+        full_slug = f"{slug}.{thread_id}" if slug else thread_id
     else:
         # Fallback: nếu không match pattern, dùng path làm slug
         slug = parsed.path.strip('/').split('/')[-1]
@@ -45,9 +51,74 @@ def extract_thread_info_from_url(url: str) -> Dict[str, str]:
         'url': url
     }
 
+def _site_netloc(netloc: str) -> str:
+    """Host viết thường, bỏ tiền tố www. (www.fuoverflow.com và fuoverflow.com là cùng một site)."""
+    netloc = netloc.lower()
+    return netloc[4:] if netloc.startswith('www.') else netloc
+
+def get_base_url(url: Optional[str] = None) -> str:
+    """
+    Lấy base URL ({scheme}://{host}) của forum/thread, host không có tiền tố www.
+    
+    Ví dụ: https://www.fuoverflow.com/forums/csi106.123/ -> https://fuoverflow.com
+    
+    Args:
+        url: URL forum hoặc thread (None = config.FORUM_URL)
+    
+    Returns:
+        Base URL không có trailing slash (DEFAULT_BASE_URL nếu URL không hợp lệ)
+    """
+    if url is None:
+        import config
+        url = getattr(config, 'FORUM_URL', None) or ''
+    parsed = urlparse(url.strip())
+    if parsed.scheme in ('http', 'https') and parsed.netloc:
+        return f"{parsed.scheme}://{_site_netloc(parsed.netloc)}"
+    return DEFAULT_BASE_URL
+
+def get_host(url: Optional[str] = None) -> str:
+    """
+    Lấy host (viết thường) của forum/thread: khóa của thread ID và của rate limiter.
+    
+    Ví dụ: https://fuoverflow.com/forums/csi106.123/ -> fuoverflow.com
+    
+    Args:
+        url: URL forum hoặc thread (None = config.FORUM_URL)
+    
+    Returns:
+        Host (có port nếu URL có), theo cùng quy tắc với get_base_url
+    """
+    return get_base_url(url).split('://', 1)[1]
+
+def canonical_thread_key(url: str) -> Optional[Tuple[str, int]]:
+    """
+    Lấy khóa chuẩn của thread: (host, thread ID dạng số của XenForo).
+    
+    Mọi biến thể URL của cùng một thread (page-2, #post-123, ?query, http/https, www.,
+    slug đã đổi tên, /threads/5577/) đều cho cùng một khóa. Thread ID chỉ duy nhất
+    trong một forum nên host là một phần của khóa: thread 5577 của site khác là thread khác.
+    
+    Ví dụ: https://fuoverflow.com/threads/csi106-fa25-re.5577/page-2#post-9 -> ('fuoverflow.com', 5577)
+    
+    Args:
+        url: URL của thread
+    
+    Returns:
+        (host viết thường, thread ID), None nếu URL không phải URL thread
+    """
+    url = url.strip()
+    match = _THREAD_PATH.search(urlparse(url).path)
+    if not match:
+        return None
+    return get_host(url), int(match.group(2))
+
 def normalize_url(url: str) -> str:
     """
-    Chuẩn hóa URL (loại bỏ trailing slash, giữ lại query params nếu cần).
+    Chuẩn hóa URL.
+    
+    URL thread được đưa về dạng chuẩn {scheme}://{host}/threads/{slug}.{id}
+    (bỏ page-N, query, fragment; host viết thường, bỏ www.). URL khác (vd: URL forum)
+    chỉ được chuẩn hóa host như vậy và bỏ trailing slash.
     
     Args:
         url: URL cần chuẩn hóa
@@ -55,9 +126,36 @@ def normalize_url(url: str) -> str:
     Returns:
         URL đã được chuẩn hóa
     """
+    url = url.strip()
+    parsed = urlparse(url)
+    match = _THREAD_PATH.search(parsed.path)
+    if match and parsed.scheme and parsed.netloc:
+        slug = match.group(1)
+        thread_part = f"{slug}.{match.group(2)}" if slug else match.group(2)
+        return f"{parsed.scheme.lower()}://{_site_netloc(parsed.netloc)}/threads/{thread_part}"
+    if parsed.scheme.lower() in ('http', 'https') and parsed.netloc:
+        url = parsed._replace(netloc=_site_netloc(parsed.netloc)).geturl()
     # Loại bỏ trailing slash
-    url = url.rstrip('/')
-    # Giữ lại URL gốc, chỉ normalize trailing slash
-    return url
-
+    return url.rstrip('/')
 
+def extract_course_code(url: str, title: Optional[str] = None) -> Optional[str]:
+    """
+    Extract mã môn học từ slug của thread (fallback: tiêu đề).
+    
+    Ví dụ: https://fuoverflow.com/threads/csi106-fa25-re.5577/ -> 'CSI106'
+    
+    Args:
+        url: URL của thread
+        title: Tiêu đề thread (optional)
+    
+    Returns:
+        Mã môn học viết hoa, None nếu không nhận diện được
+    """
+    pattern = re.compile(r'(?<![A-Za-z0-9])([A-Za-z]{2,4}\d{3}[A-Za-z]?)(?![A-Za-z0-9])')
+    
+    slug = extract_thread_info_from_url(url)['slug'] or ''
+    for text in (slug.replace('-', ' '), title or ''):
+        match = pattern.search(text)
+        if match:
+            return match.group(1).upper()
+    return None
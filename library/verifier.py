@@ -0,0 +1,226 @@
+# library/verifier.py
+
+import os
+import time
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+from PIL import Image
+from database.models import DatabaseManager, ThreadStatus
+import config
+
+# Trạng thái của một file sau khi verify
+OK = 'ok'
+MISSING = 'missing'        # DB có tham chiếu nhưng file không còn trên đĩa
+TRUNCATED = 'truncated'    # File rỗng hoặc kích thước khác với lúc tải (manifest)
+CORRUPT = 'corrupt'        # Hash khác manifest, ảnh không decode được hoặc PDF hỏng
+
+# Block đọc file khi tính hash
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+def _scan_folder(folder_path: str) -> Dict[str, Tuple[int, int]]:
+    """Một lần os.scandir: tên file -> (size, mtime_ns)."""
+    files = {}
+    try:
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return files
+
+def scan_files(folders: Iterable[str], jobs: int = 8) -> Dict[str, Tuple[int, int]]:
+    """
+    Quét song song các thư mục, lấy size và mtime của mọi file.
+    
+    Args:
+        folders: Các thư mục tuyệt đối cần quét
+        jobs: Số luồng quét đồng thời
+    
+    Returns:
+        Dict đường dẫn tuyệt đối -> (size, mtime_ns)
+    """
+    folders = list(folders)
+    files = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='verify-scan') as executor:
+        for folder, entries in zip(folders, executor.map(_scan_folder, folders)):
+            for name, stat in entries.items():
+                files[os.path.join(folder, name)] = stat
+    return files
+
+def deep_check_file(path: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Kiểm tra sâu một file: tính SHA-256 và decode (ảnh bằng Pillow, PDF kiểm tra header/trailer).
+    Hàm top-level để chạy được trong process pool.
+    
+    Args:
+        path: Đường dẫn tuyệt đối
+    
+    Returns:
+        Tuple (sha256, lỗi) - lỗi là None nếu file decode được
+    """
+    sha256 = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+                sha256.update(block)
+    except OSError as e:
+        return None, f"Không đọc được file: {e}"
+    
+    digest = sha256.hexdigest()
+    try:
+        if path.lower().endswith('.pdf'):
+            with open(path, 'rb') as f:
+                header = f.read(5)
+                f.seek(max(0, os.path.getsize(path) - 1024))
+                trailer = f.read()
+            if header != b'%PDF-' or b'%%EOF' not in trailer:
+                return digest, "PDF thiếu header hoặc trailer (%%EOF)"
+        else:
+            # verify() kiểm tra cấu trúc/CRC, load() decode toàn bộ để bắt ảnh bị cắt cụt
+            with Image.open(path) as img:
+                img.verify()
+            with Image.open(path) as img:
+                img.load()
+    except Exception as e:
+        return digest, f"Không decode được: {e}"
+    return digest, None
+
+def verify_library(db_manager: DatabaseManager, deep: bool = False, jobs: int = 4) -> Dict:
+    """
+    Đối chiếu các file mà DB tham chiếu (ảnh của media items, PDF của threads) với ổ đĩa.
+    
+    Kết quả được lưu vào bảng file_checks; file có size + mtime không đổi so với lần
+    trước được bỏ qua (với --deep: chỉ bỏ qua nếu lần trước cũng đã kiểm tra sâu).
+    
+    Args:
+        db_manager: DatabaseManager instance
+        deep: True = tính hash và decode từng file trong process pool
+        jobs: Số luồng quét thư mục / số process kiểm tra sâu
+    
+    Returns:
+        Dict chứa 'total', 'checked', 'skipped', 'ok', 'elapsed' và 'broken'
+        (list các dict: thread_id, media_id, file_path, status, error_message)
+    """
+    start = time.perf_counter()
+    targets = db_manager.get_verify_targets()
+    previous = db_manager.get_file_checks()
+    
+    abs_paths = {
+        target['file_path']: os.path.join(os.path.abspath(config.SAVE_DIRECTORY), target['file_path'])
+        for target in targets
+    }
+    on_disk = scan_files({os.path.dirname(path) for path in abs_paths.values()}, jobs=jobs)
+    
+    results = {}
+    to_deep_check = []
+    skipped = 0
+    for target in targets:
+        file_path = target['file_path']
+        check = {
+            'file_path': file_path,
+            'thread_id': target['thread_id'],
+            'media_id': target['media_id'],
+            'file_size': None,
+            'mtime_ns': None,
+            'sha256': None,
+            'status': OK,
+            'error_message': None
+        }
+        results[file_path] = check
+        
+        stat = on_disk.get(abs_paths[file_path])
+        if stat is None:
+            check['status'] = MISSING
+            check['error_message'] = "File không tồn tại"
+            continue
+        check['file_size'], check['mtime_ns'] = stat
+        
+        # File không đổi kể từ lần verify trước -> dùng lại kết quả
+        old = previous.get(file_path)
+        if (old and old['file_size'] == check['file_size'] and old['mtime_ns'] == check['mtime_ns']
+                and (old['sha256'] or not deep)):
+            check.update(sha256=old['sha256'], status=old['status'], error_message=old['error_message'])
+            check['skipped'] = True
+            skipped += 1
+            continue
+        
+        if check['file_size'] == 0:
+            check['status'] = TRUNCATED
+            check['error_message'] = "File rỗng"
+        elif target['expected_size'] and check['file_size'] != target['expected_size']:
+            check['status'] = TRUNCATED
+            check['error_message'] = f"Kích thước {check['file_size']} bytes, lúc tải là {target['expected_size']} bytes"
+        elif deep:
+            to_deep_check.append(target)
+    
+    if to_deep_check:
+        paths = [abs_paths[target['file_path']] for target in to_deep_check]
+        if jobs > 1 and len(paths) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                outcomes = list(executor.map(deep_check_file, paths, chunksize=16))
+        else:
+            outcomes = [deep_check_file(path) for path in paths]
+        
+        for target, (digest, error) in zip(to_deep_check, outcomes):
+            check = results[target['file_path']]
+            check['sha256'] = digest
+            if error:
+                check['status'] = CORRUPT
+                check['error_message'] = error
+            elif target['sha256'] and digest != target['sha256']:
+                check['status'] = CORRUPT
+                check['error_message'] = "SHA-256 khác với lúc tải"
+    
+    db_manager.save_file_checks([check for check in results.values() if not check.get('skipped')])
+    
+    broken = [check for check in results.values() if check['status'] != OK]
+    return {
+        'total': len(results),
+        'checked': len(results) - skipped,
+        'skipped': skipped,
+        'ok': len(results) - len(broken),
+        'broken': broken,
+        'elapsed': time.perf_counter() - start
+    }
+
+def requeue_broken(db_manager: DatabaseManager, queue_manager, broken: List[Dict]) -> List[int]:
+    """
+    Đưa các threads có file hỏng trở lại queue: xóa manifest + file ảnh hỏng để worker
+    tải lại đúng những ảnh đó, PDF được render lại khi thread chạy xong.
+    
+    Args:
+        db_manager: DatabaseManager instance
+        queue_manager: QueueManager dùng để requeue
+        broken: List 'broken' từ verify_library
+    
+    Returns:
+        List ID các threads đã được đưa lại vào queue
+    """
+    by_thread = defaultdict(list)
+    for check in broken:
+        by_thread[check['thread_id']].append(check)
+    
+    requeued = []
+    for thread_id, checks in by_thread.items():
+        thread = queue_manager.library.get_thread_by_id(thread_id)
+        # Thread đang trong queue sẽ tự cào lại, không cần requeue
+        if not thread or thread.status in (ThreadStatus.PENDING, ThreadStatus.PROCESSING):
+            continue
+        
+        media_ids = [check['media_id'] for check in checks if check['media_id']]
+        if media_ids:
+            db_manager.delete_manifest_entries(thread_id, media_ids)
+        for check in checks:
+            if check['media_id'] and check['status'] != MISSING:
+                try:
+                    os.remove(os.path.join(config.SAVE_DIRECTORY, check['file_path']))
+                except OSError:
+                    pass
+        
+        queue_manager.requeue_thread(thread)
+        requeued.append(thread_id)
+    return requeued
@@ -4,27 +4,59 @@
 import argparse
 import sys
 import os
-import requests
-from typing import Optional
-from database.models import DatabaseManager, ThreadStatus
+import json
+import itertools
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from typing import Optional, TYPE_CHECKING
+from database.models import DatabaseManager, ThreadStatus, THREAD_COLUMNS
 from library.library_manager import LibraryManager
 from queue_system.queue_manager import QueueManager
-from queue_system.worker import QueueWorker
 from library.thread_utils import normalize_url
+from library.answer_utils import format_consensus
+from library.storage import scan_thread_folder, scan_thread_folders
+from scraper.paths import get_absolute_path, make_relative_path
+from scraper.profiling import PROFILE_MODES
 import config
 
-def setup_session() -> requests.Session:
-    """Thiết lập requests session với cookies"""
-    if not config.COOKIES:
+# Các module nặng (requests, bs4, fpdf, PIL...) chỉ được import trong lệnh cần đến chúng,
+# để các lệnh chỉ đọc DB (stats, list, show...) khởi động nhanh (xem benchmarks/check_startup.py)
+if TYPE_CHECKING:
+    import requests
+
+def setup_session(
+    record: Optional[str] = None,
+    replay: Optional[str] = None,
+    replay_latency: float = 1.0
+) -> "requests.Session":
+    """
+    Thiết lập requests session với cookies.
+    
+    Args:
+        record: Ghi mọi request/response của session vào file cassette này
+        replay: Trả response từ file cassette thay vì gọi forum (không cần cookie)
+        replay_latency: Hệ số độ trễ khi replay (1 = như lúc ghi, 0 = không chờ)
+    """
+    import requests
+    from scraper.cassette import install_cassette
+    
+    if not config.COOKIES and not replay:
         print("(!) Lỗi: Cookie chưa được cấu hình trong file 'config.py'.")
         sys.exit(1)
     
     session = requests.Session()
-    session.cookies.update(config.COOKIES)
+    session.cookies.update(config.COOKIES or {})
     session.headers.update({
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
     })
     
+    adapter = install_cassette(session, record=record, replay=replay, latency=replay_latency)
+    if replay:
+        print(f"[*] Replay từ cassette: {replay} ({len(adapter)} responses, độ trễ x{replay_latency:g})")
+    elif record:
+        print(f"[*] Đang ghi cassette: {record}")
+    
     return session
 
 def validate_url(url: str) -> bool:
@@ -56,22 +88,90 @@ def get_file_size(file_path: str) -> Optional[int]:
         pass
     return None
 
+# Các cột được xuất ra bởi `list --format jsonl|tsv` (theo thứ tự này)
+EXPORT_COLUMNS = (
+    'id', 'url', 'title', 'status', 'course', 'priority', 'total_questions',
+    'folder_path', 'pdf_path', 'created_at', 'completed_at', 'error_message'
+)
+
+def format_thread_record(row: tuple, fmt: str) -> str:
+    """
+    Chuyển một row thread (tuple theo THREAD_COLUMNS) thành một dòng JSONL hoặc TSV.
+    
+    Args:
+        row: Tuple từ LibraryManager.iter_threads(raw=True)
+        fmt: 'jsonl' hoặc 'tsv'
+    
+    Returns:
+        Một dòng (không có newline)
+    """
+    values = dict(zip(THREAD_COLUMNS, row))
+    if fmt == 'jsonl':
+        return json.dumps({name: values[name] for name in EXPORT_COLUMNS}, ensure_ascii=False)
+    # TSV: bỏ tab/xuống dòng trong giá trị, None -> rỗng
+    return '\t'.join(
+        '' if values[name] is None else ' '.join(str(values[name]).split())
+        for name in EXPORT_COLUMNS
+    )
+
 def main():
     parser = argparse.ArgumentParser(
         description='FuOverflow Exam Scraper - Library & Queue System v2.0'
     )
     
+    # Record/replay HTTP (dùng được với mọi command có gọi forum)
+    parser.add_argument('--record', metavar='CASSETTE',
+                        help='Ghi mọi request/response vào file cassette (vd: job.cassette.gz)')
+    parser.add_argument('--replay', metavar='CASSETTE',
+                        help='Dùng response trong file cassette thay vì gọi forum (chạy offline)')
+    parser.add_argument('--replay-latency', type=float, default=1.0,
+                        help='Hệ số độ trễ khi replay: 1 = như lúc ghi, 0 = không chờ')
+    
     subparsers = parser.add_subparsers(dest='command', help='Commands')
     
     # Command: add
     add_parser = subparsers.add_parser('add', help='Thêm URL vào queue')
     add_parser.add_argument('urls', nargs='+', help='URL(s) của thread(s) cần cào')
+    add_parser.add_argument('--priority', type=int,
+                           help='Độ ưu tiên trong queue (càng lớn càng được xử lý trước, mặc định: 0)')
+    add_parser.add_argument('--forum', type=int, metavar='FORUM_ID',
+                           help='Gán thread vào forum (xem `forum list`, mặc định: forum mặc định của site)')
+    
+    # Command: crawl
+    crawl_parser = subparsers.add_parser('crawl', help='Thêm các threads mới nhất của một forum vào queue (bỏ qua threads đã có)')
+    crawl_parser.add_argument('forum_url', nargs='?', help='URL của forum (mặc định: config.FORUM_URL)')
+    crawl_parser.add_argument('--limit', type=int,
+                              help='Số threads tối đa lấy từ trang đầu (mặc định: config.THREAD_LIMIT)')
+    crawl_parser.add_argument('--priority', type=int, default=0,
+                              help='Độ ưu tiên của các threads được thêm (mặc định: 0)')
+    crawl_parser.add_argument('--all', action='store_true',
+                              help='Crawl tất cả forums đã đăng ký bằng `forum add`')
+    
+    # Command: forum
+    forum_parser = subparsers.add_parser('forum', help='Quản lý các forums (mỗi forum có queue riêng, rate budget chung theo site)')
+    forum_subparsers = forum_parser.add_subparsers(dest='forum_action', required=True)
+    forum_add_parser = forum_subparsers.add_parser('add', help='Đăng ký một forum')
+    forum_add_parser.add_argument('url', help='URL của forum (vd: https://fuoverflow.com/forums/csi106.123/)')
+    forum_add_parser.add_argument('--title', help='Tên forum (mặc định: host của URL)')
+    forum_add_parser.add_argument('--interval', type=float,
+                                  help='Số giây tối thiểu giữa hai request tới site khi cào forum này (mặc định: config.DELAY_BETWEEN_REQUESTS)')
+    forum_subparsers.add_parser('list', help='Liệt kê forums và số threads theo status')
+    forum_set_parser = forum_subparsers.add_parser('set', help='Sửa tên / rate budget của forum')
+    forum_set_parser.add_argument('forum_id', type=int, help='ID của forum')
+    forum_set_parser.add_argument('--title', help='Tên mới')
+    forum_set_parser.add_argument('--interval', type=float,
+                                  help='Số giây tối thiểu giữa hai request (0 = dùng config.DELAY_BETWEEN_REQUESTS)')
     
     # Command: list
     list_parser = subparsers.add_parser('list', help='Liệt kê threads trong library')
-    list_parser.add_argument('--status', choices=['pending', 'processing', 'completed', 'failed'], 
+    list_parser.add_argument('--status', choices=['pending', 'processing', 'completed', 'partial', 'failed'], 
                             help='Lọc theo status')
     list_parser.add_argument('--limit', type=int, help='Giới hạn số lượng')
+    list_parser.add_argument('--course', help='Lọc theo mã môn học (vd: CSI106)')
+    list_parser.add_argument('--cursor', type=int,
+                            help='Phân trang theo ID: chỉ lấy threads có ID > cursor (sắp xếp theo ID)')
+    list_parser.add_argument('--format', choices=['table', 'jsonl', 'tsv'], default='table',
+                            help='Định dạng output (jsonl/tsv: stream toàn bộ library, dùng để pipe sang tool khác)')
     
     # Command: worker
     worker_parser = subparsers.add_parser('worker', help='Chạy worker để xử lý queue')
@@ -79,9 +179,26 @@ def main():
                               help='Dừng worker khi queue rỗng')
     worker_parser.add_argument('--interval', type=int, default=5,
                               help='Thời gian nghỉ giữa các lần check queue (giây)')
+    worker_parser.add_argument('--pipeline', action='store_true',
+                              help='Chạy song song các stage (fetch/download/render) giữa nhiều threads')
+    worker_parser.add_argument('--io-workers', type=int,
+                              help='Số luồng fetch/download khi chạy --pipeline')
+    worker_parser.add_argument('--render-workers', type=int,
+                              help='Số process render PDF khi chạy --pipeline')
+    worker_parser.add_argument('--metrics-port', type=int,
+                              help='Phục vụ metrics (Prometheus) tại http://<host>:<port>/metrics')
+    worker_parser.add_argument('--metrics-file',
+                              help='Ghi metrics (Prometheus text format) ra file này định kỳ')
+    worker_parser.add_argument('--profile', choices=PROFILE_MODES,
+                              help='Profile từng job: cpu (cProfile/sampling) hoặc mem (tracemalloc)')
+    worker_parser.add_argument('--profile-dir', help='Thư mục lưu kết quả profile (mặc định config.PROFILE_DIRECTORY)')
     
     # Command: stats
-    subparsers.add_parser('stats', help='Xem thống kê queue')
+    stats_parser = subparsers.add_parser('stats', help='Xem thống kê queue')
+    stats_parser.add_argument('--check', action='store_true',
+                             help='Kiểm tra bộ đếm queue có khớp với bảng threads không')
+    stats_parser.add_argument('--rebuild', action='store_true',
+                             help='Đếm lại bộ đếm queue từ bảng threads')
     
     # Command: show
     show_parser = subparsers.add_parser('show', help='Xem chi tiết một thread')
@@ -91,6 +208,72 @@ def main():
     retry_parser = subparsers.add_parser('retry', help='Retry các thread failed')
     retry_parser.add_argument('--all', action='store_true', help='Retry tất cả failed threads')
     retry_parser.add_argument('--id', type=int, help='Retry thread với ID cụ thể')
+    retry_parser.add_argument('--items', action='store_true',
+                              help='Chỉ cào lại các media items lỗi của thread partial (kết hợp với --id)')
+    retry_parser.add_argument('--delay', type=int, default=0,
+                              help='Chỉ xử lý lại sau N giây (mặc định: ngay lập tức)')
+    
+    # Command: search
+    search_parser = subparsers.add_parser('search', help='Tìm câu hỏi theo nội dung title/comments')
+    search_parser.add_argument('query', help='Từ khóa cần tìm (vd: "subnet mask")')
+    search_parser.add_argument('--course', help='Chỉ tìm trong một môn học (vd: CSI106)')
+    search_parser.add_argument('--limit', type=int, default=20, help='Số kết quả tối đa')
+    
+    # Command: reindex
+    subparsers.add_parser('reindex', help='Xây lại search index và bảng comments/đáp án từ các media items đã lưu')
+    
+    # Command: answers
+    answers_parser = subparsers.add_parser('answers', help='Xem đáp án tổng hợp từ comments của một thread')
+    answers_parser.add_argument('--id', type=int, required=True, help='ID của thread')
+    answers_parser.add_argument('--min-agreement', type=float, default=0.6,
+                               help='Đánh dấu các câu có tỉ lệ đồng thuận thấp hơn ngưỡng này (0-1)')
+    
+    # Command: du
+    du_parser = subparsers.add_parser('du', help='Xem dung lượng library (từ thống kê đã lưu trong DB)')
+    du_parser.add_argument('--by-course', action='store_true', help='Nhóm dung lượng theo môn học')
+    du_parser.add_argument('--top', type=int, metavar='N', help='Liệt kê N threads chiếm nhiều dung lượng nhất')
+    du_parser.add_argument('--rescan', action='store_true',
+                          help='Quét lại thư mục của mọi thread để cập nhật thống kê')
+    du_parser.add_argument('--jobs', type=int, default=8, help='Số luồng quét khi --rescan')
+    
+    # Command: verify
+    verify_parser = subparsers.add_parser('verify', help='Kiểm tra ảnh/PDF trong library còn đủ và không hỏng')
+    verify_parser.add_argument('--deep', action='store_true',
+                              help='Tính hash và decode từng file (chậm hơn, chạy trong process pool)')
+    verify_parser.add_argument('--jobs', type=int, default=os.cpu_count() or 4,
+                              help='Số luồng quét / số process kiểm tra sâu')
+    verify_parser.add_argument('--no-requeue', action='store_true',
+                              help='Chỉ báo cáo, không đưa các thread có file hỏng lại vào queue')
+    
+    # Command: render
+    render_parser = subparsers.add_parser('render', help='Render lại PDF của thread từ DB (tải lại ảnh đã bị evict)')
+    render_parser.add_argument('thread_id', type=int, help='ID của thread')
+    render_parser.add_argument('--profile', choices=PROFILE_MODES,
+                              help='Profile bước render PDF: cpu (cProfile/sampling) hoặc mem (tracemalloc)')
+    render_parser.add_argument('--profile-dir', help='Thư mục lưu kết quả profile (mặc định config.PROFILE_DIRECTORY)')
+    
+    # Command: refresh
+    refresh_parser = subparsers.add_parser('refresh', help='Cào lại một thread đã hoàn thành (cập nhật comments, tải lại ảnh đã bị evict)')
+    refresh_parser.add_argument('thread_id', type=int, help='ID của thread')
+    
+    # Command: watch
+    watch_parser = subparsers.add_parser('watch', help='Tự động đưa các threads đã cào xong vào lại queue theo lịch thích ứng (chạy cùng worker)')
+    watch_parser.add_argument('--budget', type=int,
+                              help='Số request tối đa mỗi giờ cho việc kiểm tra lại (mặc định config.WATCH_REQUESTS_PER_HOUR)')
+    watch_parser.add_argument('--once', action='store_true', help='Quét lịch một lần rồi thoát (vd: chạy bằng cron mỗi giờ)')
+    watch_parser.add_argument('--dry-run', action='store_true', help='Chỉ liệt kê các threads đến hạn, không đưa vào queue')
+    
+    # Command: evict
+    evict_parser = subparsers.add_parser('evict', help='Xóa ảnh gốc của các threads ít dùng nhất để nằm trong giới hạn dung lượng')
+    evict_parser.add_argument('--budget-gb', type=float, help='Giới hạn dung lượng (GB), mặc định config.STORAGE_BUDGET_GB')
+    evict_parser.add_argument('--keep-previews', action='store_true', default=None,
+                             help='Giữ bản thu nhỏ của ảnh (mặc định config.STORAGE_KEEP_PREVIEWS)')
+    evict_parser.add_argument('--dry-run', action='store_true', help='Chỉ liệt kê các threads sẽ bị evict')
+    
+    # Command: perf
+    perf_parser = subparsers.add_parser('perf', help='Xem thời gian từng stage của worker (p50/p95/p99) và threads chậm nhất')
+    perf_parser.add_argument('--since', default='1d', help='Khoảng thời gian gần đây (vd: 30m, 12h, 1d, 2w)')
+    perf_parser.add_argument('--top', type=int, default=10, help='Số threads chậm nhất cần liệt kê')
     
     args = parser.parse_args()
     
@@ -100,13 +283,19 @@ def main():
     
     # Khởi tạo DB và managers
     db_manager = DatabaseManager()
+    if db_manager.merged_thread_ids:
+        print(f"[*] Đã gộp {len(db_manager.merged_thread_ids)} thread trùng (cùng host + thread ID, khác URL): "
+              f"{db_manager.merged_thread_ids}")
     library_manager = LibraryManager(db_manager)
     queue_manager = QueueManager(db_manager)
     
     # Command: add
     if args.command == 'add':
-        session = setup_session()
+        if args.forum is not None and library_manager.get_forum(args.forum) is None:
+            print(f"✗ Không tìm thấy forum ID {args.forum} (xem: python main.py forum list)")
+            return
         
+        # Chỉ ghi DB (không cần session / cookie): thread đã có được phát hiện trước mọi truy cập mạng
         added_count = 0
         skipped_count = 0
         
@@ -130,45 +319,196 @@ def main():
                     else:
                         print(f"✓ Đã có trong library (status: {existing.status.value}): {existing.title}")
                         print(f"  URL: {existing.url}")
+                        if existing.status == ThreadStatus.PENDING and args.priority is not None \
+                                and args.priority != existing.priority:
+                            existing.priority = args.priority
+                            library_manager.update_thread(existing)
+                            print(f"  Priority: {existing.priority} (đã cập nhật)")
                     skipped_count += 1
                 else:
                     # Thêm mới
-                    thread = library_manager.add_thread(url)
+                    thread = library_manager.add_thread(url, priority=args.priority or 0, forum_id=args.forum)
                     print(f"✓ Đã thêm vào queue: {thread.title}")
                     print(f"  URL: {thread.url}")
                     print(f"  Status: {thread.status.value}")
+                    if thread.priority:
+                        print(f"  Priority: {thread.priority}")
                     added_count += 1
             except Exception as e:
                 print(f"✗ Lỗi khi thêm URL {url}: {e}")
         
         print(f"\n--- Tóm tắt: Đã thêm {added_count}, Bỏ qua {skipped_count} ---")
     
+    # Command: crawl
+    elif args.command == 'crawl':
+        from scraper.scraper import get_latest_thread_info
+        
+        if args.all:
+            # Forum mặc định của site (url = base URL) không có trang danh sách threads
+            forums = [forum for forum in library_manager.get_forums() if forum.url != forum.base_url]
+            if not forums:
+                print("Chưa có forum nào. Thêm bằng: python main.py forum add <forum_url>")
+                return
+        else:
+            forums = [library_manager.get_or_create_forum(args.forum_url or config.FORUM_URL)]
+        
+        session = setup_session(args.record, args.replay, args.replay_latency)
+        limit = args.limit or getattr(config, 'THREAD_LIMIT', 10)
+        
+        # Chỉ tải trang danh sách của forum; thread đã có (so theo thread ID, không phân biệt
+        # biến thể URL) bị bỏ qua mà không truy cập trang thread
+        added_count = 0
+        skipped_count = 0
+        for forum in forums:
+            if len(forums) > 1:
+                print(f"\n[{forum.id}] {forum.title} ({forum.url})")
+            for info in get_latest_thread_info(session, limit=limit, forum_url=forum.url):
+                existing = library_manager.check_thread_exists(info['url'])
+                if existing:
+                    print(f"  - Đã có (status: {existing.status.value}): {existing.title}")
+                    skipped_count += 1
+                    continue
+                thread = library_manager.add_thread(
+                    info['url'], title=info['title'], priority=args.priority, forum_id=forum.id
+                )
+                print(f"  + Đã thêm vào queue: {thread.title}")
+                print(f"    URL: {thread.url}")
+                added_count += 1
+        
+        print(f"\n--- Tóm tắt: Đã thêm {added_count}, Bỏ qua {skipped_count} ---")
+    
+    # Command: forum
+    elif args.command == 'forum':
+        if args.forum_action == 'add':
+            if not validate_url(args.url):
+                print(f"✗ URL không hợp lệ: {args.url}")
+                return
+            forum = library_manager.get_or_create_forum(args.url, title=args.title)
+            if args.interval is not None:
+                forum.min_interval = args.interval or None
+                library_manager.update_forum(forum)
+            print(f"✓ Forum [{forum.id}] {forum.title}")
+            print(f"  URL: {forum.url}")
+            print("  Crawl bằng: python main.py crawl --all")
+        
+        elif args.forum_action == 'set':
+            forum = library_manager.get_forum(args.forum_id)
+            if not forum:
+                print(f"Không tìm thấy forum ID {args.forum_id}")
+                return
+            if args.title:
+                forum.title = args.title
+            if args.interval is not None:
+                forum.min_interval = args.interval or None
+            library_manager.update_forum(forum)
+            print(f"✓ Đã cập nhật forum [{forum.id}] {forum.title}")
+        
+        else:
+            forums = library_manager.get_forums()
+            if not forums:
+                print("Chưa có forum nào.")
+                return
+            queue_stats = library_manager.get_forum_queue_stats()
+            default_interval = getattr(config, 'DELAY_BETWEEN_REQUESTS', 1)
+            print(f"\n{'ID':<5} {'Pending':>8} {'Proc.':>6} {'Done':>6} {'Failed':>7} {'Interval':>9}  {'Last claimed':<20} Forum")
+            print("-" * 100)
+            for forum in forums:
+                counts = queue_stats.get(forum.id, {})
+                interval = forum.min_interval if forum.min_interval is not None else default_interval
+                last_claimed = (datetime.fromtimestamp(forum.last_claimed_at).strftime('%Y-%m-%d %H:%M:%S')
+                                if forum.last_claimed_at else '-')
+                done = counts.get(ThreadStatus.COMPLETED.value, 0) + counts.get(ThreadStatus.PARTIAL.value, 0)
+                print(f"{forum.id:<5} {counts.get(ThreadStatus.PENDING.value, 0):>8} "
+                      f"{counts.get(ThreadStatus.PROCESSING.value, 0):>6} {done:>6} "
+                      f"{counts.get(ThreadStatus.FAILED.value, 0):>7} {interval:>8g}s  {last_claimed:<20} "
+                      f"{forum.title} ({forum.url})")
+    
     # Command: list
     elif args.command == 'list':
         status = ThreadStatus(args.status) if args.status else None
-        threads = library_manager.get_all_threads(status=status, limit=args.limit)
         
-        if not threads:
-            print("Không có thread nào trong library.")
-            return
+        # Keyset pagination theo ID: đọc từng batch, không load cả library vào bộ nhớ.
+        # Export (jsonl/tsv) dùng tuple thô, không tạo Thread object cho từng row
+        if args.format == 'table' and args.cursor is None and not args.course:
+            # Mặc định: threads mới thêm trước
+            threads = library_manager.iter_threads(status=status, newest_first=True)
+        else:
+            threads = library_manager.iter_threads(
+                after_id=args.cursor or 0, status=status, course=args.course,
+                raw=args.format != 'table'
+            )
+        if args.limit:
+            threads = itertools.islice(threads, args.limit)
         
-        print(f"\n{'ID':<6} {'Status':<12} {'Title':<50} {'Created At'}")
-        print("-" * 100)
+        if args.format != 'table':
+            try:
+                last_id = None
+                for row in threads:
+                    sys.stdout.write(format_thread_record(row, args.format) + '\n')
+                    last_id = row[0]
+                if args.limit and last_id is not None:
+                    # Cursor cho trang tiếp theo (stderr để không lẫn vào dữ liệu)
+                    print(f"next cursor: {last_id}", file=sys.stderr)
+            except BrokenPipeError:
+                # Tool phía sau (vd: head) đóng pipe sớm
+                sys.stderr.close()
+            return
         
+        printed = 0
+        last_id = None
         for thread in threads:
+            if printed == 0:
+                print(f"\n{'ID':<6} {'Status':<12} {'Title':<50} {'Created At'}")
+                print("-" * 100)
             created = thread.created_at.strftime('%Y-%m-%d %H:%M') if thread.created_at else 'N/A'
             title = thread.title[:47] + '...' if len(thread.title) > 50 else thread.title
             print(f"{thread.id:<6} {thread.status.value:<12} {title:<50} {created}")
+            printed += 1
+            last_id = thread.id
+        
+        if printed == 0:
+            print("Không có thread nào trong library.")
+        elif args.cursor is not None and args.limit and printed == args.limit:
+            print(f"\nTrang tiếp theo: python main.py list --cursor {last_id} --limit {args.limit}")
     
     # Command: worker
     elif args.command == 'worker':
-        session = setup_session()
+        from queue_system.worker import QueueWorker
+        from scraper.profiling import JobProfiler
+        
+        session = setup_session(args.record, args.replay, args.replay_latency)
         worker = QueueWorker(db_manager, session)
         worker.sleep_interval = args.interval
-        worker.run_loop(stop_on_empty=args.stop_on_empty)
+        if args.metrics_port is not None or args.metrics_file:
+            worker.enable_metrics(port=args.metrics_port, file_path=args.metrics_file)
+        if args.profile:
+            worker.profiler = JobProfiler(args.profile, args.profile_dir)
+        if args.pipeline:
+            worker.run_pipeline(
+                stop_on_empty=args.stop_on_empty,
+                io_workers=args.io_workers,
+                render_workers=args.render_workers
+            )
+        else:
+            worker.run_loop(stop_on_empty=args.stop_on_empty)
     
     # Command: stats
     elif args.command == 'stats':
+        if args.check:
+            mismatches = queue_manager.check_queue_counters()
+            if not mismatches:
+                print("✓ Bộ đếm queue khớp với bảng threads.")
+            else:
+                print("✗ Bộ đếm queue bị lệch:")
+                for status, (counter, actual) in sorted(mismatches.items()):
+                    print(f"  - {status}: counter = {counter}, thực tế = {actual}")
+                print("    Sửa bằng: python main.py stats --rebuild")
+            return
+        
+        if args.rebuild:
+            db_manager.rebuild_queue_counters()
+            print("✓ Đã đếm lại bộ đếm queue từ bảng threads.")
+        
         stats = queue_manager.get_queue_stats()
         total = sum(stats.values())
         
@@ -177,6 +517,7 @@ def main():
         print(f"  - Pending:    {stats['pending']}")
         print(f"  - Processing: {stats['processing']}")
         print(f"  - Completed:  {stats['completed']}")
+        print(f"  - Partial:    {stats['partial']}")
         print(f"  - Failed:     {stats['failed']}")
         print("=" * 25)
     
@@ -186,6 +527,7 @@ def main():
         if not thread:
             print(f"✗ Không tìm thấy thread với ID: {args.thread_id}")
             return
+        library_manager.touch_thread(thread.id)
         
         print(f"\n{'='*60}")
         print(f"Thread ID: {thread.id}")
@@ -193,6 +535,9 @@ def main():
         print(f"Title: {thread.title}")
         print(f"URL: {thread.url}")
         print(f"Status: {thread.status.value}")
+        forum = library_manager.get_forum(thread.forum_id) if thread.forum_id is not None else None
+        if forum:
+            print(f"Forum: [{forum.id}] {forum.title}")
         
         if thread.created_at:
             print(f"Created: {thread.created_at.strftime('%Y-%m-%d %H:%M:%S')}")
@@ -200,16 +545,31 @@ def main():
             print(f"Updated: {thread.updated_at.strftime('%Y-%m-%d %H:%M:%S')}")
         if thread.completed_at:
             print(f"Completed: {thread.completed_at.strftime('%Y-%m-%d %H:%M:%S')}")
+        if thread.priority:
+            print(f"Priority: {thread.priority}")
+        if thread.status == ThreadStatus.PENDING and thread.not_before > time.time():
+            scheduled = datetime.fromtimestamp(thread.not_before).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"Scheduled: {scheduled}")
+        if thread.retry_count:
+            print(f"Auto retries: {thread.retry_count}")
+        if thread.last_checked_at:
+            checked = datetime.fromtimestamp(thread.last_checked_at).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"Last checked: {checked} (change score {thread.change_score:.3f})")
         
         if thread.folder_path:
             print(f"\nFolder: {thread.folder_path}")
-            abs_folder = os.path.join(config.SAVE_DIRECTORY, thread.folder_path)
-            if os.path.exists(abs_folder):
-                file_count = len([f for f in os.listdir(abs_folder) if os.path.isfile(os.path.join(abs_folder, f))])
-                print(f"  Files: {file_count}")
+            if thread.stats_updated_at:
+                print(f"  Files: {thread.file_count} ({thread.image_count} ảnh, "
+                      f"{format_file_size(thread.image_bytes)})")
+            else:
+                # Thread cũ chưa có thống kê -> đếm trực tiếp trên ổ đĩa
+                abs_folder = os.path.join(config.SAVE_DIRECTORY, thread.folder_path)
+                if os.path.exists(abs_folder):
+                    file_count = len([f for f in os.listdir(abs_folder) if os.path.isfile(os.path.join(abs_folder, f))])
+                    print(f"  Files: {file_count}")
         
         if thread.pdf_path:
-            pdf_size = get_file_size(thread.pdf_path)
+            pdf_size = thread.pdf_bytes if thread.stats_updated_at else get_file_size(thread.pdf_path)
             size_str = f" ({format_file_size(pdf_size)})" if pdf_size else ""
             print(f"PDF: {thread.pdf_path}{size_str}")
         
@@ -223,12 +583,56 @@ def main():
         media_items = db_manager.get_media_items_by_thread(thread.id)
         if media_items:
             print(f"\nMedia Items: {len(media_items)}")
+            evicted = [item for item in media_items if item.evicted_at]
+            if evicted:
+                previews = sum(1 for item in evicted if item.preview_path)
+                print(f"  Ảnh gốc đã evict: {len(evicted)} (còn bản thu nhỏ: {previews}), "
+                      f"tải lại bằng: python main.py render {thread.id}")
+        
+        failed_items = db_manager.get_failed_items(thread.id)
+        if failed_items:
+            print(f"\nFailed Items: {len(failed_items)}")
+            for item in failed_items.values():
+                print(f"  - {item['media_id']} [{item['error_kind']}, {item['attempts']} lần thử]: {item['error_message']}")
         
         print(f"{'='*60}\n")
     
     # Command: retry
     elif args.command == 'retry':
-        if args.all:
+        if args.items:
+            # Retry các media items lỗi (threads partial): manifest giữ lại các item đã tải,
+            # nên worker chỉ gọi API/tải ảnh cho các item còn thiếu
+            if args.id:
+                thread = library_manager.get_thread_by_id(args.id)
+                if not thread:
+                    print(f"✗ Không tìm thấy thread với ID: {args.id}")
+                    return
+                threads = [thread]
+            else:
+                threads = library_manager.get_all_threads(status=ThreadStatus.PARTIAL)
+            
+            if not threads:
+                print("Không có thread nào ở trạng thái 'partial'.")
+                return
+            
+            retry_count = 0
+            for thread in threads:
+                if thread.status in (ThreadStatus.PENDING, ThreadStatus.PROCESSING):
+                    print(f"✗ Thread ID {thread.id} đang ở trạng thái '{thread.status.value}', bỏ qua.")
+                    continue
+                
+                # Xóa danh sách lỗi để cả các item lỗi permanent cũng được thử lại
+                item_count = db_manager.clear_failed_items(thread.id)
+                queue_manager.requeue_thread(thread, delay=args.delay)
+                print(f"✓ Đã reset thread ID {thread.id} ({item_count} media items lỗi): {thread.title}")
+                retry_count += 1
+            
+            print(f"\n--- Đã reset {retry_count} thread(s) về pending ---")
+            if args.delay:
+                print(f"Các thread sẽ được xử lý sau {args.delay}s")
+            print("Chạy worker để xử lý lại: python main.py worker")
+        
+        elif args.all:
             # Retry all failed threads
             failed_threads = library_manager.get_all_threads(status=ThreadStatus.FAILED)
             if not failed_threads:
@@ -238,13 +642,13 @@ def main():
             print(f"\nTìm thấy {len(failed_threads)} failed thread(s).")
             retry_count = 0
             for thread in failed_threads:
-                thread.status = ThreadStatus.PENDING
-                thread.error_message = None
-                library_manager.update_thread(thread)
+                queue_manager.requeue_thread(thread, delay=args.delay)
                 print(f"✓ Đã reset thread ID {thread.id}: {thread.title}")
                 retry_count += 1
             
             print(f"\n--- Đã reset {retry_count} thread(s) về pending ---")
+            if args.delay:
+                print(f"Các thread sẽ được xử lý sau {args.delay}s")
             print("Chạy worker để xử lý lại: python main.py worker")
         
         elif args.id:
@@ -256,18 +660,310 @@ def main():
             
             if thread.status != ThreadStatus.FAILED:
                 print(f"✗ Thread ID {args.id} không ở trạng thái 'failed'. Status hiện tại: {thread.status.value}")
+                if thread.status == ThreadStatus.PARTIAL:
+                    print(f"    Dùng: python main.py retry --items --id {args.id}")
                 return
             
-            thread.status = ThreadStatus.PENDING
-            thread.error_message = None
-            library_manager.update_thread(thread)
+            queue_manager.requeue_thread(thread, delay=args.delay)
             print(f"✓ Đã reset thread ID {args.id} về pending: {thread.title}")
             print("Chạy worker để xử lý lại: python main.py worker")
         
         else:
-            print("(!) Cần chỉ định --all hoặc --id <thread_id>")
+            print("(!) Cần chỉ định --all, --id <thread_id> hoặc --items")
             print("    Ví dụ: python main.py retry --all")
             print("    Ví dụ: python main.py retry --id 1")
+            print("    Ví dụ: python main.py retry --items --id 1")
+    
+    # Command: search
+    elif args.command == 'search':
+        start = time.perf_counter()
+        try:
+            results = library_manager.search_media(args.query, course=args.course, limit=args.limit)
+        except RuntimeError as e:
+            print(f"✗ {e}")
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        
+        if not results:
+            print(f"Không tìm thấy kết quả nào cho: {args.query}")
+            if library_manager.is_search_index_empty():
+                print("    (!) Search index đang trống, chạy: python main.py reindex")
+            return
+        
+        print(f"\n=== {len(results)} kết quả cho \"{args.query}\" ({elapsed_ms:.1f} ms) ===\n")
+        for i, hit in enumerate(results, 1):
+            print(f"{i}. [Thread {hit['thread_id']}] {hit['thread_title']} - Câu {hit['question_order']}")
+            if hit['image_path']:
+                print(f"   Ảnh: {get_absolute_path(hit['image_path'])}")
+            if hit['snippet']:
+                print(f"   {' '.join(hit['snippet'].split())}")
+            print()
+    
+    # Command: reindex
+    elif args.command == 'reindex':
+        start = time.perf_counter()
+        comment_count = db_manager.rebuild_comments()
+        print(f"✓ Đã tách {comment_count} comments và tính lại đáp án tổng hợp")
+        try:
+            count = db_manager.rebuild_search_index()
+            print(f"✓ Đã index {count} media items")
+        except RuntimeError as e:
+            print(f"✗ {e}")
+        print(f"({time.perf_counter() - start:.2f}s)")
+    
+    # Command: answers
+    elif args.command == 'answers':
+        thread = library_manager.get_thread_by_id(args.id)
+        if not thread:
+            print(f"✗ Không tìm thấy thread với ID: {args.id}")
+            return
+        library_manager.touch_thread(thread.id)
+        
+        media_items = db_manager.get_media_items_by_thread(thread.id)
+        if not media_items:
+            print(f"Thread ID {thread.id} chưa có media item nào (status: {thread.status.value}).")
+            return
+        
+        consensus = db_manager.get_answer_consensus(thread.id)
+        
+        print(f"\n{'='*60}")
+        print(f"Đáp án tổng hợp - Thread ID {thread.id}: {thread.title}")
+        print(f"{'='*60}")
+        low_agreement = 0
+        for item in media_items:
+            summary = consensus.get(item.media_id)
+            flag = ''
+            if summary and summary['agreement'] < args.min_agreement:
+                flag = '  (!)'
+                low_agreement += 1
+            print(f"Câu {item.question_order:>3} [{item.media_id}]: {format_consensus(summary)}{flag}")
+        
+        print(f"{'-'*60}")
+        print(f"{len(consensus)}/{len(media_items)} câu có đáp án từ comments, "
+              f"{low_agreement} câu có độ đồng thuận < {args.min_agreement:.0%}")
+        print(f"{'='*60}\n")
+    
+    # Command: du
+    elif args.command == 'du':
+        if args.rescan:
+            start = time.perf_counter()
+            folders = [
+                (row[0], get_absolute_path(row[4]))
+                for row in library_manager.iter_threads(raw=True)
+                if row[4]
+            ]
+            updated = library_manager.save_storage_stats(scan_thread_folders(folders, jobs=args.jobs))
+            print(f"✓ Đã quét lại {updated} threads ({time.perf_counter() - start:.2f}s)\n")
+        
+        start = time.perf_counter()
+        summary = library_manager.get_storage_summary(by_course=args.by_course)
+        largest = library_manager.get_largest_threads(args.top) if args.top else []
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        
+        print(f"\n=== Dung lượng library ===")
+        if args.by_course:
+            print(f"{'Môn':<10} {'Threads':>8} {'Ảnh':>8} {'Ảnh (size)':>12} {'PDF (size)':>12} {'Tổng':>12}")
+            for row in summary:
+                print(f"{row['course'] or '-':<10} {row['threads']:>8} {row['images']:>8} "
+                      f"{format_file_size(row['image_bytes']):>12} {format_file_size(row['pdf_bytes']):>12} "
+                      f"{format_file_size(row['image_bytes'] + row['pdf_bytes']):>12}")
+        
+        threads = sum(row['threads'] for row in summary)
+        scanned = sum(row['scanned'] for row in summary)
+        image_bytes = sum(row['image_bytes'] for row in summary)
+        pdf_bytes = sum(row['pdf_bytes'] for row in summary)
+        if args.by_course:
+            print("-" * 67)
+        print(f"Threads có thư mục: {threads} (đã có thống kê: {scanned})")
+        print(f"Files: {sum(row['files'] for row in summary)}, ảnh: {sum(row['images'] for row in summary)}")
+        print(f"Ảnh: {format_file_size(image_bytes)}, PDF: {format_file_size(pdf_bytes)}, "
+              f"tổng: {format_file_size(image_bytes + pdf_bytes)}")
+        if scanned < threads:
+            print(f"(!) {threads - scanned} threads chưa có thống kê. Cập nhật bằng: python main.py du --rescan")
+        
+        if largest:
+            print(f"\nTop {len(largest)} threads lớn nhất:")
+            for row in largest:
+                print(f"  [{row['id']}] {format_file_size(row['total_bytes']):>10}  "
+                      f"{row['image_count']} ảnh  {row['title']}")
+        
+        print(f"({elapsed_ms:.1f} ms)")
+    
+    # Command: verify
+    elif args.command == 'verify':
+        from library.verifier import verify_library, requeue_broken
+        
+        mode = "kiểm tra sâu (hash + decode)" if args.deep else "đối chiếu DB với ổ đĩa"
+        print(f"[*] Verify library: {mode}, {args.jobs} jobs...")
+        report = verify_library(db_manager, deep=args.deep, jobs=args.jobs)
+        
+        print(f"\n=== Kết quả verify ===")
+        print(f"Files: {report['total']} (kiểm tra: {report['checked']}, "
+              f"bỏ qua vì không đổi: {report['skipped']})")
+        print(f"  - OK:   {report['ok']}")
+        print(f"  - Hỏng: {len(report['broken'])}")
+        for check in report['broken'][:50]:
+            print(f"    [{check['thread_id']}] {check['file_path']} - {check['status']}: {check['error_message']}")
+        if len(report['broken']) > 50:
+            print(f"    ... và {len(report['broken']) - 50} file khác")
+        print(f"({report['elapsed']:.2f}s)")
+        
+        if report['broken']:
+            if args.no_requeue:
+                print("\nBỏ qua requeue (--no-requeue).")
+            else:
+                requeued = requeue_broken(db_manager, queue_manager, report['broken'])
+                print(f"\n✓ Đã đưa {len(requeued)} thread(s) lại vào queue để tải lại file hỏng")
+                if requeued:
+                    print("Chạy worker để xử lý lại: python main.py worker")
+    
+    # Command: render
+    elif args.command == 'render':
+        from library.retention import load_question_data
+        from scraper.scraper import render_thread_pdf
+        from scraper.profiling import JobProfiler
+        
+        thread = library_manager.get_thread_by_id(args.thread_id)
+        if not thread:
+            print(f"✗ Không tìm thấy thread với ID: {args.thread_id}")
+            return
+        if not thread.folder_path:
+            print(f"✗ Thread ID {thread.id} chưa được cào (status: {thread.status.value})")
+            return
+        
+        session = setup_session(args.record, args.replay, args.replay_latency)
+        all_question_data, restored, failed = load_question_data(session, db_manager, thread)
+        if restored or failed:
+            print(f"[*] Đã tải lại {restored} ảnh bị evict ({failed} ảnh không tải lại được)")
+        
+        folder_name = os.path.basename(thread.folder_path.rstrip('/'))
+        consensus = db_manager.get_answer_consensus(thread.id)
+        profiling = JobProfiler(args.profile, args.profile_dir).profile(thread.id, 'render') if args.profile else nullcontext()
+        with profiling:
+            pdf_path = render_thread_pdf(
+                all_question_data, get_absolute_path(thread.folder_path), folder_name,
+                thread.title, session, consensus
+            )
+        if pdf_path:
+            thread.pdf_path = make_relative_path(pdf_path)
+            library_manager.update_thread(thread)
+        
+        stats = scan_thread_folder(get_absolute_path(thread.folder_path))
+        library_manager.save_storage_stats([(thread.id, stats)])
+        library_manager.touch_thread(thread.id)
+    
+    # Command: refresh
+    elif args.command == 'refresh':
+        thread = library_manager.get_thread_by_id(args.thread_id)
+        if not thread:
+            print(f"✗ Không tìm thấy thread với ID: {args.thread_id}")
+            return
+        if thread.status in (ThreadStatus.PENDING, ThreadStatus.PROCESSING):
+            print(f"✗ Thread ID {thread.id} đang ở trạng thái '{thread.status.value}', đã nằm trong queue.")
+            return
+        
+        # Manifest vẫn giữ các ảnh còn trên đĩa, worker chỉ tải lại những ảnh đã bị evict/mất
+        queue_manager.requeue_thread(thread)
+        library_manager.touch_thread(thread.id)
+        print(f"✓ Đã đưa thread ID {thread.id} vào queue để cào lại: {thread.title}")
+        print("Chạy worker để xử lý: python main.py worker")
+    
+    # Command: watch
+    elif args.command == 'watch':
+        from queue_system.watch import WatchScheduler
+        
+        scheduler = WatchScheduler(db_manager, requests_per_hour=args.budget)
+        if not (args.once or args.dry_run):
+            scheduler.run()
+            return
+        
+        report = scheduler.run_once(dry_run=args.dry_run)
+        action = "Sẽ đưa" if args.dry_run else "Đã đưa"
+        print(f"\n{action} {len(report['enqueued'])} thread vào queue "
+              f"({report['deferred']} thread đến hạn chờ budget, còn {report['budget_left']} requests):")
+        for item in report['enqueued']:
+            overdue = f", quá hạn {item['overdue'] / 3600:.1f}h" if item['overdue'] is not None else ", chưa kiểm tra lần nào"
+            print(f"  [{item['thread_id']}] {item['title']}")
+            print(f"        ~{item['cost']} requests, chu kỳ {item['interval'] / 3600:.1f}h "
+                  f"(change score {item['change_score']:.3f}{overdue})")
+        if report['enqueued'] and not args.dry_run:
+            print("Chạy worker để xử lý: python main.py worker")
+    
+    # Command: evict
+    elif args.command == 'evict':
+        from library.retention import enforce_storage_budget, get_storage_budget
+        
+        budget = int(args.budget_gb * 1024 ** 3) if args.budget_gb else get_storage_budget()
+        if budget is None:
+            print("(!) Chưa đặt giới hạn dung lượng.")
+            print("    Đặt STORAGE_BUDGET_GB trong config.py hoặc dùng: python main.py evict --budget-gb 20")
+            return
+        
+        report = enforce_storage_budget(
+            db_manager, library_manager, budget_bytes=budget,
+            keep_previews=args.keep_previews, dry_run=args.dry_run
+        )
+        print(f"\n=== Giới hạn dung lượng: {format_file_size(budget)} ===")
+        print(f"Đang dùng: {format_file_size(report['usage_before'])}")
+        if not report['evicted']:
+            if report['usage_before'] > budget:
+                print("(!) Vượt giới hạn nhưng không còn thread completed nào có thể evict.")
+            else:
+                print("✓ Library nằm trong giới hạn, không cần evict.")
+            return
+        
+        action = "Sẽ evict" if args.dry_run else "Đã evict"
+        print(f"{action} ảnh gốc của {len(report['evicted'])} thread(s) (ít dùng nhất trước): "
+              f"{', '.join(str(thread_id) for thread_id in report['evicted'])}")
+        print(f"Sau khi evict: {format_file_size(max(0, report['usage_after']))}")
+        if report['usage_after'] > budget:
+            print("(!) Vẫn vượt giới hạn: không còn thread completed nào có thể evict.")
+    
+    # Command: perf
+    elif args.command == 'perf':
+        from library.perf import build_perf_report, parse_since
+        
+        try:
+            since_seconds = parse_since(args.since)
+        except ValueError as e:
+            print(f"(!) {e}")
+            return
+        
+        report = build_perf_report(db_manager, since_seconds, top=args.top)
+        if not report['spans']:
+            print(f"(!) Không có số liệu thời gian nào trong {args.since} gần nhất.")
+            print("    Số liệu được ghi khi chạy worker (JOB_TIMINGS = True trong config.py).")
+            return
+        
+        def ms(value):
+            return f"{value / 1000:.2f}s" if value >= 1000 else f"{value:.0f}ms"
+        
+        print(f"\n=== Thời gian theo stage ({args.since} gần nhất, {report['spans']} spans) ===")
+        print(f"{'Stage':<16} {'Số lần':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'Tổng':>10}")
+        for row in report['stages']:
+            print(f"{row['stage']:<16} {row['count']:>8} {ms(row['p50']):>9} {ms(row['p95']):>9} "
+                  f"{ms(row['p99']):>9} {ms(row['total']):>10}")
+        
+        if report['http']:
+            print(f"\n=== HTTP requests theo loại URL ===")
+            print(f"{'Loại URL':<16} {'Số lần':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'Dữ liệu':>10} {'Lỗi':>6}")
+            for row in report['http']:
+                print(f"{row['url_class']:<16} {row['count']:>8} {ms(row['p50']):>9} {ms(row['p95']):>9} "
+                      f"{ms(row['p99']):>9} {format_file_size(row['bytes']):>10} {row['errors']:>6}")
+        
+        if report['slowest']:
+            print(f"\nTop {len(report['slowest'])} threads chậm nhất:")
+            for row in report['slowest']:
+                thread = library_manager.get_thread_by_id(row['thread_id'])
+                title = thread.title if thread else '(đã xóa)'
+                breakdown = ', '.join(
+                    f"{stage} {ms(total)}" for stage, total in
+                    sorted(row['stages'].items(), key=lambda kv: -kv[1]) if stage != 'job'
+                )
+                jobs = f" ({row['jobs']} lần chạy)" if row['jobs'] > 1 else ""
+                print(f"  [{row['thread_id']}] {ms(row['max_ms']):>9}{jobs}  {title}")
+                if breakdown:
+                    print(f"        {breakdown}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,188 @@
+# queue_system/metrics.py
+
+import os
+import time
+import bisect
+import threading
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, List, Optional, Tuple
+from scraper.timing import add_listener
+
+# Bucket (giây) cho histogram thời gian của các stage
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(pairs: Tuple[Tuple[str, str], ...]) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+class _Histogram:
+    """Histogram cộng dồn (không reset) theo bucket cố định."""
+    
+    def __init__(self):
+        self.counts = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, value: float):
+        index = bisect.bisect_left(DURATION_BUCKETS, value)
+        if index < len(DURATION_BUCKETS):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+class WorkerMetrics:
+    """
+    Counters / gauges / histograms của worker, xuất ra Prometheus text format.
+    
+    Thời gian stage, HTTP status và bytes được nhận từ các span của scraper/timing.py
+    (không cần bật JOB_TIMINGS); số job theo kết quả do worker cập nhật. Các giá trị tức thời
+    (queue depth, số job đang chạy, thời gian chờ rate limiter) được đọc lúc xuất qua add_collector.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs = defaultdict(int)                 # outcome -> số job
+        self.http_requests = defaultdict(int)        # (url_class, status) -> số request
+        self.http_bytes = defaultdict(int)           # url_class -> bytes
+        self.stages: Dict[str, _Histogram] = defaultdict(_Histogram)
+        self.started_at = time.time()
+        # Hàm lấy giá trị lúc xuất: name -> (type, help, fn() -> {labels tuple: value})
+        self._collectors: Dict[str, Tuple[str, str, Callable]] = {}
+        add_listener(self.on_span)
+    
+    def on_span(self, stage: str, duration: float, url_class: Optional[str],
+                status: Optional[int], nbytes: Optional[int]):
+        """Listener của scraper/timing.py."""
+        with self._lock:
+            if stage == 'http':
+                self.http_requests[(url_class or 'other', str(status))] += 1
+                if nbytes:
+                    self.http_bytes[url_class or 'other'] += nbytes
+            else:
+                self.stages[stage].observe(duration)
+    
+    def job_finished(self, outcome: str):
+        """Đếm một job theo kết quả: completed, partial, retry hoặc failed."""
+        with self._lock:
+            self.jobs[outcome] += 1
+    
+    def add_collector(self, name: str, metric_type: str, help_text: str, fn: Callable[[], Dict]):
+        """
+        Thêm metric được tính lúc xuất.
+        
+        Args:
+            name: Tên metric
+            metric_type: 'gauge' hoặc 'counter'
+            help_text: Mô tả (dòng # HELP)
+            fn: Hàm trả về dict {tuple (label, value): giá trị}
+        """
+        self._collectors[name] = (metric_type, help_text, fn)
+    
+    def render(self) -> str:
+        """Xuất toàn bộ metrics theo Prometheus text format (0.0.4)."""
+        lines: List[str] = []
+        
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                lines.append(f'{name}{_labels(labels)} {value}')
+        
+        with self._lock:
+            metric('fuo_jobs_total', 'counter', 'Số job worker đã xử lý theo kết quả',
+                   [((('outcome', outcome),), count) for outcome, count in sorted(self.jobs.items())])
+            metric('fuo_http_requests_total', 'counter', 'Số HTTP request theo loại URL và status',
+                   [((('url_class', url_class), ('status', status)), count)
+                    for (url_class, status), count in sorted(self.http_requests.items())])
+            metric('fuo_http_response_bytes_total', 'counter', 'Số bytes đã tải theo loại URL',
+                   [((('url_class', url_class),), total) for url_class, total in sorted(self.http_bytes.items())])
+            
+            lines.append('# HELP fuo_stage_duration_seconds Thời gian từng stage của job '
+                         '(render, rate_limit, media_json, image_download...)')
+            lines.append('# TYPE fuo_stage_duration_seconds histogram')
+            for stage, hist in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS, hist.counts):
+                    cumulative += count
+                    lines.append(f'fuo_stage_duration_seconds_bucket'
+                                 f'{_labels((("stage", stage), ("le", bound)))} {cumulative}')
+                lines.append(f'fuo_stage_duration_seconds_bucket{_labels((("stage", stage), ("le", "+Inf")))} '
+                             f'{hist.count}')
+                lines.append(f'fuo_stage_duration_seconds_sum{_labels((("stage", stage),))} {hist.sum:.6f}')
+                lines.append(f'fuo_stage_duration_seconds_count{_labels((("stage", stage),))} {hist.count}')
+        
+        for name, (metric_type, help_text, fn) in self._collectors.items():
+            try:
+                samples = sorted(fn().items())
+            except Exception:
+                # Vd: DB đang bị khóa -> bỏ qua metric này ở lần xuất hiện tại
+                continue
+            metric(name, metric_type, help_text, samples)
+        
+        metric('fuo_worker_start_time_seconds', 'gauge', 'Thời điểm worker khởi động (epoch seconds)',
+               [((), f'{self.started_at:.3f}')])
+        return '\n'.join(lines) + '\n'
+    
+    def write_file(self, path: str):
+        """Ghi metrics ra file (ghi file tạm rồi đổi tên, dùng cho textfile collector)."""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+def start_metrics_server(metrics: WorkerMetrics, port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """
+    Phục vụ GET /metrics trong luồng nền.
+    
+    Raises:
+        OSError: Nếu không mở được port
+    """
+    
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *_):
+            pass
+        
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+def start_metrics_file_writer(metrics: WorkerMetrics, path: str, interval: float = 15) -> threading.Event:
+    """
+    Ghi metrics ra file mỗi `interval` giây trong luồng nền (cho máy không mở được port,
+    vd: textfile collector của node_exporter).
+    
+    Returns:
+        Event: set() để dừng luồng ghi
+    """
+    stop_event = threading.Event()
+    
+    def loop():
+        while True:
+            try:
+                metrics.write_file(path)
+            except OSError as e:
+                print(f"[METRICS] (!) Không ghi được {path}: {e}")
+            if stop_event.wait(interval):
+                break
+    
+    threading.Thread(target=loop, name='metrics-file', daemon=True).start()
+    return stop_event
@@ -0,0 +1,364 @@
+# queue_system/pipeline.py
+
+import os
+import time
+import queue
+import threading
+import multiprocessing
+import requests
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from typing import Callable, Optional
+from database.models import DatabaseManager, Thread
+from queue_system.queue_manager import QueueManager
+from scraper.retry import classify_exception
+from scraper.timing import get_recorder, record_span, job_context, bind_job, span
+from scraper.scraper import (
+    discover_thread, process_media_item, export_comments_json, persist_question_data,
+    render_thread_pdf, build_thread_result, empty_thread_result
+)
+import config
+
+class PipelineEngine:
+    """
+    Chạy job theo các stage nối với nhau bằng hàng đợi có giới hạn:
+        
+        discover (1 luồng) → fetch + download (I/O thread pool)
+            → render PDF (process pool) → persist (luồng chính, ghi DB)
+    
+    Job có ảnh chưa nằm trên máy (tải lỗi, bị evict) được render trên một thread pool
+    riêng với session của pipeline, để ảnh được tải lại như khi chạy worker tuần tự.
+    
+    Network I/O của thread này chạy song song với render (CPU) của thread khác.
+    Số job đồng thời bị giới hạn bởi `max_jobs` (backpressure): khi các stage sau
+    chậm, discover sẽ dừng lấy job mới nên bộ nhớ không tăng theo độ dài queue.
+    """
+    
+    def __init__(
+        self,
+        db_manager: DatabaseManager,
+        session: requests.Session,
+        persist: Callable[[Thread, dict], None],
+        io_workers: Optional[int] = None,
+        render_workers: Optional[int] = None,
+        max_jobs: Optional[int] = None,
+        sleep_interval: int = 5
+    ):
+        """
+        Khởi tạo PipelineEngine.
+        
+        Args:
+            db_manager: DatabaseManager instance
+            session: requests.Session với cookies đã được setup
+            persist: Hàm lưu kết quả của một thread vào DB (QueueWorker.persist_result)
+            io_workers: Số luồng cho fetch + download (mặc định config.PIPELINE_IO_WORKERS)
+            render_workers: Số process render PDF (mặc định config.PIPELINE_RENDER_WORKERS)
+            max_jobs: Số thread tối đa đang nằm trong pipeline (mặc định config.PIPELINE_MAX_JOBS)
+            sleep_interval: Giây giữa các lần check queue khi rỗng
+        """
+        self.db = db_manager
+        self.session = session
+        self.persist = persist
+        self.queue_manager = QueueManager(db_manager)
+        self.io_workers = max(1, io_workers or getattr(config, 'PIPELINE_IO_WORKERS', 4))
+        self.render_workers = max(1, render_workers or getattr(config, 'PIPELINE_RENDER_WORKERS', 2))
+        self.max_jobs = max(1, max_jobs or getattr(config, 'PIPELINE_MAX_JOBS', 3))
+        self.sleep_interval = sleep_interval
+        
+        # Hàng đợi giữa các stage. _render_q không giới hạn: callback của I/O pool chỉ
+        # put_nowait (không chặn luồng pool), số job trong đó đã bị giới hạn bởi max_jobs
+        self._fetch_q: "queue.Queue[Optional[dict]]" = queue.Queue(maxsize=self.max_jobs)
+        self._render_q: "queue.Queue[Optional[dict]]" = queue.Queue()
+        self._persist_q: "queue.Queue[dict]" = queue.Queue()
+        
+        # Giới hạn số job trong pipeline và số media item đang chạy trên I/O pool
+        self._job_slots = threading.Semaphore(self.max_jobs)
+        self._item_slots = threading.Semaphore(self.io_workers * 2)
+        self._render_slots = threading.Semaphore(self.render_workers)
+        
+        self._running = False
+        self._discover_done = threading.Event()
+        self._inflight = 0
+        self._inflight_lock = threading.Lock()
+        
+        self._io_pool: Optional[ThreadPoolExecutor] = None
+        self._render_pool: Optional[ProcessPoolExecutor] = None
+        self._local_render_pool: Optional[ThreadPoolExecutor] = None
+    
+    # ------------------------------------------------------------------
+    # Stage 1: discover
+    # ------------------------------------------------------------------
+    
+    def _discover_loop(self, stop_on_empty: bool):
+        """Lấy thread pending, tải trang thread và đẩy job sang stage fetch."""
+        try:
+            while self._running:
+                # Chờ có chỗ trống trong pipeline trước khi lấy job mới
+                if not self._job_slots.acquire(timeout=0.5):
+                    continue
+                
+                # Lấy thread và chuyển sang processing trong cùng một transaction
+                thread = self.queue_manager.claim_next_pending()
+                if not thread:
+                    self._job_slots.release()
+                    if stop_on_empty:
+                        break
+                    time.sleep(self.sleep_interval)
+                    continue
+                
+                with self._inflight_lock:
+                    self._inflight += 1
+                
+                print(f"\n[PIPELINE] Discover thread ID {thread.id}: {thread.title}")
+                entry = {'thread': thread, 'job': None, 'outcomes': [], 'remaining': 0,
+                         'lock': threading.Lock(), 'pdf_path': None, 'error': None,
+                         'started_at': time.time(), 'render_started_at': None}
+                try:
+                    thread_info = self.queue_manager.build_thread_info(thread)
+                    with job_context(thread.id):
+                        entry['job'] = discover_thread(self.session, thread_info, thread.id, self.db)
+                except Exception as e:
+                    entry['error'] = f"Lỗi khi truy cập vào đề thi {thread.url}: {e}"
+                
+                if entry['error'] or not entry['job']['items']:
+                    entry['error'] = entry['error'] or "Không tìm thấy media nào trong đề thi này."
+                    self._persist_q.put(entry)
+                    continue
+                
+                self._fetch_q.put(entry)
+        finally:
+            self._discover_done.set()
+            self._fetch_q.put(None)
+    
+    # ------------------------------------------------------------------
+    # Stage 2: fetch + download (I/O thread pool)
+    # ------------------------------------------------------------------
+    
+    def _dispatch_loop(self):
+        """Chia từng media item của job cho I/O pool (giới hạn số item đang chạy)."""
+        while True:
+            entry = self._fetch_q.get()
+            if entry is None:
+                break
+            
+            items = entry['job']['items']
+            entry['outcomes'] = [None] * len(items)
+            entry['remaining'] = len(items)
+            for item in items:
+                self._item_slots.acquire()
+                future = self._io_pool.submit(
+                    bind_job(entry['thread'].id, process_media_item), self.session, entry['job'], item
+                )
+                future.add_done_callback(
+                    lambda f, entry=entry, item=item: self._on_item_done(entry, item, f)
+                )
+    
+    def _on_item_done(self, entry: dict, item: dict, future: Future):
+        """Callback khi một media item xong: khi đủ item thì chuyển job sang render."""
+        self._item_slots.release()
+        try:
+            outcome = future.result()
+        except Exception as e:
+            error = classify_exception(e, f"media ID {item['media_id']}")
+            outcome = {'index': item['index'], 'question_data': None, 'failure': {
+                'media_id': item['media_id'],
+                'error_kind': error.kind,
+                'error_message': str(error),
+                'attempts': error.attempts
+            }}
+        
+        with entry['lock']:
+            entry['outcomes'][item['index']] = outcome
+            entry['remaining'] -= 1
+            done = entry['remaining'] == 0
+        
+        if done:
+            # Không chặn trong callback: luồng I/O bị chặn có thể là luồng mà render đang cần
+            self._render_q.put_nowait(entry)
+    
+    # ------------------------------------------------------------------
+    # Stage 3: render (process pool)
+    # ------------------------------------------------------------------
+    
+    def _render_loop(self):
+        """Export comments.json và render PDF của job trong process pool."""
+        while True:
+            entry = self._render_q.get()
+            if entry is None:
+                break
+            
+            job = entry['job']
+            all_question_data = [o['question_data'] for o in entry['outcomes'] if o and o['question_data']]
+            with job_context(entry['thread'].id):
+                try:
+                    export_comments_json(job['thread_save_path'], all_question_data)
+                except Exception as e:
+                    print(f"    (!) Lỗi khi lưu comments.json: {e}")
+                consensus = persist_question_data(job, all_question_data)
+            
+            self._render_slots.acquire()
+            missing = [
+                q for q in all_question_data
+                if q.get('image_url') and not (q.get('image_local_path') and os.path.exists(q['image_local_path']))
+            ]
+            if missing:
+                # Process render không có session: ảnh tải lỗi / đã bị evict phải được tải lại
+                # như ở run_loop, nên render trong process chính (pool riêng, không dùng I/O pool)
+                print(f"    [*] {len(missing)} ảnh chưa có trên máy: render trong process chính để tải lại.")
+                entry['render_started_at'] = None  # render_thread_pdf tự ghi span khi chạy tại chỗ
+                future = self._local_render_pool.submit(
+                    bind_job(entry['thread'].id, render_thread_pdf), all_question_data,
+                    job['thread_save_path'], job['folder_name'], job['thread_info']['title'],
+                    self.session, consensus
+                )
+                future.add_done_callback(lambda f, entry=entry: self._on_render_done(entry, f))
+                continue
+            
+            entry['render_started_at'] = time.time()
+            try:
+                future = self._render_pool.submit(
+                    render_thread_pdf, all_question_data, job['thread_save_path'],
+                    job['folder_name'], job['thread_info']['title'], None, consensus
+                )
+            except Exception as e:
+                # Process pool hỏng -> render ngay trong luồng này
+                print(f"    (!) Không dùng được process pool ({e}), render trong luồng hiện tại.")
+                self._render_slots.release()
+                entry['render_started_at'] = None  # render_thread_pdf tự ghi span khi chạy tại chỗ
+                with job_context(entry['thread'].id):
+                    entry['pdf_path'] = render_thread_pdf(
+                        all_question_data, job['thread_save_path'], job['folder_name'],
+                        job['thread_info']['title'], self.session, consensus
+                    )
+                self._persist_q.put(entry)
+                continue
+            
+            future.add_done_callback(lambda f, entry=entry: self._on_render_done(entry, f))
+    
+    def _on_render_done(self, entry: dict, future: Future):
+        """Callback khi render xong: chuyển job sang stage persist."""
+        self._render_slots.release()
+        # Process con không có recorder: đo render (gồm thời gian chờ process rảnh) từ phía pipeline
+        if entry['render_started_at'] is not None:
+            record_span('render', time.time() - entry['render_started_at'],
+                        thread_id=entry['thread'].id, started_at=entry['render_started_at'])
+        try:
+            entry['pdf_path'] = future.result()
+        except Exception as e:
+            print(f"    (!) Lỗi khi tạo PDF cho thread ID {entry['thread'].id}: {e}")
+            entry['pdf_path'] = None
+        self._persist_q.put(entry)
+    
+    # ------------------------------------------------------------------
+    # Stage 4: persist (luồng chính)
+    # ------------------------------------------------------------------
+    
+    def _persist_entry(self, entry: dict):
+        """Ghi kết quả của job vào DB (chạy trên luồng chính, tuần tự)."""
+        thread = entry['thread']
+        try:
+            if entry['error']:
+                result = empty_thread_result(entry['error'])
+            else:
+                outcomes = [o for o in entry['outcomes'] if o]
+                all_question_data = [o['question_data'] for o in outcomes if o['question_data']]
+                failed_items = [o['failure'] for o in outcomes if o['failure']]
+                result = build_thread_result(entry['job'], all_question_data, failed_items, entry['pdf_path'])
+            with job_context(thread.id), span('persist'):
+                self.persist(thread, result)
+        except Exception as e:
+            print(f"\n[PIPELINE] ✗ Exception khi lưu thread ID {thread.id}: {e}")
+            self.queue_manager.schedule_retry(thread.id, str(e))
+        finally:
+            record_span('job', time.time() - entry['started_at'],
+                        thread_id=thread.id, started_at=entry['started_at'])
+            recorder = get_recorder()
+            if recorder is not None:
+                recorder.flush()
+            with self._inflight_lock:
+                self._inflight -= 1
+            self._job_slots.release()
+    
+    # ------------------------------------------------------------------
+    
+    def run(self, stop_on_empty: bool = False):
+        """
+        Chạy pipeline cho đến khi bị dừng (hoặc queue rỗng nếu stop_on_empty).
+        
+        Args:
+            stop_on_empty: Nếu True, dừng khi queue rỗng và các job đang chạy đã xong.
+        """
+        self._running = True
+        self._discover_done.clear()
+        
+        print(f"\n{'='*60}")
+        print(f"[PIPELINE] Bắt đầu pipeline")
+        print(f"[PIPELINE] I/O workers: {self.io_workers}, render workers: {self.render_workers}, "
+              f"max jobs: {self.max_jobs}")
+        print(f"[PIPELINE] Stop on empty: {stop_on_empty}")
+        print(f"{'='*60}\n")
+        
+        self._io_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='pipeline-io')
+        # Render trong process chính khi job thiếu ảnh (cần session để tải lại)
+        self._local_render_pool = ThreadPoolExecutor(max_workers=self.render_workers,
+                                                     thread_name_prefix='pipeline-render-local')
+        # spawn thay vì fork: process con không thừa hưởng lock của các luồng đang chạy
+        self._render_pool = ProcessPoolExecutor(
+            max_workers=self.render_workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        
+        stage_threads = [
+            threading.Thread(target=self._discover_loop, args=(stop_on_empty,),
+                             name='pipeline-discover', daemon=True),
+            threading.Thread(target=self._dispatch_loop, name='pipeline-dispatch', daemon=True),
+            threading.Thread(target=self._render_loop, name='pipeline-render', daemon=True),
+        ]
+        for t in stage_threads:
+            t.start()
+        
+        drained = False
+        try:
+            self._persist_until_idle()
+            drained = True
+            if stop_on_empty:
+                print("\n[PIPELINE] Queue rỗng. Dừng pipeline.")
+        except KeyboardInterrupt:
+            # Dừng lấy job mới nhưng vẫn lưu các job đang chạy, tránh để thread kẹt ở processing
+            self._running = False
+            print(f"\n[PIPELINE] Nhận tín hiệu dừng (Ctrl+C). Chờ {self.inflight} job đang chạy hoàn tất "
+                  f"(Ctrl+C lần nữa để thoát ngay)...")
+            try:
+                self._persist_until_idle()
+                drained = True
+            except KeyboardInterrupt:
+                print(f"\n[PIPELINE] Thoát ngay, {self.inflight} job chưa được lưu.")
+        finally:
+            self._running = False
+            self._render_q.put(None)
+            # Đã lưu hết job -> các pool đã rảnh, chờ chúng dừng hẳn; thoát ngay thì không chờ
+            self._io_pool.shutdown(wait=drained)
+            self._local_render_pool.shutdown(wait=drained)
+            self._render_pool.shutdown(wait=drained)
+    
+    def _persist_until_idle(self):
+        """Lưu các job đã xong cho đến khi discover dừng và không còn job nào trong pipeline."""
+        while True:
+            try:
+                entry = self._persist_q.get(timeout=0.5)
+            except queue.Empty:
+                with self._inflight_lock:
+                    idle = self._inflight == 0
+                if self._discover_done.is_set() and idle:
+                    return
+                continue
+            self._persist_entry(entry)
+    
+    @property
+    def inflight(self) -> int:
+        """Số job đang nằm trong pipeline."""
+        with self._inflight_lock:
+            return self._inflight
+    
+    def stop(self):
+        """Dừng lấy job mới (các job đang chạy vẫn được hoàn tất)."""
+        self._running = False
@@ -1,9 +1,15 @@
 # queue/queue_manager.py
 
-from typing import Optional, Dict
+import time
+from typing import Optional, Dict, List, Tuple
 from datetime import datetime
-from database.models import DatabaseManager, Thread, ThreadStatus
+from database.models import DatabaseManager, Thread, ThreadStatus, THREAD_COLUMNS, THREAD_SELECT
 from library.library_manager import LibraryManager
+import config
+
+# Thứ tự lấy job: priority cao trước, rồi thread đến hạn sớm hơn, rồi FIFO.
+# Khớp với index idx_threads_queue nên SQLite không phải sort.
+QUEUE_ORDER = "ORDER BY priority DESC, not_before ASC, created_at ASC"
 
 class QueueManager:
     """Quản lý queue (hàng chờ xử lý threads)"""
@@ -20,24 +26,269 @@ class QueueManager:
     
     def get_next_pending(self) -> Optional[Thread]:
         """
-        Lấy thread pending cũ nhất (FIFO - First In First Out).
+        Xem thread pending tiếp theo đã đến hạn (không thay đổi status).
         
         Returns:
-            Thread object nếu có, None nếu không có thread nào pending
+            Thread object nếu có, None nếu không có thread nào pending đến hạn
         """
-        with self.db.get_connection() as conn:
+        threads = self.get_pending_threads(1)
+        return threads[0] if threads else None
+    
+    def claim_next_pending(self) -> Optional[Thread]:
+        """
+        Lấy thread pending tiếp theo đã đến hạn và chuyển sang processing (atomic).
+        
+        SELECT + UPDATE chạy trong cùng transaction BEGIN IMMEDIATE nên hai worker
+        chạy song song không bao giờ lấy trùng một thread.
+        
+        Fair scheduling giữa các forum: trong số các forum có thread đến hạn ở mức priority
+        cao nhất, forum được lấy job lâu nhất rồi (forums.last_claimed_at) được chọn trước,
+        nên backlog lớn của một môn không chặn các môn khác. Trong một forum vẫn theo QUEUE_ORDER.
+        
+        Returns:
+            Thread object (status = processing), None nếu không có thread nào đến hạn
+        """
+        conn = self.db.get_connection()
+        conn.isolation_level = None  # Tự quản lý transaction
+        try:
             cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            pending = ThreadStatus.PENDING.value
+            cursor.execute("""
+                SELECT MAX(priority) FROM threads WHERE status = ? AND not_before <= ?
+            """, (pending, int(now)))
+            top_priority = cursor.fetchone()[0]
+            if top_priority is None:
+                cursor.execute("COMMIT")
+                return None
+            
+            # Forum đến lượt: có thread đến hạn ở priority cao nhất, lâu chưa được lấy job nhất
             cursor.execute("""
-                SELECT * FROM threads 
-                WHERE status = ? 
-                ORDER BY created_at ASC 
+                SELECT f.id FROM forums f
+                WHERE EXISTS (
+                    SELECT 1 FROM threads t
+                    WHERE t.forum_id = f.id AND t.status = ? AND t.priority = ? AND t.not_before <= ?
+                )
+                ORDER BY COALESCE(f.last_claimed_at, 0) ASC, f.id ASC
                 LIMIT 1
+            """, (pending, top_priority, int(now)))
+            forum = cursor.fetchone()
+            if forum:
+                cursor.execute(f"""
+                    SELECT id FROM threads 
+                    WHERE forum_id = ? AND status = ? AND priority = ? AND not_before <= ? 
+                    {QUEUE_ORDER} 
+                    LIMIT 1
+                """, (forum[0], pending, top_priority, int(now)))
+                row = cursor.fetchone()
+                cursor.execute("UPDATE forums SET last_claimed_at = ? WHERE id = ?", (now, forum[0]))
+            else:
+                # Thread chưa được gán forum (DB sửa tay...) -> thứ tự chung của queue
+                cursor.execute(f"""
+                    SELECT id FROM threads 
+                    WHERE status = ? AND not_before <= ? 
+                    {QUEUE_ORDER} 
+                    LIMIT 1
+                """, (pending, int(now)))
+                row = cursor.fetchone()
+            if not row:
+                cursor.execute("COMMIT")
+                return None
+            
+            cursor.execute("""
+                UPDATE threads 
+                SET status = ?, updated_at = CURRENT_TIMESTAMP 
+                WHERE id = ?
+            """, (ThreadStatus.PROCESSING.value, row[0]))
+            cursor.execute(f"{THREAD_SELECT} WHERE id = ?", (row[0],))
+            claimed = cursor.fetchone()
+            cursor.execute("COMMIT")
+            return self.db.thread_from_row(claimed)
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+    
+    def build_thread_info(self, thread: Thread) -> Dict:
+        """
+        Chuẩn bị thread_info cho scraper: URL, tiêu đề và forum của thread
+        (base URL + rate interval của forum; rate limiter dùng chung theo site).
+        
+        Returns:
+            Dict chứa url, title, forum_id, base_url, rate_interval, refresh_comments
+        """
+        forum = self.library.get_forum(thread.forum_id) if thread.forum_id is not None else None
+        return {
+            'url': thread.url,
+            'title': thread.title,
+            'forum_id': forum.id if forum else None,
+            # Thread thêm thủ công vào forum của site khác -> scraper tự tính base URL từ URL thread
+            'base_url': forum.base_url if forum and thread.url.startswith(forum.base_url + '/') else None,
+            'rate_interval': forum.min_interval if forum else None,
+            # Thread đã từng cào xong (refresh / watch): cập nhật comments của các ảnh đã tải
+            'refresh_comments': thread.last_checked_at is not None
+        }
+    
+    def get_pending_threads(self, limit: int) -> List[Thread]:
+        """
+        Lấy danh sách các thread pending đã đến hạn theo thứ tự xử lý (không thay đổi status).
+        
+        Args:
+            limit: Số lượng thread tối đa
+        
+        Returns:
+            List các Thread objects
+        """
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                {THREAD_SELECT} 
+                WHERE status = ? AND not_before <= ? 
+                {QUEUE_ORDER} 
+                LIMIT ?
+            """, (ThreadStatus.PENDING.value, int(time.time()), limit))
+            rows = cursor.fetchall()
+            
+            return [self.db.thread_from_row(row) for row in rows]
+    
+    def get_next_due_time(self) -> Optional[int]:
+        """
+        Thời điểm (epoch seconds) sớm nhất mà một thread pending đến hạn.
+        
+        Returns:
+            Epoch seconds, None nếu không có thread pending nào
+        """
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT MIN(not_before) FROM threads WHERE status = ?
             """, (ThreadStatus.PENDING.value,))
             row = cursor.fetchone()
-            
-            if row:
-                return self.db.thread_from_row(row)
+            return row[0] if row else None
+    
+    def requeue_thread(
+        self,
+        thread: Thread,
+        delay: float = 0,
+        priority: Optional[int] = None,
+        reset_retries: bool = True
+    ):
+        """
+        Đưa thread về pending, chỉ được xử lý sau `delay` giây.
+        
+        Args:
+            thread: Thread cần đưa lại vào queue
+            delay: Số giây trì hoãn (0 = xử lý ngay khi đến lượt)
+            priority: Độ ưu tiên mới (None = giữ nguyên)
+            reset_retries: Đặt lại bộ đếm retry tự động (khi người dùng retry thủ công)
+        """
+        thread.status = ThreadStatus.PENDING
+        thread.not_before = int(time.time() + max(0, delay))
+        if priority is not None:
+            thread.priority = priority
+        if reset_retries:
+            thread.retry_count = 0
+            thread.error_message = None
+        self.library.update_thread(thread)
+    
+    def schedule_retry(self, thread_id: int, error_message: str) -> Optional[float]:
+        """
+        Thread thất bại: lên lịch retry với exponential backoff (qua not_before),
+        hoặc đánh dấu failed nếu đã hết số lần retry.
+        
+        Args:
+            thread_id: ID của thread
+            error_message: Lỗi của lần xử lý vừa rồi
+        
+        Returns:
+            Số giây đến lần retry tiếp theo, None nếu thread đã chuyển sang failed
+        """
+        # scraper.retry kéo theo requests: chỉ import khi thật sự retry (CLI đọc DB không cần)
+        from scraper.retry import backoff_delay
+        
+        thread = self.library.get_thread_by_id(thread_id)
+        if not thread:
             return None
+        
+        max_retries = getattr(config, 'THREAD_MAX_RETRIES', 3)
+        if thread.retry_count >= max_retries:
+            self.update_thread_status(thread_id, ThreadStatus.FAILED, error_message=error_message)
+            return None
+        
+        thread.retry_count += 1
+        base = getattr(config, 'THREAD_RETRY_BACKOFF', 60)
+        cap = getattr(config, 'THREAD_RETRY_BACKOFF_MAX', 3600)
+        # Equal jitter: luôn chờ ít nhất một nửa khoảng backoff, nửa còn lại ngẫu nhiên
+        delay = min(cap, base * 2 ** (thread.retry_count - 1)) / 2
+        delay += backoff_delay(thread.retry_count, base=base / 2, cap=cap / 2)
+        thread.error_message = f"(retry {thread.retry_count}/{max_retries}) {error_message}"
+        self.requeue_thread(thread, delay=delay, reset_retries=False)
+        return delay
+    
+    def record_check(self, thread_id: int, changed: bool):
+        """
+        Ghi nhận một lần cào thành công cho lịch kiểm tra lại của `watch`.
+        
+        change_score giảm theo hệ số config.WATCH_SCORE_DECAY sau mỗi lần không có gì mới
+        (chu kỳ kiểm tra dài ra theo cấp số nhân) và tăng lại về phía 1 khi thread thay đổi.
+        
+        Args:
+            thread_id: ID của thread
+            changed: Lần cào này có câu hỏi/comments mới hay thay đổi không
+        """
+        decay = getattr(config, 'WATCH_SCORE_DECAY', 0.5)
+        with self.db.get_connection() as conn:
+            conn.execute("""
+                UPDATE threads
+                SET last_checked_at = ?, change_score = change_score * ? + ?
+                WHERE id = ?
+            """, (int(time.time()), decay, (1 - decay) if changed else 0, thread_id))
+            conn.commit()
+    
+    def get_due_checks(
+        self,
+        min_interval: float,
+        max_interval: float,
+        limit: int,
+        now: Optional[float] = None
+    ) -> List[Tuple[Thread, int]]:
+        """
+        Lấy các thread đã cào xong (completed/partial) đến hạn kiểm tra lại, quá hạn lâu nhất trước.
+        
+        Chu kỳ của mỗi thread = min_interval / change_score, giới hạn trong [min_interval, max_interval]
+        (cùng công thức với queue_system.watch.check_interval). Thread chưa từng được kiểm tra
+        (last_checked_at NULL) luôn đến hạn.
+        
+        Args:
+            min_interval: Chu kỳ ngắn nhất (giây), cho thread vừa thay đổi
+            max_interval: Chu kỳ dài nhất (giây), cho thread không đổi từ lâu
+            limit: Số thread tối đa
+            now: Epoch seconds (mặc định: hiện tại)
+        
+        Returns:
+            List (Thread, số ảnh đã bị evict - worker sẽ tải lại khi cào)
+        """
+        now = time.time() if now is None else now
+        interval = "MIN(:max, :min / MAX(change_score, :min / :max))"
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT {', '.join(THREAD_COLUMNS)},
+                       (SELECT COUNT(*) FROM media_items m
+                        WHERE m.thread_id = threads.id AND m.evicted_at IS NOT NULL)
+                FROM threads
+                WHERE status IN (:completed, :partial)
+                  AND (last_checked_at IS NULL OR last_checked_at + {interval} <= :now)
+                ORDER BY COALESCE(last_checked_at + {interval}, 0) ASC, id ASC
+                LIMIT :limit
+            """, {
+                'min': float(min_interval), 'max': float(max_interval), 'now': now, 'limit': limit,
+                'completed': ThreadStatus.COMPLETED.value, 'partial': ThreadStatus.PARTIAL.value
+            })
+            return [(self.db.thread_from_row(row[:-1]), row[-1]) for row in cursor.fetchall()]
     
     def update_thread_status(
         self, 
@@ -74,7 +325,7 @@ class QueueManager:
         if total_questions > 0:
             thread.total_questions = total_questions
         
-        if status == ThreadStatus.COMPLETED or status == ThreadStatus.FAILED:
+        if status in (ThreadStatus.COMPLETED, ThreadStatus.PARTIAL, ThreadStatus.FAILED):
             thread.completed_at = datetime.now()
         
         self.library.update_thread(thread)
@@ -83,22 +334,22 @@ class QueueManager:
         """
         Lấy thống kê queue (số lượng threads theo từng status).
         
+        Đọc từ bảng queue_counters (trigger cập nhật) nên chi phí không phụ thuộc
+        vào số threads trong library.
+        
         Returns:
-            Dict với keys: 'pending', 'processing', 'completed', 'failed'
+            Dict với keys: 'pending', 'processing', 'completed', 'partial', 'failed'
         """
         with self.db.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT status, COUNT(*) 
-                FROM threads 
-                GROUP BY status
-            """)
+            cursor.execute("SELECT status, count FROM queue_counters")
             results = cursor.fetchall()
             
             stats = {
                 'pending': 0,
                 'processing': 0,
                 'completed': 0,
+                'partial': 0,
                 'failed': 0
             }
             
@@ -106,5 +357,24 @@ class QueueManager:
                 stats[status] = count
             
             return stats
-
-
+    
+    def check_queue_counters(self) -> Dict[str, tuple]:
+        """
+        So sánh queue_counters với số đếm thực tế từ bảng threads.
+        
+        Returns:
+            Dict {status: (counter, thực tế)} của các status bị lệch (rỗng nếu khớp)
+        """
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT status, count FROM queue_counters")
+            counters = dict(cursor.fetchall())
+            cursor.execute("SELECT status, COUNT(*) FROM threads GROUP BY status")
+            actual = dict(cursor.fetchall())
+        
+        mismatches = {}
+        for status in set(counters) | set(actual):
+            counter, real = counters.get(status, 0), actual.get(status, 0)
+            if counter != real:
+                mismatches[status] = (counter, real)
+        return mismatches
@@ -0,0 +1,155 @@
+# queue_system/watch.py
+
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+from database.models import DatabaseManager
+from queue_system.queue_manager import QueueManager
+import config
+
+# Cửa sổ tính request budget (giây)
+BUDGET_WINDOW = 3600
+
+def check_interval(change_score: float, min_interval: float, max_interval: float) -> float:
+    """
+    Chu kỳ kiểm tra lại của một thread (giây): min_interval / change_score,
+    giới hạn trong [min_interval, max_interval].
+    
+    change_score giảm theo cấp số nhân sau mỗi lần cào không có gì mới
+    (QueueManager.record_check), nên chu kỳ của thread ổn định dài ra theo cấp số nhân.
+    """
+    return min(max_interval, min_interval / max(change_score, min_interval / max_interval))
+
+def estimate_requests(total_questions: int, evicted_images: int) -> int:
+    """Số request ước tính khi cào lại một thread: trang thread + JSON từng câu hỏi + ảnh đã bị evict."""
+    return 1 + (total_questions or 0) + evicted_images
+
+class WatchScheduler:
+    """
+    Đưa các thread đã cào xong (completed/partial) vào lại queue theo lịch riêng của từng thread,
+    để worker cập nhật comments/đáp án mới.
+    
+    - Thread vừa có thay đổi được kiểm tra sau WATCH_MIN_INTERVAL; mỗi lần không đổi,
+      chu kỳ dài ra theo cấp số nhân đến tối đa WATCH_MAX_INTERVAL.
+    - Tổng số request ước tính của các thread được đưa vào queue trong một giờ
+      không vượt WATCH_REQUESTS_PER_HOUR (budget tính trong bộ nhớ của process `watch`).
+    
+    Scheduler chỉ đưa thread vào queue; việc cào do `worker` thực hiện.
+    """
+    
+    def __init__(
+        self,
+        db_manager: DatabaseManager,
+        requests_per_hour: Optional[int] = None,
+        min_interval: Optional[float] = None,
+        max_interval: Optional[float] = None,
+        poll_interval: Optional[float] = None
+    ):
+        """
+        Khởi tạo WatchScheduler.
+        
+        Args:
+            db_manager: DatabaseManager instance
+            requests_per_hour: Request budget mỗi giờ (mặc định config.WATCH_REQUESTS_PER_HOUR)
+            min_interval: Chu kỳ ngắn nhất, giây (mặc định config.WATCH_MIN_INTERVAL)
+            max_interval: Chu kỳ dài nhất, giây (mặc định config.WATCH_MAX_INTERVAL)
+            poll_interval: Giây giữa hai lần quét lịch (mặc định config.WATCH_POLL_INTERVAL)
+        """
+        self.queue_manager = QueueManager(db_manager)
+        self.requests_per_hour = requests_per_hour or getattr(config, 'WATCH_REQUESTS_PER_HOUR', 300)
+        self.min_interval = min_interval or getattr(config, 'WATCH_MIN_INTERVAL', 3 * 3600)
+        self.max_interval = max(self.min_interval, max_interval or getattr(config, 'WATCH_MAX_INTERVAL', 14 * 86400))
+        self.poll_interval = poll_interval or getattr(config, 'WATCH_POLL_INTERVAL', 300)
+        self.priority = getattr(config, 'WATCH_PRIORITY', -1)
+        self.is_running = False
+        # (thời điểm đưa vào queue, số request ước tính) trong BUDGET_WINDOW gần nhất
+        self._spent: Deque[Tuple[float, int]] = deque()
+    
+    def remaining_budget(self, now: Optional[float] = None) -> int:
+        """Số request còn được dùng trong cửa sổ một giờ hiện tại."""
+        now = time.time() if now is None else now
+        while self._spent and self._spent[0][0] <= now - BUDGET_WINDOW:
+            self._spent.popleft()
+        return self.requests_per_hour - sum(cost for _, cost in self._spent)
+    
+    def run_once(self, dry_run: bool = False, now: Optional[float] = None) -> Dict:
+        """
+        Quét lịch một lần: đưa các thread đến hạn vào queue, quá hạn lâu nhất trước,
+        cho đến khi hết budget.
+        
+        Thread có chi phí lớn hơn cả budget một giờ vẫn được đưa vào khi cửa sổ đang trống
+        (nếu không sẽ không bao giờ được kiểm tra lại).
+        
+        Args:
+            dry_run: Chỉ liệt kê, không đưa vào queue và không tính vào budget
+            now: Epoch seconds (mặc định: hiện tại)
+        
+        Returns:
+            Dict chứa:
+                - due: Số thread đến hạn tìm thấy
+                - enqueued: List dict (thread_id, title, cost, interval, change_score, overdue)
+                - deferred: Số thread đến hạn nhưng để lần sau vì hết budget
+                - budget_left: Budget còn lại sau lần quét
+        """
+        now = time.time() if now is None else now
+        budget = self.remaining_budget(now)
+        # Không lấy nhiều hơn số thread có thể đưa vào (mỗi thread tốn ít nhất 1 request)
+        due = self.queue_manager.get_due_checks(
+            self.min_interval, self.max_interval, limit=max(1, budget) + 1, now=now
+        )
+        
+        enqueued = []
+        for thread, evicted in due:
+            cost = estimate_requests(thread.total_questions, evicted)
+            if cost > budget and (enqueued or self._spent or budget <= 0):
+                break
+            interval = check_interval(thread.change_score, self.min_interval, self.max_interval)
+            enqueued.append({
+                'thread_id': thread.id,
+                'title': thread.title,
+                'cost': cost,
+                'interval': interval,
+                'change_score': thread.change_score,
+                'overdue': now - (thread.last_checked_at + interval) if thread.last_checked_at else None
+            })
+            budget -= cost
+            if not dry_run:
+                self.queue_manager.requeue_thread(thread, priority=self.priority)
+                self._spent.append((now, cost))
+        
+        return {
+            'due': len(due),
+            'enqueued': enqueued,
+            'deferred': len(due) - len(enqueued),
+            'budget_left': max(0, budget)
+        }
+    
+    def run(self):
+        """Chạy liên tục: quét lịch mỗi poll_interval giây cho đến khi bị dừng (Ctrl+C)."""
+        self.is_running = True
+        print(f"\n{'='*60}")
+        print(f"[WATCH] Bắt đầu theo dõi threads đã cào xong")
+        print(f"[WATCH] Chu kỳ: {self.min_interval / 3600:g}h - {self.max_interval / 3600:g}h, "
+              f"budget {self.requests_per_hour} requests/giờ, quét mỗi {self.poll_interval:g}s")
+        print(f"{'='*60}\n")
+        
+        try:
+            while self.is_running:
+                report = self.run_once()
+                for item in report['enqueued']:
+                    print(f"[WATCH] + [{item['thread_id']}] {item['title']} "
+                          f"(~{item['cost']} requests, chu kỳ {item['interval'] / 3600:.1f}h)")
+                if report['enqueued'] or report['deferred']:
+                    print(f"[WATCH] Đã đưa {len(report['enqueued'])} thread vào queue, "
+                          f"{report['deferred']} thread chờ budget, còn {report['budget_left']} requests")
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print("\n[WATCH] Nhận tín hiệu dừng (Ctrl+C).")
+        finally:
+            self.is_running = False
+        
+        print("[WATCH] Đã dừng.")
+    
+    def stop(self):
+        """Dừng vòng lặp"""
+        self.is_running = False
@@ -2,10 +2,19 @@
 
 import time
 import requests
-from typing import Optional
-from database.models import DatabaseManager, ThreadStatus
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Dict, List, Tuple
+from database.models import DatabaseManager, Thread, ThreadStatus
 from queue_system.queue_manager import QueueManager
-from scraper.scraper import download_images_with_comments_from_thread
+from scraper.scraper import download_images_with_comments_from_thread, get_absolute_path, thread_rate_limiter
+from library.storage import scan_thread_folder
+from library.retention import enforce_storage_budget
+from scraper.media_api import extract_media_ids_from_thread
+from scraper.rate_limiter import get_total_wait
+from scraper.timing import (
+    TimingRecorder, set_recorder, get_recorder, install_http_timing, job_context, bind_job, span
+)
 import config
 
 class QueueWorker:
@@ -24,6 +33,235 @@ class QueueWorker:
         self.queue_manager = QueueManager(db_manager)
         self.is_running = False
         self.sleep_interval = 5  # Giây giữa các lần check queue
+        
+        # Prefetch: tải trước trang thread (Media IDs + CSRF token) của K job tiếp theo
+        self.prefetch_count = getattr(config, 'PREFETCH_THREADS', 2)
+        self.prefetch_ttl = getattr(config, 'PREFETCH_TTL', 600)  # Giây
+        self._prefetch_executor: Optional[ThreadPoolExecutor] = None
+        # thread_id -> (url, thời điểm submit, Future[(media_items, csrf_token)])
+        self._prefetch_futures: Dict[int, Tuple[str, float, Future]] = {}
+        self._pipeline = None  # PipelineEngine khi chạy run_pipeline
+        self._active_jobs = 0  # Số job đang chạy ở chế độ tuần tự (0 hoặc 1)
+        self.profiler = None  # JobProfiler khi chạy với --profile (scraper/profiling.py)
+        
+        # Metrics cho Prometheus (bật bằng enable_metrics)
+        self.metrics = None
+        self._metrics_server = None
+        self._metrics_file: Optional[str] = None
+        self._metrics_file_stop = None
+        
+        # Span HTTP cho job_timings và metrics (không tốn gì khi cả hai đều tắt)
+        install_http_timing(session)
+        
+        # Đo thời gian từng stage + từng HTTP request, ghi vào bảng job_timings (xem `perf`)
+        if getattr(config, 'JOB_TIMINGS', True):
+            set_recorder(TimingRecorder(db_manager))
+            retention_days = getattr(config, 'JOB_TIMINGS_RETENTION_DAYS', 30)
+            if retention_days:
+                db_manager.prune_job_timings(time.time() - retention_days * 86400)
+    
+    def enable_metrics(self, port: Optional[int] = None, file_path: Optional[str] = None):
+        """
+        Bật metrics (Prometheus text format): phục vụ qua HTTP tại `port` và/hoặc ghi định kỳ ra `file_path`.
+        
+        Nếu không mở được port, metrics được ghi ra file (mặc định config.METRICS_FILE).
+        
+        Args:
+            port: Port của endpoint /metrics (None = không mở)
+            file_path: File metrics được ghi lại mỗi config.METRICS_FILE_INTERVAL giây
+        """
+        from queue_system.metrics import WorkerMetrics, start_metrics_server, start_metrics_file_writer
+        
+        metrics = WorkerMetrics()
+        metrics.add_collector(
+            'fuo_queue_depth', 'gauge', 'Số threads trong library theo status (từ queue_counters)',
+            lambda: {(('status', status),): count for status, count in self.queue_manager.get_queue_stats().items()}
+        )
+        metrics.add_collector(
+            'fuo_jobs_in_progress', 'gauge', 'Số job đang được xử lý đồng thời',
+            lambda: {(): self._pipeline.inflight if self._pipeline is not None else self._active_jobs}
+        )
+        metrics.add_collector(
+            'fuo_rate_limit_wait_seconds_total', 'counter', 'Tổng thời gian chờ rate limiter (giây)',
+            lambda: {(): round(get_total_wait(self.session), 6)}
+        )
+        self.metrics = metrics
+        
+        if port is not None:
+            try:
+                self._metrics_server = start_metrics_server(metrics, port)
+                print(f"[WORKER] Metrics: http://localhost:{self._metrics_server.server_address[1]}/metrics")
+            except OSError as e:
+                file_path = file_path or getattr(config, 'METRICS_FILE', 'worker_metrics.prom')
+                print(f"[WORKER] (!) Không mở được port {port} cho metrics ({e}), ghi ra file thay thế")
+        
+        if file_path:
+            self._metrics_file = file_path
+            self._metrics_file_stop = start_metrics_file_writer(
+                metrics, file_path, getattr(config, 'METRICS_FILE_INTERVAL', 15)
+            )
+            print(f"[WORKER] Metrics được ghi vào: {file_path}")
+    
+    def _shutdown_metrics(self):
+        """Tắt endpoint metrics và ghi file metrics lần cuối."""
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+            self._metrics_server = None
+        if self._metrics_file_stop is not None:
+            self._metrics_file_stop.set()
+            self._metrics_file_stop = None
+            try:
+                self.metrics.write_file(self._metrics_file)
+            except OSError:
+                pass
+    
+    def _count_job(self, outcome: str):
+        if self.metrics is not None:
+            self.metrics.job_finished(outcome)
+    
+    def _prefetch_upcoming(self, current_thread_id: int):
+        """
+        Tải trước trang thread của các job pending tiếp theo trong luồng nền.
+        
+        Chỉ đọc (không đổi status thread); request đi qua rate limiter chung của session
+        nên không vượt quá DELAY_BETWEEN_REQUESTS dù chạy song song với job hiện tại.
+        
+        Args:
+            current_thread_id: ID của thread đang xử lý (không prefetch)
+        """
+        if self.prefetch_count <= 0:
+            return
+        
+        upcoming = [
+            thread for thread in self.queue_manager.get_pending_threads(self.prefetch_count + 1)
+            if thread.id != current_thread_id
+        ][:self.prefetch_count]
+        upcoming_ids = {thread.id for thread in upcoming}
+        
+        # Bỏ các kết quả không còn cần (thread đã bị xử lý/xóa khỏi queue, hoặc quá cũ)
+        now = time.time()
+        for thread_id, (_, submitted_at, future) in list(self._prefetch_futures.items()):
+            if thread_id not in upcoming_ids or now - submitted_at > self.prefetch_ttl:
+                future.cancel()
+                del self._prefetch_futures[thread_id]
+        
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        
+        for thread in upcoming:
+            if thread.id not in self._prefetch_futures:
+                rate_limiter = thread_rate_limiter(self.session, self.queue_manager.build_thread_info(thread))
+                future = self._prefetch_executor.submit(
+                    bind_job(thread.id, extract_media_ids_from_thread), self.session, thread.url, rate_limiter
+                )
+                self._prefetch_futures[thread.id] = (thread.url, now, future)
+    
+    def _take_prefetched(self, thread: Thread) -> Optional[Tuple[List[Dict], Optional[str]]]:
+        """
+        Lấy kết quả prefetch của thread (nếu có và còn hợp lệ).
+        
+        Returns:
+            Tuple (media_items, csrf_token), hoặc None nếu phải tải lại trang thread
+        """
+        entry = self._prefetch_futures.pop(thread.id, None)
+        if not entry:
+            return None
+        
+        url, submitted_at, future = entry
+        if url != thread.url or time.time() - submitted_at > self.prefetch_ttl:
+            future.cancel()
+            return None
+        
+        try:
+            # Nếu prefetch vẫn đang chạy thì đợi luôn thay vì gửi request trùng
+            media_items, csrf_token = future.result()
+        except Exception:
+            return None
+        
+        return (media_items, csrf_token) if media_items else None
+    
+    def _shutdown_prefetch(self):
+        """Hủy các prefetch đang chờ và dừng luồng nền."""
+        for _, _, future in self._prefetch_futures.values():
+            future.cancel()
+        self._prefetch_futures.clear()
+        if self._prefetch_executor is not None:
+            self._prefetch_executor.shutdown(wait=False)
+            self._prefetch_executor = None
+    
+    def persist_result(self, thread: Thread, result: dict):
+        """
+        Stage persist: lưu kết quả scrape vào DB và cập nhật status của thread.
+        
+        Args:
+            thread: Thread vừa xử lý
+            result: Dict kết quả từ download_images_with_comments_from_thread
+                (hoặc từ pipeline)
+        """
+        if result['success']:
+            # Lưu media items vào DB nếu chưa được lưu trước khi render
+            # (số câu hỏi đổi nội dung -> lịch kiểm tra lại của `watch`)
+            content_changes = result.get('content_changes', 0)
+            if result.get('media_items_data'):
+                content_changes += self.db.save_media_items(thread.id, result['media_items_data'])
+            
+            # Ghi lại các media items lỗi (để `retry --items` chỉ cào lại những item này)
+            failed_items = result.get('failed_items', [])
+            self.db.save_failed_items(thread.id, failed_items)
+            
+            # Update thread status = completed (hoặc partial nếu thiếu media items)
+            if failed_items:
+                status = ThreadStatus.PARTIAL
+                error_msg = f"Thiếu {len(failed_items)} media items (xem: python main.py show {thread.id})"
+            else:
+                status = ThreadStatus.COMPLETED
+                error_msg = None
+            
+            self.queue_manager.update_thread_status(
+                thread.id,
+                status,
+                error_message=error_msg,
+                folder_path=result['folder_path'],
+                pdf_path=result['pdf_path'],
+                total_questions=result['total_questions']
+            )
+            self.queue_manager.record_check(thread.id, changed=content_changes > 0)
+            self._count_job(status.value)
+            
+            # Lưu thống kê dung lượng để `du`/`show` không phải duyệt lại ổ đĩa
+            stats = scan_thread_folder(get_absolute_path(result['folder_path']))
+            self.queue_manager.library.save_storage_stats([(thread.id, stats)])
+            
+            # Vượt STORAGE_BUDGET_GB -> xóa ảnh gốc của các threads ít dùng nhất (PDF vẫn giữ)
+            report = enforce_storage_budget(self.db, self.queue_manager.library)
+            if report and report['evicted']:
+                print(f"[WORKER]   - Đã giải phóng ảnh gốc của {len(report['evicted'])} thread(s) "
+                      f"để nằm trong giới hạn dung lượng")
+            
+            if failed_items:
+                print(f"\n[WORKER] ~ Hoàn thành một phần: {thread.title}")
+                print(f"[WORKER]   - Media items lỗi: {len(failed_items)}")
+            else:
+                print(f"\n[WORKER] ✓ Hoàn thành: {thread.title}")
+            print(f"[WORKER]   - Câu hỏi: {result['total_questions']}")
+            print(f"[WORKER]   - Folder: {result['folder_path']}")
+            if result['pdf_path']:
+                print(f"[WORKER]   - PDF: {result['pdf_path']}")
+        else:
+            error_msg = result.get('error', 'Unknown error')
+            print(f"\n[WORKER] ✗ Thất bại: {thread.title}")
+            print(f"[WORKER]   Lỗi: {error_msg}")
+            self._schedule_retry(thread, error_msg)
+    
+    def _schedule_retry(self, thread: Thread, error_msg: str):
+        """Lên lịch retry (backoff qua not_before) hoặc đánh dấu failed nếu hết lượt."""
+        delay = self.queue_manager.schedule_retry(thread.id, error_msg)
+        self._count_job('failed' if delay is None else 'retry')
+        if delay is None:
+            print(f"[WORKER]   -> Đã hết số lần retry, status = failed")
+        else:
+            print(f"[WORKER]   -> Sẽ retry sau {delay:.0f}s")
     
     def process_queue_once(self) -> bool:
         """
@@ -32,73 +270,49 @@ class QueueWorker:
         Returns:
             True nếu có thread được xử lý, False nếu queue rỗng
         """
-        thread = self.queue_manager.get_next_pending()
+        # Lấy thread và chuyển sang processing trong cùng một transaction
+        thread = self.queue_manager.claim_next_pending()
         
         if not thread:
             return False
         
+        self._active_jobs = 1
         try:
-            # Update status = processing
-            self.queue_manager.update_thread_status(thread.id, ThreadStatus.PROCESSING)
-            
             print(f"\n{'='*60}")
             print(f"[WORKER] Xử lý thread: {thread.title}")
             print(f"[WORKER] URL: {thread.url}")
             print(f"[WORKER] ID: {thread.id}")
             print(f"{'='*60}")
             
-            # Chuẩn bị thread_info dict cho hàm scraper
-            thread_info = {
-                'url': thread.url,
-                'title': thread.title
-            }
+            # Chuẩn bị thread_info dict cho hàm scraper (kèm base URL / rate budget của forum)
+            thread_info = self.queue_manager.build_thread_info(thread)
             
-            # Gọi hàm scrape (refactored, return dict)
-            result = download_images_with_comments_from_thread(self.session, thread_info, thread.id)
+            # Dùng kết quả prefetch (nếu có) rồi bắt đầu prefetch các job tiếp theo,
+            # để việc tải trang thread của chúng chạy song song với job này
+            prefetched = self._take_prefetched(thread)
+            self._prefetch_upcoming(thread.id)
             
-            if result['success']:
-                # Lưu media items vào DB
-                if result.get('media_items_data'):
-                    self.db.save_media_items(thread.id, result['media_items_data'])
-                
-                # Update thread status = completed
-                self.queue_manager.update_thread_status(
-                    thread.id,
-                    ThreadStatus.COMPLETED,
-                    folder_path=result['folder_path'],
-                    pdf_path=result['pdf_path'],
-                    total_questions=result['total_questions']
+            profiling = self.profiler.profile(thread.id) if self.profiler else nullcontext()
+            with profiling, job_context(thread.id), span('job'):
+                # Gọi hàm scrape (refactored, return dict)
+                result = download_images_with_comments_from_thread(
+                    self.session, thread_info, thread.id, db_manager=self.db, prefetched=prefetched
                 )
                 
-                print(f"\n[WORKER] ✓ Hoàn thành: {thread.title}")
-                print(f"[WORKER]   - Câu hỏi: {result['total_questions']}")
-                print(f"[WORKER]   - Folder: {result['folder_path']}")
-                if result['pdf_path']:
-                    print(f"[WORKER]   - PDF: {result['pdf_path']}")
-            else:
-                # Update status = failed
-                error_msg = result.get('error', 'Unknown error')
-                self.queue_manager.update_thread_status(
-                    thread.id,
-                    ThreadStatus.FAILED,
-                    error_message=error_msg
-                )
-                
-                print(f"\n[WORKER] ✗ Thất bại: {thread.title}")
-                print(f"[WORKER]   Lỗi: {error_msg}")
+                with span('persist'):
+                    self.persist_result(thread, result)
             
             return True
             
         except Exception as e:
-            # Update status = failed
-            self.queue_manager.update_thread_status(
-                thread.id,
-                ThreadStatus.FAILED,
-                error_message=str(e)
-            )
-            
             print(f"\n[WORKER] ✗ Exception: {e}")
+            self._schedule_retry(thread, str(e))
             return True  # Đã xử lý (dù thất bại)
+        finally:
+            self._active_jobs = 0
+            recorder = get_recorder()
+            if recorder is not None:
+                recorder.flush()
     
     def run_loop(self, stop_on_empty: bool = False):
         """
@@ -135,7 +349,14 @@ class QueueWorker:
                 processed = self.process_queue_once()
                 
                 if not processed:
-                    # Không có thread nào, nghỉ một chút
+                    # Các thread pending đều đang chờ lịch retry (not_before)
+                    next_due = self.queue_manager.get_next_due_time()
+                    wait = max(0, next_due - time.time()) if next_due else 0
+                    if stop_on_empty:
+                        print(f"\n[WORKER] Không còn thread nào đến hạn "
+                              f"(thread tiếp theo sau {wait:.0f}s). Dừng worker.")
+                        break
+                    print(f"\n[WORKER] Chưa có thread nào đến hạn. Đợi {self.sleep_interval}s...")
                     time.sleep(self.sleep_interval)
                 
         except KeyboardInterrupt:
@@ -144,10 +365,55 @@ class QueueWorker:
         except Exception as e:
             print(f"\n[WORKER] Lỗi trong worker loop: {e}")
             self.is_running = False
+        finally:
+            self._shutdown_prefetch()
+            self._shutdown_metrics()
+        
+        print("\n[WORKER] Worker đã dừng.")
+    
+    def run_pipeline(
+        self,
+        stop_on_empty: bool = False,
+        io_workers: Optional[int] = None,
+        render_workers: Optional[int] = None
+    ):
+        """
+        Chạy worker ở chế độ pipeline: discover → fetch/download → render → persist
+        chạy song song giữa nhiều thread (xem queue_system/pipeline.py).
+        
+        Args:
+            stop_on_empty: Nếu True, dừng khi queue rỗng và các job đang chạy đã xong.
+            io_workers: Số luồng I/O cho fetch + download (None = config.PIPELINE_IO_WORKERS)
+            render_workers: Số process render PDF (None = config.PIPELINE_RENDER_WORKERS)
+        """
+        from queue_system.pipeline import PipelineEngine
+        
+        if self.profiler is not None:
+            # Các stage chạy trên nhiều luồng/process, không gắn được profile với từng job
+            print("[WORKER] (!) --profile chỉ hỗ trợ worker tuần tự, bỏ qua khi chạy --pipeline")
+        
+        self.is_running = True
+        engine = PipelineEngine(
+            self.db,
+            self.session,
+            persist=self.persist_result,
+            io_workers=io_workers,
+            render_workers=render_workers,
+            sleep_interval=self.sleep_interval
+        )
+        self._pipeline = engine
+        try:
+            engine.run(stop_on_empty=stop_on_empty)
+        finally:
+            self._pipeline = None
+            self.is_running = False
+            self._shutdown_metrics()
         
         print("\n[WORKER] Worker đã dừng.")
     
     def stop(self):
         """Dừng worker"""
         self.is_running = False
+        if self._pipeline is not None:
+            self._pipeline.stop()
 
@@ -0,0 +1,182 @@
+# scraper/cassette.py
+
+import io
+import gzip
+import json
+import time
+import base64
+import threading
+from collections import defaultdict, deque
+from typing import Dict, Optional, Tuple
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# Header không ghi vào cassette (chứa cookie/phiên đăng nhập)
+SENSITIVE_HEADERS = {'cookie', 'set-cookie', 'authorization'}
+
+# Header của response bị bỏ khi ghi: body trong cassette đã được giải nén
+_HOP_HEADERS = {'content-encoding', 'transfer-encoding', 'content-length', 'connection'}
+
+# Content-Type có thể lưu dạng text
+_TEXT_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml')
+
+def _interaction_key(method: str, url: str, headers) -> Tuple[str, str, str]:
+    """Khóa để khớp request khi replay: method + URL + Range (tải tiếp file dở)."""
+    return method.upper(), url, headers.get('Range', '') if headers else ''
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Transport adapter ghi lại mọi request/response đi qua session vào cassette
+    (file JSON Lines nén gzip, mỗi dòng một interaction, ghi ngay khi có response).
+    """
+    
+    def __init__(self, path: str, **kwargs):
+        """
+        Args:
+            path: Đường dẫn file cassette (ghi nối tiếp nếu đã tồn tại)
+        """
+        super().__init__(**kwargs)
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+    
+    def send(self, request, **kwargs):
+        start = time.monotonic()
+        response = super().send(request, **kwargs)
+        # Đọc hết body (kể cả khi stream=True) để ghi lại; iter_content vẫn dùng được sau đó
+        body = response.content
+        elapsed = time.monotonic() - start
+        
+        # Text được lưu nguyên dạng UTF-8 cho dễ đọc/sửa tay, còn lại (ảnh...) lưu base64
+        text = None
+        if response.headers.get('Content-Type', '').startswith(_TEXT_TYPES):
+            try:
+                text = body.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        request_body = request.body.decode('utf-8', 'replace') if isinstance(request.body, bytes) else request.body
+        interaction = {
+            'method': request.method,
+            'url': request.url,
+            'request_headers': {k: v for k, v in request.headers.items() if k.lower() not in SENSITIVE_HEADERS},
+            'request_body': request_body,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {
+                k: v for k, v in response.headers.items()
+                if k.lower() not in SENSITIVE_HEADERS and k.lower() not in _HOP_HEADERS
+            },
+            'body': text if text is not None else base64.b64encode(body).decode('ascii'),
+            'encoding': 'text' if text is not None else 'base64',
+            'elapsed': round(elapsed, 4)
+        }
+        line = json.dumps(interaction, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            # Mỗi lần ghi là một gzip member: file vẫn đọc được nếu job bị ngắt giữa chừng
+            with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                f.write(line)
+            self.count += 1
+        return response
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport adapter trả response từ cassette thay vì gọi mạng.
+    
+    Request được khớp theo method + URL (+ Range); nhiều response cùng khóa được trả
+    lần lượt theo thứ tự đã ghi, hết thì lặp lại response cuối.
+    """
+    
+    def __init__(self, path: str, latency: float = 1.0):
+        """
+        Args:
+            path: Đường dẫn file cassette
+            latency: Hệ số độ trễ so với lúc ghi (1 = như thật, 0 = trả ngay)
+        """
+        super().__init__()
+        self.latency = max(0.0, latency)
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._interactions: Dict[Tuple[str, str, str], deque] = defaultdict(deque)
+        self._last: Dict[Tuple[str, str, str], dict] = {}
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    interaction = json.loads(line)
+                    key = _interaction_key(
+                        interaction['method'], interaction['url'], interaction.get('request_headers')
+                    )
+                    self._interactions[key].append(interaction)
+    
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._interactions.values())
+    
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        key = _interaction_key(request.method, request.url, request.headers)
+        with self._lock:
+            queue = self._interactions.get(key)
+            if queue:
+                interaction = queue.popleft()
+                self._last[key] = interaction
+            else:
+                interaction = self._last.get(key)
+            if interaction is None:
+                self.misses += 1
+        if interaction is None:
+            raise requests.exceptions.ConnectionError(
+                f"Không có response trong cassette cho {request.method} {request.url}", request=request
+            )
+        
+        if self.latency and interaction.get('elapsed'):
+            time.sleep(interaction['elapsed'] * self.latency)
+        
+        if interaction['encoding'] == 'base64':
+            body = base64.b64decode(interaction['body'])
+        else:
+            body = interaction['body'].encode('utf-8')
+        
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.reason = interaction.get('reason')
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        response.headers['Content-Length'] = str(len(body))
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.raw = io.BytesIO(body)
+        # Body đã có sẵn: iter_content() (stream=True) sẽ cắt từ _content
+        response._content = body
+        response._content_consumed = True
+        return response
+    
+    def close(self):
+        pass
+
+def install_cassette(
+    session: requests.Session,
+    record: Optional[str] = None,
+    replay: Optional[str] = None,
+    latency: float = 1.0
+) -> Optional[BaseAdapter]:
+    """
+    Gắn adapter record/replay vào session (áp dụng cho mọi request http/https của session).
+    
+    Args:
+        session: requests.Session dùng cho scraper
+        record: Ghi mọi request/response vào file cassette này
+        replay: Trả response từ file cassette này thay vì gọi mạng
+        latency: Hệ số độ trễ khi replay (1 = như lúc ghi, 0 = không chờ)
+    
+    Returns:
+        Adapter đã gắn, None nếu không bật chế độ nào
+    """
+    if replay:
+        adapter = ReplayAdapter(replay, latency=latency)
+    elif record:
+        adapter = RecordingAdapter(record)
+    else:
+        return None
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return adapter
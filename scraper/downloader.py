@@ -0,0 +1,182 @@
+# scraper/downloader.py
+
+import os
+import hashlib
+import requests
+from typing import Optional, Dict
+from PIL import Image
+import config
+
+# Kích thước chunk mặc định khi stream ảnh (có thể override bằng config.DOWNLOAD_CHUNK_SIZE)
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Hậu tố của file tạm trong lúc đang tải
+PARTIAL_SUFFIX = '.part'
+
+class DownloadError(Exception):
+    """
+    Lỗi khi tải file (thiếu byte, ảnh không hợp lệ...).
+    
+    Attributes:
+        transient: True nếu tải lại có thể thành công (vd: tải thiếu byte)
+    """
+    
+    def __init__(self, message: str, transient: bool = False):
+        super().__init__(message)
+        self.transient = transient
+
+def get_chunk_size() -> int:
+    """Lấy chunk size từ config (bytes), fallback về DEFAULT_CHUNK_SIZE."""
+    chunk_size = getattr(config, 'DOWNLOAD_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    try:
+        chunk_size = int(chunk_size)
+    except (TypeError, ValueError):
+        return DEFAULT_CHUNK_SIZE
+    return chunk_size if chunk_size > 0 else DEFAULT_CHUNK_SIZE
+
+def is_valid_image(path: str) -> bool:
+    """
+    Kiểm tra nhanh header ảnh bằng Pillow (không decode toàn bộ ảnh).
+    
+    Args:
+        path: Đường dẫn file ảnh
+    
+    Returns:
+        True nếu Pillow nhận diện được format và kích thước ảnh
+    """
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+            return bool(img.format) and width > 0 and height > 0
+    except Exception:
+        return False
+
+def file_sha256(path: str, chunk_size: Optional[int] = None) -> str:
+    """Tính SHA-256 của một file đã có trên đĩa."""
+    chunk_size = chunk_size or get_chunk_size()
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def _expected_total_size(response: requests.Response, resume_from: int) -> Optional[int]:
+    """
+    Tính tổng kích thước file mong đợi từ Content-Range (206) hoặc Content-Length (200).
+    
+    Returns:
+        Tổng số bytes của file hoàn chỉnh, None nếu server không cho biết
+    """
+    if response.status_code == 206:
+        content_range = response.headers.get('Content-Range', '')
+        # Format: bytes 1000-1999/2000
+        if '/' in content_range:
+            total = content_range.rsplit('/', 1)[1].strip()
+            if total.isdigit():
+                return int(total)
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit():
+            return resume_from + int(content_length)
+        return None
+    
+    content_length = response.headers.get('Content-Length')
+    # Nếu server nén (gzip...), Content-Length là kích thước sau nén -> không dùng để so sánh
+    if content_length and content_length.isdigit() and not response.headers.get('Content-Encoding'):
+        return int(content_length)
+    return None
+
+def download_file(
+    session: requests.Session,
+    url: str,
+    save_path: str,
+    headers: Optional[Dict[str, str]] = None,
+    timeout: int = 20,
+    chunk_size: Optional[int] = None,
+    validate_image: bool = True
+) -> Dict:
+    """
+    Tải file về save_path một cách an toàn (atomic).
+    
+    - Ghi vào file tạm `save_path + '.part'`, chỉ rename sang save_path khi đã hoàn tất.
+    - Nếu file tạm đã có từ lần tải trước bị ngắt, tiếp tục tải bằng HTTP Range
+      (nếu server trả 206), ngược lại tải lại từ đầu.
+    - Kiểm tra số bytes với Content-Length và header ảnh bằng Pillow trước khi rename.
+    
+    Args:
+        session: requests.Session với cookies
+        url: URL của file cần tải
+        save_path: Đường dẫn file đích
+        headers: Headers bổ sung cho request (Referer...)
+        timeout: Timeout cho request (giây)
+        chunk_size: Kích thước chunk (None = lấy từ config)
+        validate_image: Có kiểm tra header ảnh bằng Pillow hay không
+    
+    Returns:
+        Dict chứa 'path', 'size' (bytes), 'sha256' và 'resumed' (bool)
+    
+    Raises:
+        DownloadError: Nếu file tải về không hoàn chỉnh hoặc không phải ảnh hợp lệ
+        requests.exceptions.RequestException: Lỗi kết nối/HTTP
+    """
+    chunk_size = chunk_size or get_chunk_size()
+    part_path = save_path + PARTIAL_SUFFIX
+    request_headers = dict(headers) if headers else {}
+    
+    resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if resume_from > 0:
+        request_headers['Range'] = f"bytes={resume_from}-"
+    
+    response = session.get(url, headers=request_headers, timeout=timeout, stream=True)
+    try:
+        if response.status_code == 416 and resume_from > 0:
+            # Range không hợp lệ (file tạm lớn hơn file trên server) -> tải lại từ đầu
+            response.close()
+            os.remove(part_path)
+            request_headers.pop('Range', None)
+            resume_from = 0
+            response = session.get(url, headers=request_headers, timeout=timeout, stream=True)
+        
+        response.raise_for_status()
+        
+        resumed = resume_from > 0 and response.status_code == 206
+        if not resumed:
+            # Server không hỗ trợ Range (trả 200) -> ghi đè từ đầu
+            resume_from = 0
+        
+        expected_size = _expected_total_size(response, resume_from)
+        
+        sha256 = hashlib.sha256()
+        if resumed:
+            # Hash phần đã tải trước đó để có checksum của toàn bộ file
+            with open(part_path, 'rb') as f:
+                for block in iter(lambda: f.read(chunk_size), b''):
+                    sha256.update(block)
+        
+        size = resume_from
+        with open(part_path, 'ab' if resumed else 'wb') as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+    finally:
+        response.close()
+    
+    if expected_size is not None and size != expected_size:
+        if size > expected_size:
+            # File tạm không khớp với server -> bỏ để lần sau tải lại từ đầu
+            os.remove(part_path)
+        raise DownloadError(f"Tải thiếu dữ liệu: {size}/{expected_size} bytes ({url})", transient=True)
+    
+    if validate_image and not is_valid_image(part_path):
+        os.remove(part_path)
+        raise DownloadError(f"File tải về không phải ảnh hợp lệ ({url})")
+    
+    os.replace(part_path, save_path)
+    
+    return {
+        'path': save_path,
+        'size': size,
+        'sha256': sha256.hexdigest(),
+        'resumed': resumed
+    }
@@ -2,11 +2,33 @@
 
 import re
 import json
+import threading
+import weakref
+import contextvars
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlencode
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, Iterable, List, Tuple
 import config
+from scraper.retry import ItemFetchError, PERMANENT, classify_exception, call_with_retry
+from scraper.rate_limiter import RateLimiter, get_rate_limiter
+from scraper.timing import span
+from library.thread_utils import get_base_url
+
+# Selector của nội dung comment, thử lần lượt (selector đầu tiên có kết quả được dùng)
+COMMENT_SELECTORS = (
+    '.comment-body .bbWrapper',
+    '.comment-content .bbWrapper',
+    '.message-body .bbWrapper',
+    '.comment .bbWrapper'
+)
+
+# ID của comment trên khung chứa nó: data-content="xfmg-comment-123" / id="js-comment-123"
+_COMMENT_ID = re.compile(r'comment-(\d+)')
+
+# Số trang trong link phân trang: .../page-3 hoặc ...?page=3
+_PAGE_NUMBER = re.compile(r'/page-(\d+)|[?&]page=(\d+)')
 
 
 def get_csrf_token(soup: BeautifulSoup) -> Optional[str]:
@@ -32,19 +54,123 @@ def get_csrf_token(soup: BeautifulSoup) -> Optional[str]:
     return None
 
 
-def extract_media_ids_from_thread(session: requests.Session, thread_url: str) -> Tuple[List[Dict[str, str]], Optional[str]]:
+class CsrfTokenManager:
+    """
+    Quản lý CSRF token (_xfToken) ở mức session.
+    
+    Token được cache và dùng lại cho các thread liên tiếp. Khi API trả 400 do token
+    hết hạn, chỉ một request duy nhất được gửi để lấy token mới (single-flight),
+    các luồng khác gặp lỗi cùng lúc sẽ đợi và dùng lại token mới đó.
+    """
+    
+    def __init__(self, session: requests.Session):
+        """
+        Args:
+            session: requests.Session với cookies đã được cấu hình
+        """
+        self._session = weakref.ref(session)
+        self._lock = threading.Lock()
+        self.token: Optional[str] = None
+        self.refresh_count = 0
+    
+    def current(self, fallback: Optional[str] = None) -> Optional[str]:
+        """Trả về token đang cache, hoặc fallback (và cache lại) nếu chưa có."""
+        if self.token is None and fallback:
+            self.token = fallback
+        return self.token or fallback
+    
+    def update(self, token: Optional[str]):
+        """Cập nhật token mới lấy được từ một trang HTML (vd: trang thread)."""
+        if token:
+            self.token = token
+    
+    def refresh(
+        self,
+        stale_token: Optional[str],
+        refresh_url: str,
+        rate_limiter: Optional[RateLimiter] = None
+    ) -> Optional[str]:
+        """
+        Lấy token mới sau khi stale_token bị server từ chối.
+        
+        Args:
+            stale_token: Token vừa bị từ chối (400), None nếu request được gửi không có token
+            refresh_url: URL của một trang nhẹ để đọc token mới
+            rate_limiter: Limiter phải chờ trước request lấy token (optional)
+        
+        Returns:
+            Token mới, hoặc None nếu không lấy được
+        """
+        with self._lock:
+            # Luồng khác đã làm mới token trong lúc chờ lock -> dùng luôn
+            if self.token and self.token != stale_token:
+                return self.token
+            
+            session = self._session()
+            if session is None:
+                return None
+            
+            try:
+                if rate_limiter is not None:
+                    rate_limiter.wait()
+                response = session.get(refresh_url, timeout=15)
+                response.raise_for_status()
+                new_token = get_csrf_token(BeautifulSoup(response.text, 'html.parser'))
+            except requests.exceptions.RequestException as e:
+                print(f"    (!) Không làm mới được CSRF token: {e}")
+                return None
+            
+            if new_token:
+                self.token = new_token
+                self.refresh_count += 1
+            return new_token
+
+
+# Token của XenForo gắn với site: mỗi session có một manager cho từng base URL
+_token_managers: "weakref.WeakKeyDictionary[requests.Session, Dict[str, CsrfTokenManager]]" = weakref.WeakKeyDictionary()
+_token_managers_lock = threading.Lock()
+
+
+def get_token_manager(session: requests.Session, base_url: Optional[str] = None) -> CsrfTokenManager:
+    """Lấy CsrfTokenManager gắn với session và site `base_url` (mặc định: site của config.FORUM_URL)."""
+    key = (base_url or get_base_url()).rstrip('/')
+    with _token_managers_lock:
+        managers = _token_managers.get(session)
+        if managers is None:
+            managers = _token_managers[session] = {}
+        manager = managers.get(key)
+        if manager is None:
+            manager = managers[key] = CsrfTokenManager(session)
+        return manager
+
+
+def extract_media_ids_from_thread(
+    session: requests.Session,
+    thread_url: str,
+    rate_limiter: Optional[RateLimiter] = None
+) -> Tuple[List[Dict[str, str]], Optional[str]]:
     """
     Trích xuất danh sách Media IDs từ trang thread và CSRF token.
     Trả về tuple: (list các dict chứa media_id, media_url, filename, csrf_token).
+    
+    Args:
+        session: requests.Session với cookies đã được cấu hình
+        thread_url: URL của thread (media URL được ghép với base URL của chính thread này)
+        rate_limiter: Limiter của site chứa thread (mặc định: limiter chung của session)
     """
+    base_url = get_base_url(thread_url)
     try:
+        (rate_limiter or get_rate_limiter(session)).wait()
         response = session.get(thread_url, timeout=15)
         response.raise_for_status()
         
         soup = BeautifulSoup(response.text, 'html.parser')
         
-        # Lấy CSRF token từ trang thread
+        # Lấy CSRF token từ trang thread (fallback: token đã cache của session)
+        token_manager = get_token_manager(session, base_url)
         csrf_token = get_csrf_token(soup)
+        token_manager.update(csrf_token)
+        csrf_token = token_manager.current(csrf_token)
         
         # Tìm tất cả các link có chứa /media/ hoặc có data-lb-sidebar-href
         media_items = []
@@ -58,10 +184,6 @@ def extract_media_ids_from_thread(session: requests.Session, thread_url: str) ->
                 match = re.search(r'/media/[^/]+\.(\d+)/', sidebar_href)
                 if match:
                     media_id = match.group(1)
-                    base_url = config.FORUM_URL.split('/forums/')[0] if '/forums/' in config.FORUM_URL else config.FORUM_URL
-                    base_url = base_url.split('/threads/')[0] if '/threads/' in base_url else base_url
-                    if not base_url.startswith('http'):
-                        base_url = 'https://fuoverflow.com'
                     media_url = urljoin(base_url, sidebar_href.split('?')[0])
                     
                     # Lấy tên file từ link hoặc span
@@ -76,6 +198,7 @@ def extract_media_ids_from_thread(session: requests.Session, thread_url: str) ->
         
         # Phương pháp 2: Tìm qua attachmentList (fallback)
         if not media_items:
+            seen_ids = set()
             attachment_links = soup.select('ul.attachmentList a.file-preview.js-lbImage')
             for link in attachment_links:
                 href = link.get('href', '')
@@ -83,16 +206,13 @@ def extract_media_ids_from_thread(session: requests.Session, thread_url: str) ->
                     match = re.search(r'/media/[^/]+\.(\d+)/', href)
                     if match:
                         media_id = match.group(1)
-                        base_url = config.FORUM_URL.split('/forums/')[0] if '/forums/' in config.FORUM_URL else config.FORUM_URL
-                        base_url = base_url.split('/threads/')[0] if '/threads/' in base_url else base_url
-                        if not base_url.startswith('http'):
-                            base_url = 'https://fuoverflow.com'
                         media_url = urljoin(base_url, href.split('?')[0])
                         filename_span = link.find('span', class_='file-name')
                         filename = filename_span.text.strip() if filename_span else f"media_{media_id}"
                         
                         # Tránh trùng lặp
-                        if not any(item['media_id'] == media_id for item in media_items):
+                        if media_id not in seen_ids:
+                            seen_ids.add(media_id)
                             media_items.append({
                                 'media_id': media_id,
                                 'media_url': media_url,
@@ -106,32 +226,174 @@ def extract_media_ids_from_thread(session: requests.Session, thread_url: str) ->
         return [], None
 
 
-def get_media_data_from_json_api(session: requests.Session, media_id: str, csrf_token: Optional[str] = None) -> Optional[Dict]:
+def _comment_id(tag) -> Optional[str]:
+    """ID của comment chứa tag (từ data-content / id của khung comment), None nếu không có."""
+    for parent in tag.parents:
+        for attr in ('data-content', 'id'):
+            match = _COMMENT_ID.search(parent.get(attr) or '')
+            if match:
+                return match.group(1)
+    return None
+
+
+def parse_comments(soup: BeautifulSoup) -> List[Tuple[Optional[str], str]]:
+    """
+    Lấy các comments trong một trang theo thứ tự.
+    
+    Returns:
+        List (comment ID hoặc None, nội dung). Các comment cùng nội dung (vd: nhiều người
+        cùng trả lời "A") đều được giữ, vì mỗi comment là một phiếu của answer consensus.
+    """
+    for selector in COMMENT_SELECTORS:
+        comment_tags = soup.select(selector)
+        if comment_tags:
+            comments = []
+            for tag in comment_tags:
+                text = tag.get_text(strip=True)
+                if text:
+                    comments.append((_comment_id(tag), text))
+            return comments
+    return []
+
+
+def merge_comments(*pages: Iterable[Tuple[Optional[str], str]]) -> List[str]:
+    """
+    Gộp comments của các trang theo thứ tự. Chỉ bỏ comment trùng ID (comment bị đẩy sang
+    trang sau trong lúc tải song song); không so nội dung.
+    """
+    seen_ids = set()
+    merged = []
+    for page in pages:
+        for comment_id, text in page:
+            if comment_id is not None:
+                if comment_id in seen_ids:
+                    continue
+                seen_ids.add(comment_id)
+            merged.append(text)
+    return merged
+
+
+def parse_comment_count(soup: BeautifulSoup) -> Optional[int]:
+    """
+    Tổng số comments mà forum hiển thị trong phần thông tin media (vd: <dt>Comments</dt><dd>12</dd>),
+    None nếu trang không có.
+    """
+    for dt in soup.select('dl.pairs dt'):
+        if dt.get_text(strip=True).lower() in ('comments', 'bình luận'):
+            dd = dt.find_next_sibling('dd')
+            digits = re.sub(r'[^\d]', '', dd.get_text()) if dd else ''
+            if digits:
+                return int(digits)
+    return None
+
+
+def find_comment_pages(soup: BeautifulSoup, page_url: str) -> List[str]:
+    """
+    URL các trang comments tiếp theo (trang 2..N) từ thanh phân trang của trang đầu.
+    
+    Thanh phân trang của XenForo chỉ hiện vài trang quanh trang hiện tại và trang cuối,
+    nên URL của các trang bị ẩn được tạo từ link của một trang khác.
+    
+    Returns:
+        List URL theo thứ tự trang, rỗng nếu comments không bị phân trang
+    """
+    links: Dict[int, str] = {}
+    template = None
+    for link in soup.select('.pageNav a[href], .pageNavSimple a[href]'):
+        match = _PAGE_NUMBER.search(link['href'])
+        if match:
+            group = 1 if match.group(1) else 2
+            links[int(match.group(group))] = link['href']
+            template = (link['href'], match.start(group), match.end(group))
+    
+    pages = []
+    for number in range(2, max(links, default=1) + 1):
+        href = links.get(number)
+        if href is None:
+            pattern, start, end = template
+            href = f"{pattern[:start]}{number}{pattern[end:]}"
+        pages.append(urljoin(page_url, href.split('#')[0]))
+    return pages
+
+
+def fetch_comment_pages(
+    session: requests.Session,
+    page_urls: List[str],
+    headers: Dict[str, str],
+    csrf_token: Optional[str],
+    rate_limiter: RateLimiter
+) -> List[List[Tuple[Optional[str], str]]]:
+    """
+    Tải song song các trang comments tiếp theo (JSON API), mỗi request vẫn chờ rate limiter.
+    
+    Returns:
+        Comments (ID, nội dung) của từng trang, theo thứ tự của page_urls
+    
+    Raises:
+        ItemFetchError: Một trang bị lỗi (không lưu comments thiếu trang)
+    """
+    params = {'_xfResponseType': 'json'}
+    if csrf_token:
+        params['_xfToken'] = csrf_token
+    
+    def fetch_page(page_url: str) -> List[Tuple[Optional[str], str]]:
+        rate_limiter.wait()
+        separator = '&' if '?' in page_url else '?'
+        try:
+            response = session.get(f"{page_url}{separator}{urlencode(params)}", headers=headers, timeout=20)
+            response.raise_for_status()
+            data = response.json()
+        except (json.JSONDecodeError, ValueError) as e:
+            raise ItemFetchError(f"Lỗi parse JSON từ {page_url}: {e}", PERMANENT)
+        except requests.exceptions.RequestException as e:
+            raise classify_exception(e, page_url)
+        if not isinstance(data, dict) or 'content' not in data.get('html', {}):
+            raise ItemFetchError(f"Cấu trúc JSON không đúng từ {page_url}", PERMANENT)
+        return parse_comments(BeautifulSoup(data['html']['content'], 'html.parser'))
+    
+    max_workers = max(1, min(len(page_urls), getattr(config, 'COMMENT_PAGE_WORKERS', 3)))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='comments') as executor:
+        # copy_context: span HTTP của các trang vẫn gắn với job hiện tại (scraper/timing.py)
+        futures = [executor.submit(contextvars.copy_context().run, fetch_page, url) for url in page_urls]
+        return [future.result() for future in futures]
+
+
+def fetch_media_data(
+    session: requests.Session,
+    media_id: str,
+    csrf_token: Optional[str] = None,
+    base_url: Optional[str] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    known_comments: Optional[Tuple[List[str], Optional[int]]] = None
+) -> Dict:
     """
     Gọi JSON API để lấy dữ liệu ảnh và comments từ media ID.
-    Trả về dict chứa image_url, comments, title hoặc None nếu lỗi.
+    Trả về dict chứa image_url, comments, comment_count, title.
+    
+    Comments bị phân trang: các trang sau được tải song song (qua rate_limiter). Nếu
+    known_comments cho biết số comments lần trước bằng số forum đang hiển thị, các trang
+    sau không được tải lại mà dùng comments đã lưu.
     
     Args:
         session: requests.Session với cookies đã được cấu hình
         media_id: Media ID (ví dụ: "117803")
         csrf_token: CSRF token (_xfToken) từ trang thread
+        base_url: Base URL của forum chứa media (mặc định: suy ra từ config.FORUM_URL)
+        rate_limiter: Limiter cho request làm mới CSRF token, request gửi lại sau đó và các trang
+            comments tiếp theo (mặc định: limiter chung của session). Request trang đầu do người
+            gọi tự chờ limiter (fetch_media_data_with_retry chờ trước mỗi lần thử).
+        known_comments: Tuple (comments, comment_count) đã lưu từ lần cào trước (optional)
+    
+    Raises:
+        ItemFetchError: Lỗi đã được phân loại transient (timeout, 5xx, 429)
+            hoặc permanent (404, cấu trúc JSON không đúng...)
     """
-    # Xây dựng URL API với format chuẩn: /media/item.{id}/
-    base_url = config.FORUM_URL.split('/threads/')[0] if '/threads/' in config.FORUM_URL else config.FORUM_URL
-    base_url = base_url.split('/forums/')[0] if '/forums/' in base_url else base_url
-    if not base_url.startswith('http'):
-        base_url = 'https://fuoverflow.com'
+    base_url = (base_url or get_base_url()).rstrip('/')
+    rate_limiter = rate_limiter or get_rate_limiter(session)
     
     # Sử dụng format chuẩn: /media/item.{id}/
-    api_url = f"{base_url.rstrip('/')}/media/item.{media_id}/"
-    
-    # Thêm tham số _xfResponseType=json và _xfToken
-    params = {'_xfResponseType': 'json'}
-    if csrf_token:
-        params['_xfToken'] = csrf_token
-    
-    # Build URL với query parameters
-    api_url = f"{api_url}?{urlencode(params)}"
+    # (item_url không chứa token, dùng trong thông báo lỗi được lưu vào DB)
+    item_url = f"{base_url}/media/item.{media_id}/"
     
     headers = {
         'X-Requested-With': 'XMLHttpRequest',
@@ -139,96 +401,160 @@ def get_media_data_from_json_api(session: requests.Session, media_id: str, csrf_
         'Referer': base_url
     }
     
+    # Ưu tiên token mới nhất của session (có thể đã được làm mới bởi item trước)
+    token_manager = get_token_manager(session, base_url)
+    csrf_token = token_manager.current(csrf_token)
+    
+    def get_json(token: Optional[str]) -> requests.Response:
+        # Thêm tham số _xfResponseType=json và _xfToken
+        params = {'_xfResponseType': 'json'}
+        if token:
+            params['_xfToken'] = token
+        
+        # Build URL với query parameters
+        api_url = f"{item_url}?{urlencode(params)}"
+        return session.get(api_url, headers=headers, timeout=20)
+    
     try:
-        response = session.get(api_url, headers=headers, timeout=20)
+        response = get_json(csrf_token)
+        if response.status_code == 400:
+            # Token đã hết hạn (hoặc trang thread không có token): làm mới một lần rồi gửi lại request
+            refresh_url = urljoin(base_url + '/', getattr(config, 'CSRF_REFRESH_PATH', 'help/').lstrip('/'))
+            new_token = token_manager.refresh(csrf_token, refresh_url, rate_limiter)
+            if new_token and new_token != csrf_token:
+                rate_limiter.wait()
+                response = get_json(new_token)
         response.raise_for_status()
-        
         data = response.json()
-        
-        # Kiểm tra cấu trúc JSON trả về
-        if 'html' not in data or 'content' not in data['html']:
-            print(f"    (!) Cấu trúc JSON không đúng từ {api_url}")
-            return None
-        
-        html_content = data['html']['content']
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # 1. Lấy link ảnh gốc (chất lượng cao)
-        img_url = None
-        
-        # Thử nhiều selector khác nhau
-        img_selectors = [
-            '.attachedImage img',
-            '.media-container img',
-            '.mediaItem img',
-            'img[data-src]',
-            'img[src]'
-        ]
-        
-        for selector in img_selectors:
-            img_tag = soup.select_one(selector)
-            if img_tag:
-                img_url = img_tag.get('data-src') or img_tag.get('src')
-                if img_url:
-                    # Chuyển đổi relative URL thành absolute
-                    if not img_url.startswith('http'):
-                        base_url = config.FORUM_URL.split('/threads/')[0] if '/threads/' in config.FORUM_URL else config.FORUM_URL
-                        base_url = base_url.split('/forums/')[0] if '/forums/' in base_url else base_url
-                        if not base_url.startswith('http'):
-                            base_url = 'https://fuoverflow.com'
-                        img_url = urljoin(base_url, img_url)
-                    break
-        
-        # 2. Lấy tiêu đề/câu hỏi
-        title = None
-        title_selectors = ['.p-title-value', '.media-title', 'h1']
-        for selector in title_selectors:
-            title_tag = soup.select_one(selector)
-            if title_tag:
-                title = title_tag.get_text(strip=True)
-                break
-        
-        # 3. Lấy tất cả comments
-        comments = []
-        comment_selectors = [
-            '.comment-body .bbWrapper',
-            '.comment-content .bbWrapper',
-            '.message-body .bbWrapper',
-            '.comment .bbWrapper'
-        ]
-        
-        for selector in comment_selectors:
-            comment_tags = soup.select(selector)
-            if comment_tags:
-                for tag in comment_tags:
-                    comment_text = tag.get_text(strip=True)
-                    if comment_text and comment_text not in comments:
-                        comments.append(comment_text)
-                break
-        
-        return {
-            'image_url': img_url,
-            'title': title or 'Unknown',
-            'comments': comments
-        }
-        
     except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 400:
-            print(f"    (!) Lỗi 400 Bad Request từ {api_url}")
+        error = classify_exception(e, item_url)
+        if e.response is not None and e.response.status_code == 400:
             if not csrf_token:
-                print(f"    (!) Có thể do thiếu CSRF token. Kiểm tra lại cookie.")
+                error = ItemFetchError(f"Lỗi 400 Bad Request từ {item_url} (có thể do thiếu CSRF token)", PERMANENT, 400)
             else:
-                print(f"    (!) CSRF token có thể đã hết hạn. Vui lòng cập nhật cookie mới.")
-        else:
-            print(f"    (!) Lỗi HTTP {e.response.status_code} từ {api_url}: {e}")
-        return None
+                error = ItemFetchError(f"Lỗi 400 Bad Request từ {item_url} (CSRF token có thể đã hết hạn)", PERMANENT, 400)
+        raise error
+    except (json.JSONDecodeError, ValueError) as e:
+        raise ItemFetchError(f"Lỗi parse JSON từ {item_url}: {e}", PERMANENT)
     except requests.exceptions.RequestException as e:
-        print(f"    (!) Lỗi khi gọi JSON API {api_url}: {e}")
-        return None
-    except json.JSONDecodeError as e:
-        print(f"    (!) Lỗi parse JSON từ {api_url}: {e}")
+        raise classify_exception(e, item_url)
+    
+    # Kiểm tra cấu trúc JSON trả về
+    if not isinstance(data, dict) or 'html' not in data or 'content' not in data['html']:
+        raise ItemFetchError(f"Cấu trúc JSON không đúng từ {item_url}", PERMANENT)
+    
+    html_content = data['html']['content']
+    soup = BeautifulSoup(html_content, 'html.parser')
+    
+    # 1. Lấy link ảnh gốc (chất lượng cao)
+    img_url = None
+    
+    # Thử nhiều selector khác nhau
+    img_selectors = [
+        '.attachedImage img',
+        '.media-container img',
+        '.mediaItem img',
+        'img[data-src]',
+        'img[src]'
+    ]
+    
+    for selector in img_selectors:
+        img_tag = soup.select_one(selector)
+        if img_tag:
+            img_url = img_tag.get('data-src') or img_tag.get('src')
+            if img_url:
+                # Chuyển đổi relative URL thành absolute
+                if not img_url.startswith('http'):
+                    img_url = urljoin(base_url + '/', img_url)
+                break
+    
+    # 2. Lấy tiêu đề/câu hỏi
+    title = None
+    title_selectors = ['.p-title-value', '.media-title', 'h1']
+    for selector in title_selectors:
+        title_tag = soup.select_one(selector)
+        if title_tag:
+            title = title_tag.get_text(strip=True)
+            break
+    
+    # 3. Lấy tất cả comments (kể cả các trang sau nếu bị phân trang)
+    first_page = parse_comments(soup)
+    comment_count = parse_comment_count(soup)
+    page_urls = find_comment_pages(soup, item_url)
+    if not page_urls:
+        comments = merge_comments(first_page)
+    elif known_comments and comment_count is not None and known_comments[1] == comment_count:
+        # Số comments không đổi từ lần cào trước -> không tải lại các trang sau:
+        # trang đầu mới + phần comments đã lưu sau trang đầu
+        comments = merge_comments(first_page) + known_comments[0][len(first_page):]
+    else:
+        other_pages = fetch_comment_pages(
+            session, page_urls, headers, token_manager.current(csrf_token), rate_limiter
+        )
+        comments = merge_comments(first_page, *other_pages)
+        if comment_count is None:
+            comment_count = len(first_page) + sum(len(page) for page in other_pages)
+    
+    return {
+        'image_url': img_url,
+        'title': title or 'Unknown',
+        'comments': comments,
+        'comment_count': comment_count if comment_count is not None else len(first_page)
+    }
+
+
+def fetch_media_data_with_retry(
+    session: requests.Session,
+    media_id: str,
+    csrf_token: Optional[str] = None,
+    base_url: Optional[str] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    known_comments: Optional[Tuple[List[str], Optional[int]]] = None
+) -> Dict:
+    """
+    Như fetch_media_data, nhưng tự thử lại lỗi transient với exponential backoff + jitter.
+    Mỗi lần thử (kể cả lần đầu) đều chờ rate_limiter trước request trang đầu.
+    
+    Raises:
+        ItemFetchError: Lỗi permanent, hoặc lỗi transient sau khi đã hết số lần thử
+    """
+    rate_limiter = rate_limiter or get_rate_limiter(session)
+    
+    def fetch_once() -> Dict:
+        with span('rate_limit'):
+            rate_limiter.wait()
+        with span('media_json'):
+            return fetch_media_data(session, media_id, csrf_token, base_url, rate_limiter, known_comments)
+    
+    def on_retry(attempt: int, error: ItemFetchError, delay: float):
+        print(f"    (!) Media ID {media_id}: {error} - thử lại lần {attempt + 1} sau {delay:.1f}s")
+    
+    return call_with_retry(fetch_once, context=f"media ID {media_id}", on_retry=on_retry)
+
+
+def get_media_data_from_json_api(
+    session: requests.Session,
+    media_id: str,
+    csrf_token: Optional[str] = None,
+    base_url: Optional[str] = None
+) -> Optional[Dict]:
+    """
+    Gọi JSON API để lấy dữ liệu ảnh và comments từ media ID.
+    Trả về dict chứa image_url, comments, title hoặc None nếu lỗi.
+    
+    Args:
+        session: requests.Session với cookies đã được cấu hình
+        media_id: Media ID (ví dụ: "117803")
+        csrf_token: CSRF token (_xfToken) từ trang thread
+        base_url: Base URL của forum chứa media (mặc định: suy ra từ config.FORUM_URL)
+    """
+    try:
+        return fetch_media_data(session, media_id, csrf_token, base_url)
+    except ItemFetchError as e:
+        print(f"    (!) {e}")
+        if e.status_code == 400:
+            print(f"    (!) Vui lòng kiểm tra lại hoặc cập nhật cookie mới.")
         return None
     except Exception as e:
-        print(f"    (!) Lỗi không xác định khi xử lý {api_url}: {e}")
+        print(f"    (!) Lỗi không xác định khi xử lý media ID {media_id}: {e}")
         return None
-
@@ -0,0 +1,52 @@
+# scraper/paths.py
+# Chuyển đổi đường dẫn relative (lưu trong DB) <-> absolute theo SAVE_DIRECTORY.
+# Tách khỏi scraper.py để các lệnh chỉ đọc DB không phải import requests/bs4/fpdf.
+
+import os
+from typing import Optional
+import config
+
+def make_relative_path(absolute_path: str, base_dir: str = config.SAVE_DIRECTORY) -> Optional[str]:
+    """
+    Convert absolute path thành relative path từ base_dir.
+    
+    Args:
+        absolute_path: Đường dẫn tuyệt đối
+        base_dir: Thư mục base (mặc định: SAVE_DIRECTORY)
+    
+    Returns:
+        Đường dẫn tương đối (với / thay vì \), hoặc None nếu absolute_path là None
+    """
+    if not absolute_path:
+        return None
+    
+    abs_path = os.path.abspath(absolute_path)
+    abs_base = os.path.abspath(base_dir)
+    
+    try:
+        # Lấy relative path
+        rel_path = os.path.relpath(abs_path, abs_base)
+        # Normalize: convert \ thành / (để tương thích cross-platform)
+        rel_path = rel_path.replace('\\', '/')
+        return rel_path
+    except ValueError:
+        # Nếu không cùng drive (Windows), return absolute path
+        return absolute_path
+
+def get_absolute_path(relative_path: str, base_dir: str = config.SAVE_DIRECTORY) -> Optional[str]:
+    """
+    Convert relative path thành absolute path.
+    
+    Args:
+        relative_path: Đường dẫn tương đối
+        base_dir: Thư mục base (mặc định: SAVE_DIRECTORY)
+    
+    Returns:
+        Đường dẫn tuyệt đối, hoặc None nếu relative_path là None
+    """
+    if not relative_path:
+        return None
+    
+    abs_base = os.path.abspath(base_dir)
+    abs_path = os.path.join(abs_base, relative_path)
+    return os.path.normpath(abs_path)
@@ -2,11 +2,15 @@
 
 import os
 import json
+import shutil
+import tempfile
 import requests
 from fpdf import FPDF
 from PIL import Image
-from typing import List, Dict
+from typing import List, Dict, Optional
 import config
+from scraper.downloader import download_file
+from library.answer_utils import summarize_answers, format_consensus
 
 
 def setup_unicode_font(pdf: FPDF):
@@ -129,27 +133,30 @@ def download_image_for_pdf(session: requests.Session, img_url: str, temp_path: s
     try:
         headers = session.headers.copy()
         headers['Referer'] = config.FORUM_URL
-        response = session.get(img_url, headers=headers, timeout=20, stream=True)
-        response.raise_for_status()
-        
-        with open(temp_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        download_file(session, img_url, temp_path, headers=headers)
         return True
     except Exception as e:
         print(f"    (!) Lỗi khi tải ảnh cho PDF: {e}")
         return False
 
 
-def create_pdf_from_data(session: requests.Session, data_list: List[Dict], output_path: str, thread_title: str):
+def create_pdf_from_data(
+    session: Optional[requests.Session],
+    data_list: List[Dict],
+    output_path: str,
+    thread_title: str,
+    consensus: Optional[Dict[str, Dict]] = None
+):
     """
     Tạo file PDF từ danh sách dữ liệu câu hỏi.
     
     Args:
-        session: requests.Session để tải ảnh
-        data_list: List các dict chứa image_url, comments, title
+        session: requests.Session để tải ảnh chưa có trên máy (None = chỉ dùng ảnh local)
+        data_list: List các dict chứa media_id, image_url, image_local_path, comments, title
         output_path: Đường dẫn file PDF đầu ra
         thread_title: Tiêu đề đề thi
+        consensus: Đáp án tổng hợp theo media_id (DatabaseManager.get_answer_consensus).
+            None = tự tổng hợp từ comments (khi tạo PDF không qua DB)
     """
     pdf = ExamPDF()
     
@@ -157,8 +164,8 @@ def create_pdf_from_data(session: requests.Session, data_list: List[Dict], outpu
     font_name = 'Unicode' if pdf.unicode_font_available else 'Arial'
     pdf.set_font(font_name, '', 14)
     
-    temp_dir = "temp_pdf_images"
-    os.makedirs(temp_dir, exist_ok=True)
+    # Thư mục tạm riêng cho mỗi lần render (nhiều PDF có thể được render song song)
+    temp_dir = tempfile.mkdtemp(prefix="temp_pdf_images_")
     
     for i, item in enumerate(data_list):
         question_num = i + 1
@@ -170,14 +177,20 @@ def create_pdf_from_data(session: requests.Session, data_list: List[Dict], outpu
         pdf.cell(0, 10, f"Câu số: {question_num}", ln=True, align='C')
         pdf.ln(5)
         
-        if item.get('image_url'):
-            temp_img_path = os.path.join(temp_dir, f"temp_img_{question_num}.jpg")
+        if item.get('image_url') or item.get('image_local_path'):
+            # Ưu tiên ảnh đã tải về máy, chỉ tải lại khi không có file local
+            local_path = item.get('image_local_path')
+            if local_path and os.path.exists(local_path):
+                img_path = local_path
+            else:
+                img_path = os.path.join(temp_dir, f"temp_img_{question_num}.jpg")
+                if not (session and item.get('image_url') and download_image_for_pdf(session, item['image_url'], img_path)):
+                    img_path = None
             
-            # Tải ảnh về
-            if download_image_for_pdf(session, item['image_url'], temp_img_path):
+            if img_path:
                 try:
                     # Mở ảnh và tính toán kích thước
-                    with Image.open(temp_img_path) as img:
+                    with Image.open(img_path) as img:
                         img_width, img_height = img.size
                         aspect_ratio = img_height / img_width
                         
@@ -196,11 +209,11 @@ def create_pdf_from_data(session: requests.Session, data_list: List[Dict], outpu
                         
                         # Chèn ảnh vào PDF (căn giữa)
                         x_position = (210 - width_mm) / 2
-                        pdf.image(temp_img_path, x=x_position, y=40, w=width_mm, h=height_mm)
+                        pdf.image(img_path, x=x_position, y=40, w=width_mm, h=height_mm)
                     
                     # Xóa ảnh tạm
-                    if os.path.exists(temp_img_path):
-                        os.remove(temp_img_path)
+                    if img_path != local_path and os.path.exists(img_path):
+                        os.remove(img_path)
                         
                 except Exception as e:
                     print(f"    (!) Lỗi khi xử lý ảnh câu {question_num}: {e}")
@@ -218,6 +231,14 @@ def create_pdf_from_data(session: requests.Session, data_list: List[Dict], outpu
         pdf.ln(5)
         
         comments = item.get('comments', [])
+        if consensus is not None:
+            summary = consensus.get(str(item.get('media_id')))
+        else:
+            summary = summarize_answers(comments)
+        pdf.set_font(font_name, 'B', 12)
+        pdf.multi_cell(0, 8, f"Đáp án được chọn nhiều nhất: {format_consensus(summary)}")
+        pdf.ln(3)
+        
         if not comments:
             pdf.set_font(font_name, '', 12)
             pdf.multi_cell(0, 10, "- Chưa có bình luận/đáp án nào.")
@@ -242,11 +263,7 @@ def create_pdf_from_data(session: requests.Session, data_list: List[Dict], outpu
                 pdf.cell(0, 8, f"(Hiển thị {max_comments}/{len(comments)} bình luận)", ln=True)
     
     # Xóa thư mục tạm
-    try:
-        if os.path.exists(temp_dir) and not os.listdir(temp_dir):
-            os.rmdir(temp_dir)
-    except:
-        pass
+    shutil.rmtree(temp_dir, ignore_errors=True)
     
     # Lưu file PDF
     try:
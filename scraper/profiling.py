@@ -0,0 +1,186 @@
+# scraper/profiling.py
+
+# cProfile / pstats / tracemalloc được import khi profile thật sự chạy: main.py import
+# PROFILE_MODES cho argparse và không muốn mất thời gian khởi động cho các module này
+import io
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, Optional
+import config
+
+PROFILE_MODES = ('cpu', 'mem')
+
+# Định dạng output của --profile cpu: 'pstats' (cProfile) hoặc 'collapsed' (sampling, cho flamegraph)
+CPU_FORMATS = ('pstats', 'collapsed')
+
+class StackSampler:
+    """
+    Sampling profiler cho một luồng: định kỳ chụp stack của luồng đó (sys._current_frames)
+    và đếm theo dạng collapsed stack ("a;b;c count"), đọc được bằng flamegraph.pl / speedscope.
+    """
+    
+    def __init__(self, thread_ident: int, interval: float = 0.005):
+        """
+        Args:
+            thread_ident: threading.get_ident() của luồng cần sample
+            interval: Khoảng cách giữa hai lần sample (giây)
+        """
+        self.thread_ident = thread_ident
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+    
+    def write(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+class JobProfiler:
+    """
+    Profile từng job (hoặc từng lần render) và ghi kết quả theo thread ID:
+        
+        <output_dir>/thread_<id>/<thời điểm>_<label>.pstats|.collapsed|.mem.txt
+    
+    - cpu: cProfile (.pstats, mở bằng `python -m pstats` / snakeviz) hoặc sampling (.collapsed)
+    - mem: tracemalloc snapshot lúc bắt đầu và kết thúc, báo cáo các dòng cấp phát nhiều nhất
+    
+    Chỉ đo luồng gọi profile() nên dùng cho worker tuần tự (không dùng với --pipeline).
+    """
+    
+    def __init__(self, mode: str, output_dir: Optional[str] = None, top: Optional[int] = None):
+        """
+        Args:
+            mode: 'cpu' hoặc 'mem'
+            output_dir: Thư mục chứa kết quả (mặc định config.PROFILE_DIRECTORY)
+            top: Số dòng in ra / ghi trong báo cáo (mặc định config.PROFILE_TOP)
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Chế độ profile không hợp lệ: {mode} (chọn {', '.join(PROFILE_MODES)})")
+        self.mode = mode
+        self.output_dir = output_dir or getattr(config, 'PROFILE_DIRECTORY', 'profiles')
+        self.top = top or getattr(config, 'PROFILE_TOP', 25)
+        self.cpu_format = getattr(config, 'PROFILE_CPU_FORMAT', 'pstats')
+        if self.cpu_format not in CPU_FORMATS:
+            self.cpu_format = 'pstats'
+    
+    def _output_path(self, thread_id: Optional[int], label: str, ext: str) -> str:
+        folder = os.path.join(self.output_dir, f"thread_{thread_id}" if thread_id is not None else 'other')
+        os.makedirs(folder, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        return os.path.join(folder, f"{stamp}_{label}{ext}")
+    
+    @contextmanager
+    def profile(self, thread_id: Optional[int], label: str = 'job') -> Iterator[None]:
+        """
+        Profile khối code bên trong và ghi kết quả khi kết thúc (kể cả khi có exception).
+        
+        Args:
+            thread_id: ID của thread (để đặt tên thư mục output)
+            label: Tên của khối được đo (vd: 'job', 'render')
+        """
+        if self.mode == 'cpu':
+            with self._profile_cpu(thread_id, label):
+                yield
+        else:
+            with self._profile_mem(thread_id, label):
+                yield
+    
+    @contextmanager
+    def _profile_cpu(self, thread_id: Optional[int], label: str) -> Iterator[None]:
+        import cProfile
+        import pstats
+        
+        start = time.perf_counter()
+        if self.cpu_format == 'collapsed':
+            sampler = StackSampler(threading.get_ident(), getattr(config, 'PROFILE_SAMPLE_INTERVAL', 0.005))
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                path = self._output_path(thread_id, label, '.collapsed')
+                sampler.write(path)
+                print(f"[PROFILE] CPU ({label}, {time.perf_counter() - start:.2f}s, "
+                      f"{sum(sampler.stacks.values())} samples): {path}")
+            return
+        
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = self._output_path(thread_id, label, '.pstats')
+            profiler.dump_stats(path)
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(self.top)
+            print(f"[PROFILE] CPU ({label}, {time.perf_counter() - start:.2f}s): {path}")
+            # Bỏ phần header của pstats, chỉ in bảng hàm tốn thời gian nhất
+            report = stream.getvalue()
+            print(report[report.find('   ncalls'):].rstrip() if '   ncalls' in report else report.rstrip())
+    
+    @contextmanager
+    def _profile_mem(self, thread_id: Optional[int], label: str) -> Iterator[None]:
+        import tracemalloc
+        
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(getattr(config, 'PROFILE_MEM_FRAMES', 10))
+        if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+            tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if started_here:
+                tracemalloc.stop()
+            
+            # Bỏ qua cấp phát của chính tracemalloc / module profile
+            filters = [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ]
+            diff = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+            top_stats = sorted(diff, key=lambda stat: stat.size_diff, reverse=True)[:self.top]
+            
+            lines = [f"Peak: {peak / 1024 / 1024:.1f} MB, còn giữ sau job: {current / 1024 / 1024:.1f} MB",
+                     f"Top {len(top_stats)} dòng cấp phát nhiều nhất (tăng thêm trong {label}):"]
+            for stat in top_stats:
+                frame = stat.traceback[0]
+                lines.append(f"  {stat.size_diff / 1024:>10.1f} KB  {stat.count_diff:>+8} blocks  "
+                             f"{frame.filename}:{frame.lineno}")
+            
+            path = self._output_path(thread_id, label, '.mem.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            print(f"[PROFILE] Bộ nhớ ({label}): {path}")
+            for line in lines[:12]:
+                print(f"[PROFILE] {line}")
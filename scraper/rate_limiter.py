@@ -0,0 +1,82 @@
+# scraper/rate_limiter.py
+
+import time
+import threading
+import weakref
+import requests
+from typing import Dict, Optional
+import config
+
+class RateLimiter:
+    """
+    Giới hạn tốc độ request dùng chung giữa nhiều luồng.
+    
+    Đảm bảo hai lần cấp phép liên tiếp cách nhau ít nhất `min_interval` giây,
+    bất kể request đến từ luồng worker chính hay luồng prefetch.
+    """
+    
+    def __init__(self, min_interval: float):
+        """
+        Args:
+            min_interval: Khoảng cách tối thiểu giữa hai request (giây)
+        """
+        self.min_interval = max(0.0, float(min_interval))
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self.total_wait = 0.0
+    
+    def wait(self) -> float:
+        """
+        Chờ đến lượt được gửi request tiếp theo.
+        
+        Returns:
+            Số giây đã phải chờ
+        """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval
+            self.total_wait += slot - now
+        
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+        return 0.0
+
+# Mỗi session có một limiter mặc định (key None) và một limiter riêng cho từng site (key = host)
+_rate_limiters: "weakref.WeakKeyDictionary[requests.Session, Dict[Optional[str], RateLimiter]]" = weakref.WeakKeyDictionary()
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(
+    session: requests.Session,
+    min_interval: Optional[float] = None,
+    key: Optional[str] = None
+) -> RateLimiter:
+    """
+    Lấy RateLimiter gắn với session (tạo mới nếu chưa có).
+    
+    Args:
+        session: requests.Session
+        min_interval: Khoảng cách tối thiểu (giây), mặc định config.DELAY_BETWEEN_REQUESTS.
+            Với limiter đã có, giá trị khác được áp dụng cho các request tiếp theo.
+        key: Host (thread_utils.get_host) để dùng budget riêng của site đó, chung cho mọi
+            forum trên site (None = limiter mặc định của session)
+    """
+    with _rate_limiters_lock:
+        limiters = _rate_limiters.get(session)
+        if limiters is None:
+            limiters = _rate_limiters[session] = {}
+        limiter = limiters.get(key)
+        if limiter is None:
+            if min_interval is None:
+                min_interval = config.DELAY_BETWEEN_REQUESTS
+            limiter = limiters[key] = RateLimiter(min_interval)
+        elif min_interval is not None:
+            limiter.min_interval = max(0.0, float(min_interval))
+        return limiter
+
+def get_total_wait(session: requests.Session) -> float:
+    """Tổng thời gian chờ (giây) của mọi limiter của session."""
+    with _rate_limiters_lock:
+        return sum(limiter.total_wait for limiter in _rate_limiters.get(session, {}).values())
@@ -0,0 +1,153 @@
+# scraper/retry.py
+
+import time
+import random
+import requests
+from typing import Callable, Optional, TypeVar
+import config
+
+T = TypeVar('T')
+
+# Các HTTP status được coi là lỗi tạm thời (thử lại có thể thành công)
+TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+class ItemFetchError(Exception):
+    """
+    Lỗi khi xử lý một media item, đã được phân loại transient/permanent.
+    
+    Attributes:
+        kind: TRANSIENT (timeout, 5xx, 429...) hoặc PERMANENT (404, sai cấu trúc...)
+        status_code: HTTP status code (nếu có)
+        retry_after: Số giây server yêu cầu đợi (header Retry-After, nếu có)
+        attempts: Số lần đã thử trước khi bỏ cuộc
+    """
+    
+    def __init__(self, message: str, kind: str, status_code: Optional[int] = None,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.kind = kind
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.attempts = 1
+    
+    @property
+    def is_transient(self) -> bool:
+        return self.kind == TRANSIENT
+
+def classify_http_status(status_code: int) -> str:
+    """Phân loại HTTP status code thành TRANSIENT hoặc PERMANENT."""
+    if status_code in TRANSIENT_STATUS_CODES or status_code >= 500:
+        return TRANSIENT
+    return PERMANENT
+
+def _parse_retry_after(response: Optional[requests.Response]) -> Optional[float]:
+    """Đọc header Retry-After (chỉ hỗ trợ dạng số giây)."""
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After', '')
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+def classify_exception(e: Exception, context: str = '') -> ItemFetchError:
+    """
+    Chuyển một exception bất kỳ thành ItemFetchError đã phân loại.
+    
+    Args:
+        e: Exception gốc
+        context: Mô tả ngắn (URL, media ID...) để đưa vào thông báo lỗi
+    
+    Returns:
+        ItemFetchError tương ứng
+    """
+    if isinstance(e, ItemFetchError):
+        return e
+    
+    prefix = f"{context}: " if context else ''
+    
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        status_code = e.response.status_code
+        return ItemFetchError(
+            f"{prefix}HTTP {status_code}",
+            classify_http_status(status_code),
+            status_code=status_code,
+            retry_after=_parse_retry_after(e.response)
+        )
+    
+    # Timeout, mất kết nối, đứt stream giữa chừng... -> thử lại được
+    if isinstance(e, (requests.exceptions.Timeout,
+                      requests.exceptions.ConnectionError,
+                      requests.exceptions.ChunkedEncodingError)):
+        return ItemFetchError(f"{prefix}{e}", TRANSIENT)
+    
+    # Exception tự đánh dấu có thể thử lại (vd: DownloadError khi tải thiếu byte)
+    if getattr(e, 'transient', False):
+        return ItemFetchError(f"{prefix}{e}", TRANSIENT)
+    
+    return ItemFetchError(f"{prefix}{e}", PERMANENT)
+
+def backoff_delay(attempt: int, base: Optional[float] = None, cap: Optional[float] = None) -> float:
+    """
+    Thời gian chờ trước lần thử lại thứ `attempt` (exponential backoff + full jitter).
+    
+    Args:
+        attempt: Số lần đã thử thất bại (bắt đầu từ 1)
+        base: Thời gian chờ cơ sở (giây), mặc định config.RETRY_BACKOFF_BASE
+        cap: Thời gian chờ tối đa (giây), mặc định config.RETRY_BACKOFF_MAX
+    
+    Returns:
+        Số giây cần chờ, ngẫu nhiên trong khoảng [0, min(cap, base * 2^(attempt-1))]
+    """
+    if base is None:
+        base = getattr(config, 'RETRY_BACKOFF_BASE', 1.0)
+    if cap is None:
+        cap = getattr(config, 'RETRY_BACKOFF_MAX', 30.0)
+    return random.uniform(0, min(cap, base * (2 ** max(0, attempt - 1))))
+
+def call_with_retry(
+    func: Callable[[], T],
+    max_attempts: Optional[int] = None,
+    context: str = '',
+    on_retry: Optional[Callable[[int, ItemFetchError, float], None]] = None
+) -> T:
+    """
+    Gọi func(), thử lại với exponential backoff nếu gặp lỗi tạm thời.
+    
+    Args:
+        func: Hàm không tham số cần gọi
+        max_attempts: Số lần thử tối đa, mặc định config.ITEM_MAX_ATTEMPTS
+        context: Mô tả ngắn để đưa vào thông báo lỗi
+        on_retry: Callback (attempt, error, delay) trước mỗi lần thử lại
+    
+    Returns:
+        Kết quả của func()
+    
+    Raises:
+        ItemFetchError: Lỗi permanent, hoặc lỗi transient sau khi hết số lần thử
+            (thuộc tính `attempts` cho biết đã thử bao nhiêu lần)
+    """
+    if max_attempts is None:
+        max_attempts = getattr(config, 'ITEM_MAX_ATTEMPTS', 4)
+    max_attempts = max(1, max_attempts)
+    
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return func()
+        except Exception as e:
+            error = classify_exception(e, context)
+            error.attempts = attempt
+            if not error.is_transient or attempt >= max_attempts:
+                raise error
+            
+            delay = backoff_delay(attempt)
+            if error.retry_after is not None:
+                delay = max(delay, error.retry_after)
+            if on_retry:
+                on_retry(attempt, error, delay)
+            time.sleep(delay)
@@ -3,15 +3,24 @@
 import os
 import re
 import json
-import time
 import requests
-from typing import Optional
+from collections import Counter
+from typing import Optional, Dict, List, Tuple, TYPE_CHECKING
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 from tqdm import tqdm
 import config # Import cấu hình từ config.py
-from scraper.media_api import extract_media_ids_from_thread, get_media_data_from_json_api
+from scraper.media_api import extract_media_ids_from_thread, fetch_media_data_with_retry
 from scraper.pdf_generator import create_pdf_from_data
+from scraper.downloader import download_file, is_valid_image, file_sha256
+from scraper.retry import ItemFetchError, PERMANENT, call_with_retry
+from scraper.rate_limiter import RateLimiter, get_rate_limiter
+from scraper.paths import make_relative_path, get_absolute_path
+from scraper.timing import span, timed
+from library.thread_utils import get_base_url, get_host
+
+if TYPE_CHECKING:
+    from database.models import DatabaseManager
 
 def sanitize_filename(name: str) -> str:
     """Làm sạch tên file/thư mục để loại bỏ các ký tự không hợp lệ."""
@@ -20,56 +29,64 @@ def sanitize_filename(name: str) -> str:
     name = re.sub(r'^[a-zA-Z0-9]+\s*-\s*', '', name, flags=re.IGNORECASE)
     return re.sub(r'[\\/*?:"<>|]', "_", name).strip()
 
-def make_relative_path(absolute_path: str, base_dir: str = config.SAVE_DIRECTORY) -> Optional[str]:
+def scan_folder_file_sizes(folder_path: str) -> Dict[str, int]:
     """
-    Convert absolute path thành relative path từ base_dir.
+    Liệt kê các file trong thư mục bằng một lần os.scandir.
     
     Args:
-        absolute_path: Đường dẫn tuyệt đối
-        base_dir: Thư mục base (mặc định: SAVE_DIRECTORY)
+        folder_path: Đường dẫn thư mục
     
     Returns:
-        Đường dẫn tương đối (với / thay vì \), hoặc None nếu absolute_path là None
+        Dict tên file -> kích thước (bytes), rỗng nếu thư mục chưa tồn tại
     """
-    if not absolute_path:
-        return None
-    
-    abs_path = os.path.abspath(absolute_path)
-    abs_base = os.path.abspath(base_dir)
-    
+    sizes = {}
     try:
-        # Lấy relative path
-        rel_path = os.path.relpath(abs_path, abs_base)
-        # Normalize: convert \ thành / (để tương thích cross-platform)
-        rel_path = rel_path.replace('\\', '/')
-        return rel_path
-    except ValueError:
-        # Nếu không cùng drive (Windows), return absolute path
-        return absolute_path
+        with os.scandir(folder_path) as it:
+            for entry in it:
+                if entry.is_file():
+                    sizes[entry.name] = entry.stat().st_size
+    except FileNotFoundError:
+        pass
+    return sizes
 
-def get_absolute_path(relative_path: str, base_dir: str = config.SAVE_DIRECTORY) -> Optional[str]:
+def load_exported_comments(thread_save_path: str) -> Dict[str, Dict]:
     """
-    Convert relative path thành absolute path.
-    
-    Args:
-        relative_path: Đường dẫn tương đối
-        base_dir: Thư mục base (mặc định: SAVE_DIRECTORY)
+    Đọc comments.json của lần cào trước (dữ liệu cho các file ảnh có sẵn nhưng chưa
+    có trong manifest: thư viện từ phiên bản cũ, hoặc chạy scraper.py không có DB).
     
     Returns:
-        Đường dẫn tuyệt đối, hoặc None nếu relative_path là None
+        Dict media_id -> item trong comments.json, rỗng nếu không có / không đọc được
     """
-    if not relative_path:
+    try:
+        with open(os.path.join(thread_save_path, 'comments.json'), 'r', encoding='utf-8') as f:
+            return {str(item['media_id']): item for item in json.load(f) if 'media_id' in item}
+    except (OSError, ValueError, TypeError):
+        return {}
+
+def _file_size(path: str, folder_path: str, folder_sizes: Dict[str, int]) -> Optional[int]:
+    """Lấy kích thước file, ưu tiên kết quả scandir của thư mục thread."""
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(folder_path):
+        return folder_sizes.get(os.path.basename(path))
+    try:
+        return os.path.getsize(path)
+    except OSError:
         return None
-    
-    abs_base = os.path.abspath(base_dir)
-    abs_path = os.path.join(abs_base, relative_path)
-    return os.path.normpath(abs_path)
 
-def get_latest_thread_info(session, limit: int) -> list[dict]:
-    """Lấy thông tin (URL và tiêu đề) của các đề thi mới nhất."""
-    print(f"[*] Đang truy cập trang môn học: {config.FORUM_URL}")
+def _failed_item(media_id: str, error: ItemFetchError) -> Dict:
+    """Tạo bản ghi media item lỗi để lưu vào bảng failed_items."""
+    return {
+        'media_id': media_id,
+        'error_kind': error.kind,
+        'error_message': str(error),
+        'attempts': error.attempts
+    }
+
+def get_latest_thread_info(session, limit: int, forum_url: Optional[str] = None) -> list[dict]:
+    """Lấy thông tin (URL và tiêu đề) của các đề thi mới nhất (mặc định từ config.FORUM_URL)."""
+    forum_url = forum_url or config.FORUM_URL
+    print(f"[*] Đang truy cập trang môn học: {forum_url}")
     try:
-        response = session.get(config.FORUM_URL, timeout=15)
+        response = session.get(forum_url, timeout=15)
         response.raise_for_status()
         
         soup = BeautifulSoup(response.text, 'html.parser')
@@ -86,7 +103,7 @@ def get_latest_thread_info(session, limit: int) -> list[dict]:
             title_tag = item.select_one('div.structItem-title > a[data-tp-primary="on"]')
             if title_tag and title_tag.has_attr('href'):
                 threads_info.append({
-                    'url': urljoin(config.FORUM_URL, title_tag['href']),
+                    'url': urljoin(forum_url, title_tag['href']),
                     'title': title_tag.text.strip()
                 })
         
@@ -96,28 +113,38 @@ def get_latest_thread_info(session, limit: int) -> list[dict]:
         print(f"(!) Lỗi kết nối đến trang môn học: {e}")
         return []
 
-def download_images_with_comments_from_thread(
-    session: requests.Session, 
+def thread_rate_limiter(session: requests.Session, thread_info: dict) -> RateLimiter:
+    """
+    Rate limiter của site chứa thread. Các forum cùng host dùng chung một budget (thêm forum
+    không nhân số request gửi tới server lên); min_interval của forum đang cào được áp dụng.
+    """
+    return get_rate_limiter(session, thread_info.get('rate_interval'),
+                            key=get_host(thread_info.get('base_url') or thread_info['url']))
+
+@timed('discover')
+def discover_thread(
+    session: requests.Session,
     thread_info: dict,
-    thread_db_id: Optional[int] = None
+    thread_db_id: Optional[int] = None,
+    db_manager: Optional["DatabaseManager"] = None,
+    prefetched: Optional[Tuple[List[Dict], Optional[str]]] = None
 ) -> dict:
     """
-    Tải tất cả hình ảnh và comments từ một URL đề thi sử dụng JSON API.
-    Lưu ảnh và comments vào thư mục riêng, đồng thời tạo file JSON.
+    Stage discover: tải trang thread, lấy Media IDs + CSRF token và lập kế hoạch
+    (tên file, đường dẫn lưu) cho từng media item.
     
     Args:
         session: requests.Session với cookies
-        thread_info: Dict chứa 'url' và 'title'
-        thread_db_id: ID của thread trong DB (optional, để tích hợp sau)
+        thread_info: Dict chứa 'url' và 'title'; có thể có 'forum_id', 'base_url', 'rate_interval'
+            (QueueManager.build_thread_info) để dùng base URL của forum và rate budget của site, và
+            'refresh_comments' để cập nhật comments của các ảnh đã tải (cào lại thread đã xong)
+        thread_db_id: ID của thread trong DB (optional)
+        db_manager: DatabaseManager để đọc download manifest (optional)
+        prefetched: Tuple (media_items, csrf_token) đã được worker tải trước (optional)
     
     Returns:
-        dict chứa:
-            - folder_path: Đường dẫn thư mục (relative)
-            - pdf_path: Đường dẫn file PDF (relative, None nếu không có)
-            - total_questions: Tổng số câu hỏi
-            - media_items_data: List các dict chứa thông tin media items
-            - success: bool
-            - error: str (nếu có lỗi)
+        Dict job context, dùng cho process_media_item / render_thread_pdf /
+        build_thread_result. `job['items']` rỗng nếu không tìm thấy media nào.
     """
     thread_url = thread_info['url']
     folder_name = sanitize_filename(thread_info['title'])
@@ -126,186 +153,473 @@ def download_images_with_comments_from_thread(
     
     print(f"\n--- Đang xử lý đề: '{thread_info['title']}' ---")
     print(f"    Lưu tại: {thread_save_path}")
+    
+    job = {
+        'thread_info': thread_info,
+        'thread_url': thread_url,
+        'base_url': thread_info.get('base_url') or get_base_url(thread_url),
+        'rate_limiter': thread_rate_limiter(session, thread_info),
+        'thread_db_id': thread_db_id,
+        'db_manager': db_manager,
+        'folder_name': folder_name,
+        'thread_save_path': thread_save_path,
+        'csrf_token': None,
+        'items': [],
+        'manifest': {},
+        'refresh_comments': bool(thread_info.get('refresh_comments')) and getattr(config, 'REFRESH_COMMENTS', True),
+        'previous_failures': {},
+        'existing_files': {},
+        'exported_data': {}
+    }
+    
+    # Bước 1: Trích xuất Media IDs và CSRF token từ thread
+    if prefetched:
+        # Worker đã tải trước trang thread trong lúc xử lý job trước
+        print("    [*] Dùng Media IDs và CSRF token đã prefetch.")
+        media_items, csrf_token = prefetched
+    else:
+        print("    [*] Đang trích xuất Media IDs và CSRF token...")
+        media_items, csrf_token = extract_media_ids_from_thread(session, thread_url, job['rate_limiter'])
+    
+    if not media_items:
+        return job
+    
+    if not csrf_token:
+        print("    (!) Cảnh báo: Không lấy được CSRF token. Có thể gặp lỗi 400 khi gọi API.")
+        print("    (!) Vui lòng kiểm tra lại cookie hoặc cập nhật cookie mới nhất.")
+    else:
+        print(f"    [+] Đã lấy CSRF token thành công.")
+    
+    print(f"    [+] Tìm thấy {len(media_items)} media items. Bắt đầu tải...")
+    job['csrf_token'] = csrf_token
+    
+    # Load manifest (ảnh đã tải xong, keyed theo media_id) bằng một query duy nhất
+    if db_manager and thread_db_id:
+        job['manifest'] = db_manager.get_download_manifest(thread_db_id)
+        job['previous_failures'] = db_manager.get_failed_items(thread_db_id)
+    
+    # Liệt kê thư mục một lần thay vì os.path.exists cho từng media
+    job['existing_files'] = scan_folder_file_sizes(thread_save_path)
+    
+    # Tên file bị trùng giữa nhiều media (vd: image.png) -> thêm media_id vào tên
+    filename_counts = Counter(sanitize_filename(item['filename']) for item in media_items)
+    
+    for idx, media_item in enumerate(media_items):
+        media_id = str(media_item['media_id'])
+        original_filename = media_item['filename']
+        
+        # Tạo tên file (duy nhất trong thread)
+        file_ext = os.path.splitext(original_filename)[1] or '.jpg'
+        base_filename = sanitize_filename(original_filename)
+        if not base_filename:
+            safe_filename = f"question_{idx+1}{file_ext}"
+        elif filename_counts[base_filename] > 1:
+            stem, ext = os.path.splitext(base_filename)
+            safe_filename = f"{stem}_{media_id}{ext or file_ext}"
+        else:
+            safe_filename = base_filename
+        
+        job['items'].append({
+            'index': idx,
+            'media_id': media_id,
+            'base_filename': base_filename,
+            'safe_filename': safe_filename,
+            'save_path': os.path.join(thread_save_path, safe_filename)
+        })
+    
+    # Có item chưa nằm trong manifest -> đọc comments.json cũ một lần để nhận lại file có sẵn
+    if ('comments.json' in job['existing_files']
+            and any(item['media_id'] not in job['manifest'] for item in job['items'])):
+        job['exported_data'] = load_exported_comments(thread_save_path)
+    
+    return job
+
+def process_media_item(session: requests.Session, job: dict, item: dict) -> dict:
+    """
+    Stage fetch + download cho một media item: gọi JSON API và tải ảnh về
+    (bỏ qua nếu manifest đã có). An toàn khi gọi song song từ nhiều luồng.
+    
+    Args:
+        session: requests.Session với cookies
+        job: Job context từ discover_thread
+        item: Một phần tử của job['items']
+    
+    Returns:
+        Dict chứa:
+            - index: Thứ tự của item trong thread
+            - question_data: Dữ liệu cho PDF/JSON (None nếu không lấy được)
+            - failure: Bản ghi lỗi cho bảng failed_items (None nếu không lỗi)
+    """
+    idx = item['index']
+    media_id = item['media_id']
+    safe_filename = item['safe_filename']
+    save_path = item['save_path']
+    existing_files = job['existing_files']
+    outcome = {'index': idx, 'question_data': None, 'failure': None}
+    
+    # Manifest có entry và file trên đĩa đúng kích thước -> không tải lại ảnh
+    entry = job['manifest'].get(media_id)
+    if entry:
+        entry_path = get_absolute_path(entry['file_path'])
+        if _file_size(entry_path, job['thread_save_path'], existing_files) == entry['file_size']:
+            tqdm.write(f"    - Bỏ qua (đã tải): {os.path.basename(entry_path)}")
+            outcome['question_data'] = {
+                'media_id': media_id,
+                'title': entry.get('title') or f'Question {idx+1}',
+                'image_url': entry.get('image_url'),
+                'image_local_path': entry_path,
+                'comments': entry.get('comments', []),
+                'comment_count': entry.get('comment_count')
+            }
+            if job['refresh_comments']:
+                _refresh_comments(session, job, entry, outcome['question_data'])
+            return outcome
+    
+    # File từ phiên bản cũ (trước khi có manifest, hoặc scraper.py không có DB): nhận lại
+    # không cần gọi API nếu ảnh hợp lệ, comments.json còn dữ liệu của nó và tên file chỉ
+    # thuộc về media này (tên gốc không trùng, hoặc tên đã kèm media_id; không nhận question_N)
+    exported = job['exported_data'].get(media_id)
+    if (not entry and exported and item['base_filename']
+            and safe_filename in existing_files and is_valid_image(save_path)):
+        tqdm.write(f"    - Bỏ qua (đã tồn tại): {safe_filename}")
+        outcome['question_data'] = {
+            'media_id': media_id,
+            'title': exported.get('title') or f'Question {idx+1}',
+            'image_url': exported.get('image_url'),
+            'image_local_path': save_path,
+            'comments': exported.get('comments', []),
+            'comment_count': exported.get('comment_count')
+        }
+        _save_download(job, media_id, {
+            'path': save_path,
+            'size': existing_files[safe_filename],
+            'sha256': file_sha256(save_path)
+        }, outcome['question_data'])
+        return outcome
+    
+    # Lỗi permanent từ lần trước (404...) -> không gọi lại, chờ `retry --items`
+    previous_failure = job['previous_failures'].get(media_id)
+    if previous_failure and previous_failure['error_kind'] == PERMANENT:
+        tqdm.write(f"    - Bỏ qua media ID {media_id}: Lỗi vĩnh viễn từ lần trước ({previous_failure['error_message']})")
+        outcome['failure'] = previous_failure
+        return outcome
+    
+    # Chưa có trong manifest (hoặc file đã mất), gọi API để lấy dữ liệu
+    # (mỗi request chờ rate limiter dùng chung với luồng prefetch, thay cho sleep cố định)
+    try:
+        media_data = fetch_media_data_with_retry(
+            session, media_id, job['csrf_token'], job['base_url'], job['rate_limiter'],
+            known_comments=(entry['comments'], entry.get('comment_count')) if entry else None
+        )
+    except ItemFetchError as e:
+        tqdm.write(f"    - Bỏ qua media ID {media_id}: {e} ({e.kind}, {e.attempts} lần thử)")
+        outcome['failure'] = _failed_item(media_id, e)
+        return outcome
+
+    # Tải ảnh về
+    image_url = media_data.get('image_url')
+    download = None
+    if image_url:
+        # File từ phiên bản cũ (trước khi có manifest): chỉ nhận lại nếu tên
+        # không bị trùng và ảnh hợp lệ, tránh tải lại toàn bộ thư viện
+        if (safe_filename == item['base_filename'] and safe_filename in existing_files
+                and is_valid_image(save_path)):
+            download = {
+                'path': save_path,
+                'size': existing_files[safe_filename],
+                'sha256': file_sha256(save_path)
+            }
+            tqdm.write(f"    - Đã có sẵn: {safe_filename}")
+        else:
+            try:
+                download_headers = session.headers.copy()
+                download_headers['Referer'] = job['thread_url']
+                # Lỗi giữa chừng được thử lại, file .part giúp tải tiếp phần còn lại
+                with span('image_download') as timing:
+                    download = call_with_retry(
+                        lambda: download_file(session, image_url, save_path, headers=download_headers),
+                        context=f"ảnh media ID {media_id}"
+                    )
+                    timing['bytes'] = download['size']
+                
+                resumed_str = " (tiếp tục từ lần trước)" if download['resumed'] else ""
+                tqdm.write(f"    - Đã tải: {safe_filename}{resumed_str}")
+                
+            except ItemFetchError as e:
+                tqdm.write(f"    - Lỗi khi tải ảnh media ID {media_id}: {e}")
+                outcome['failure'] = _failed_item(media_id, e)
+                save_path = None
+    
+    # Lưu dữ liệu cho PDF và JSON
+    question_data = {
+        'media_id': media_id,
+        'title': media_data.get('title', f'Question {idx+1}'),
+        'image_url': image_url,
+        'image_local_path': save_path if image_url else None,
+        'comments': media_data.get('comments', []),
+        'comment_count': media_data.get('comment_count')
+    }
+    outcome['question_data'] = question_data
+    
+    # Ghi manifest ngay khi ảnh tải xong (không mất tiến độ nếu job bị ngắt)
+    if download:
+        _save_download(job, media_id, download, question_data)
+    
+    return outcome
+
+def _save_download(job: dict, media_id: str, download: dict, question_data: dict):
+    """Ghi manifest entry cho ảnh đã có trên máy (không làm gì nếu không có DB)."""
+    db_manager = job['db_manager']
+    if not (db_manager and job['thread_db_id']):
+        return
+    preview_path = db_manager.save_manifest_entry(job['thread_db_id'], media_id, {
+        'file_path': make_relative_path(download['path']),
+        'file_size': download['size'],
+        'sha256': download['sha256'],
+        'image_url': question_data['image_url'],
+        'title': question_data['title'],
+        'comments': question_data['comments'],
+        'comment_count': question_data['comment_count']
+    })
+    # Ảnh từng bị evict đã được tải lại -> bỏ bản thu nhỏ
+    if preview_path:
+        try:
+            os.remove(get_absolute_path(preview_path))
+        except OSError:
+            pass
+
+def _refresh_comments(session: requests.Session, job: dict, entry: dict, question_data: dict):
+    """
+    Cào lại thread đã xong: lấy lại comments của một ảnh đã tải (không tải lại ảnh).
+    
+    Chỉ tốn một request cho trang comments đầu nếu tổng số comments không đổi; lỗi thì
+    giữ comments đã lưu. Manifest được cập nhật khi comments thay đổi.
+    """
+    media_id = question_data['media_id']
+    try:
+        media_data = fetch_media_data_with_retry(
+            session, media_id, job['csrf_token'], job['base_url'], job['rate_limiter'],
+            known_comments=(question_data['comments'], question_data['comment_count'])
+        )
+    except ItemFetchError as e:
+        tqdm.write(f"    - Không cập nhật được comments của media ID {media_id}: {e}")
+        return
+    
+    if (media_data['comments'], media_data['comment_count']) == (question_data['comments'], question_data['comment_count']):
+        return
+    question_data['comments'] = media_data['comments']
+    question_data['comment_count'] = media_data['comment_count']
+    if job['db_manager'] and job['thread_db_id']:
+        job['db_manager'].save_manifest_entry(
+            job['thread_db_id'], media_id, dict(entry, comments=media_data['comments'],
+                                                comment_count=media_data['comment_count'])
+        )
+
+@timed('export')
+def export_comments_json(thread_save_path: str, all_question_data: List[Dict]):
+    """Export comments ra file JSON (để xem/chia sẻ; chỉ đọc lại cho file ảnh chưa có trong manifest)."""
+    json_save_path = os.path.join(thread_save_path, 'comments.json')
+    with open(json_save_path, 'w', encoding='utf-8') as f:
+        json.dump(all_question_data, f, ensure_ascii=False, indent=2)
+    print(f"    [+] Đã lưu comments vào: comments.json")
+
+def build_media_items_data(all_question_data: List[Dict]) -> List[Dict]:
+    """Chuyển dữ liệu câu hỏi thành format media items của DatabaseManager.save_media_items."""
+    media_items_data = []
+    for idx, q_data in enumerate(all_question_data):
+        media_items_data.append({
+            'media_id': q_data['media_id'],
+            'filename': os.path.basename(q_data['image_local_path']) if q_data.get('image_local_path') else None,
+            'image_path': make_relative_path(q_data.get('image_local_path')) if q_data.get('image_local_path') else None,
+            'image_url': q_data.get('image_url'),
+            'title': q_data.get('title'),
+            'comments': q_data.get('comments', []),
+            'comment_count': q_data.get('comment_count'),
+            'question_order': idx + 1
+        })
+    return media_items_data
+
+@timed('persist_media')
+def persist_question_data(job: dict, all_question_data: List[Dict]) -> Optional[Dict[str, Dict]]:
+    """
+    Lưu media items vào DB trước khi render, để PDF đọc đáp án tổng hợp đã tính sẵn.
+    
+    Returns:
+        Dict {media_id: consensus} từ DB, None nếu chạy không có DB (PDF tự tổng hợp)
+    """
+    db_manager = job.get('db_manager')
+    if not db_manager or not job.get('thread_db_id'):
+        return None
+    
+    try:
+        # Số câu hỏi đổi nội dung được đưa vào kết quả job; build_thread_result thấy key này
+        # thì không đưa media items vào kết quả nữa (chỉ lưu một lần)
+        job['content_changes'] = db_manager.save_media_items(
+            job['thread_db_id'], build_media_items_data(all_question_data)
+        )
+        return db_manager.get_answer_consensus(job['thread_db_id'])
+    except Exception as e:
+        print(f"    (!) Lỗi khi lưu media items trước khi render: {e}")
+        return None
+
+@timed('render')
+def render_thread_pdf(
+    all_question_data: List[Dict],
+    thread_save_path: str,
+    folder_name: str,
+    thread_title: str,
+    session: Optional[requests.Session] = None,
+    consensus: Optional[Dict[str, Dict]] = None
+) -> Optional[str]:
+    """
+    Stage render: tạo PDF từ dữ liệu câu hỏi (ưu tiên ảnh đã tải về máy).
+    
+    Chỉ nhận tham số picklable (trừ session tùy chọn) để có thể chạy trong
+    ProcessPoolExecutor của pipeline. `consensus` là đáp án tổng hợp đọc từ DB
+    (xem persist_question_data).
+    
+    Returns:
+        Đường dẫn tuyệt đối của file PDF, hoặc None nếu không tạo PDF
+    """
+    if not config.GENERATE_PDF:
+        print(f"    [*] PDF generation đã được tắt trong config (GENERATE_PDF = False)")
+        return None
+    
+    if not all_question_data:
+        print(f"    (!) Không có dữ liệu để tạo PDF. Kiểm tra lại quá trình cào dữ liệu.")
+        return None
+    
+    pdf_path = os.path.join(thread_save_path, f"{folder_name}.pdf")
+    print(f"\n    [*] Đang tạo file PDF...")
+    try:
+        create_pdf_from_data(session, all_question_data, pdf_path, thread_title, consensus)
+        print(f"    [+] Đã tạo PDF thành công: {os.path.basename(pdf_path)}")
+        return pdf_path
+    except Exception as e:
+        print(f"    (!) Lỗi khi tạo PDF: {e}")
+        print(f"    (!) Bạn vẫn có thể tạo PDF sau bằng file comments.json")
+        return None
+
+def build_thread_result(
+    job: dict,
+    all_question_data: List[Dict],
+    failed_items: List[Dict],
+    pdf_path: Optional[str]
+) -> dict:
+    """
+    Stage cuối: chuẩn bị dict kết quả (đường dẫn relative, media items cho DB).
+    
+    Returns:
+        Dict cùng format với download_images_with_comments_from_thread
+    """
+    # persist_question_data đã lưu media items trước khi render -> không ghi lại ở stage persist
+    media_items_data = [] if 'content_changes' in job else build_media_items_data(all_question_data)
+    
+    print(f"\n    -> Hoàn tất. Đã xử lý {len(all_question_data)}/{len(job['items'])} media items.")
+    if failed_items:
+        print(f"    (!) {len(failed_items)} media items bị lỗi, chạy `retry --items` để thử lại.")
+    
+    # Convert paths sang relative
+    return {
+        'folder_path': make_relative_path(job['thread_save_path']),
+        'pdf_path': make_relative_path(pdf_path) if pdf_path else None,
+        'total_questions': len(all_question_data),
+        'media_items_data': media_items_data,
+        'failed_items': failed_items,
+        'content_changes': job.get('content_changes', 0),
+        'success': True,
+        'error': None
+    }
 
-    result = {
+def empty_thread_result(error: Optional[str] = None) -> dict:
+    """Dict kết quả cho thread xử lý thất bại."""
+    return {
         'folder_path': None,
         'pdf_path': None,
         'total_questions': 0,
         'media_items_data': [],
+        'failed_items': [],
         'success': False,
-        'error': None
+        'error': error
     }
 
+def download_images_with_comments_from_thread(
+    session: requests.Session, 
+    thread_info: dict,
+    thread_db_id: Optional[int] = None,
+    db_manager: Optional["DatabaseManager"] = None,
+    prefetched: Optional[Tuple[List[Dict], Optional[str]]] = None
+) -> dict:
+    """
+    Tải tất cả hình ảnh và comments từ một URL đề thi sử dụng JSON API.
+    Lưu ảnh và comments vào thư mục riêng, đồng thời tạo file JSON.
+    
+    Chạy tuần tự các stage discover -> fetch/download -> render (pipeline song song:
+    xem queue_system/pipeline.py).
+    
+    Args:
+        session: requests.Session với cookies
+        thread_info: Dict chứa 'url' và 'title'
+        thread_db_id: ID của thread trong DB (optional, để tích hợp sau)
+        db_manager: DatabaseManager để đọc/ghi download manifest (optional)
+        prefetched: Tuple (media_items, csrf_token) đã được worker tải trước (optional)
+    
+    Returns:
+        dict chứa:
+            - folder_path: Đường dẫn thư mục (relative)
+            - pdf_path: Đường dẫn file PDF (relative, None nếu không có)
+            - total_questions: Tổng số câu hỏi
+            - media_items_data: List các dict chứa thông tin media items (rỗng nếu đã được
+              lưu vào DB trước khi render)
+            - failed_items: List các media items lỗi (media_id, error_kind, error_message, attempts)
+            - content_changes: Số câu hỏi mới/đổi nội dung so với lần cào trước (cho `watch`)
+            - success: bool
+            - error: str (nếu có lỗi)
+    """
+    thread_url = thread_info['url']
+
     try:
-        # Bước 1: Trích xuất Media IDs và CSRF token từ thread
-        print("    [*] Đang trích xuất Media IDs và CSRF token...")
-        media_items, csrf_token = extract_media_ids_from_thread(session, thread_url)
+        job = discover_thread(session, thread_info, thread_db_id, db_manager, prefetched)
         
-        if not media_items:
+        if not job['items']:
             error_msg = "Không tìm thấy media nào trong đề thi này."
             print(f"    -> {error_msg}")
-            result['error'] = error_msg
-            return result
-        
-        if not csrf_token:
-            print("    (!) Cảnh báo: Không lấy được CSRF token. Có thể gặp lỗi 400 khi gọi API.")
-            print("    (!) Vui lòng kiểm tra lại cookie hoặc cập nhật cookie mới nhất.")
-        else:
-            print(f"    [+] Đã lấy CSRF token thành công.")
-        
-        print(f"    [+] Tìm thấy {len(media_items)} media items. Bắt đầu tải...")
+            return empty_thread_result(error_msg)
         
         # Danh sách để lưu dữ liệu cho PDF
         all_question_data = []
-        
-        # Load dữ liệu cũ từ comments.json nếu có (để tái sử dụng cho file đã tồn tại)
-        old_data_dict = {}
-        json_save_path = os.path.join(thread_save_path, 'comments.json')
-        if os.path.exists(json_save_path):
-            try:
-                with open(json_save_path, 'r', encoding='utf-8') as f:
-                    old_data_list = json.load(f)
-                    for item in old_data_list:
-                        if 'media_id' in item:
-                            old_data_dict[str(item['media_id'])] = item
-            except Exception:
-                pass  # Nếu không load được thì bỏ qua
+        # Media items lỗi trong lần cào này (được ghi vào DB bởi worker)
+        failed_items = []
         
         # Bước 2: Duyệt qua từng media item và lấy dữ liệu qua JSON API
-        for idx, media_item in enumerate(tqdm(media_items, desc="    Xử lý", unit="item", leave=False)):
-            media_id = media_item['media_id']
-            original_filename = media_item['filename']
-            
-            # Tạo tên file để kiểm tra
-            file_ext = os.path.splitext(original_filename)[1] or '.jpg'
-            safe_filename = sanitize_filename(original_filename) or f"question_{idx+1}{file_ext}"
-            save_path = os.path.join(thread_save_path, safe_filename)
-                
-            # Kiểm tra file đã tồn tại chưa - Nếu có thì skip luôn, không gọi API
-            if os.path.exists(save_path):
-                tqdm.write(f"    - Bỏ qua (đã tồn tại): {safe_filename}")
-                # Vẫn thêm vào danh sách để tạo PDF (dùng dữ liệu từ file cũ nếu có)
-                if str(media_id) in old_data_dict:
-                    # Dùng dữ liệu cũ từ comments.json
-                    old_item = old_data_dict[str(media_id)]
-                    question_data = {
-                        'media_id': media_id,
-                        'title': old_item.get('title', f'Question {idx+1}'),
-                        'image_url': old_item.get('image_url'),
-                        'image_local_path': save_path,
-                        'comments': old_item.get('comments', [])
-                    }
-                else:
-                    # Không có dữ liệu cũ, dùng dữ liệu mặc định
-                    question_data = {
-                        'media_id': media_id,
-                        'title': f'Question {idx+1}',
-                        'image_url': None,
-                        'image_local_path': save_path,
-                        'comments': []
-                    }
-                all_question_data.append(question_data)
-                continue  # Skip luôn, không gọi API
-            
-            # File chưa tồn tại, gọi API để lấy dữ liệu
-            media_data = get_media_data_from_json_api(session, media_id, csrf_token)
-            
-            if not media_data:
-                tqdm.write(f"    - Bỏ qua media ID {media_id}: Không lấy được dữ liệu")
-                time.sleep(config.DELAY_BETWEEN_REQUESTS)
-                continue
-
-            # Tải ảnh về
-            image_url = media_data.get('image_url')
-            if image_url:
-                try:
-                    download_headers = session.headers.copy()
-                    download_headers['Referer'] = thread_url
-                    img_response = session.get(image_url, headers=download_headers, timeout=20, stream=True)
-                    img_response.raise_for_status()
-                    
-                    with open(save_path, 'wb') as f:
-                        for chunk in img_response.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                    
-                    tqdm.write(f"    - Đã tải: {safe_filename}")
-                    
-                except Exception as e:
-                    tqdm.write(f"    - Lỗi khi tải ảnh media ID {media_id}: {e}")
-                    save_path = None
-            
-            # Lưu dữ liệu cho PDF và JSON
-            question_data = {
-                'media_id': media_id,
-                'title': media_data.get('title', f'Question {idx+1}'),
-                'image_url': image_url,
-                'image_local_path': save_path if image_url else None,
-                'comments': media_data.get('comments', [])
-            }
-            all_question_data.append(question_data)
-            
-            # Nghỉ giữa các request
-            time.sleep(config.DELAY_BETWEEN_REQUESTS)
+        for item in tqdm(job['items'], desc="    Xử lý", unit="item", leave=False):
+            outcome = process_media_item(session, job, item)
+            if outcome['question_data']:
+                all_question_data.append(outcome['question_data'])
+            if outcome['failure']:
+                failed_items.append(outcome['failure'])
         
-        # Bước 3: Lưu tất cả comments vào file JSON
-        json_save_path = os.path.join(thread_save_path, 'comments.json')
-        with open(json_save_path, 'w', encoding='utf-8') as f:
-            json.dump(all_question_data, f, ensure_ascii=False, indent=2)
-        print(f"    [+] Đã lưu comments vào: comments.json")
+        # Bước 3: Export comments ra file JSON
+        export_comments_json(job['thread_save_path'], all_question_data)
         
-        # Bước 4: Tạo PDF tự động sau khi cào xong
-        pdf_path = None
-        if config.GENERATE_PDF:
-            if all_question_data:
-                pdf_path = os.path.join(thread_save_path, f"{folder_name}.pdf")
-                print(f"\n    [*] Đang tạo file PDF...")
-                try:
-                    create_pdf_from_data(session, all_question_data, pdf_path, thread_info['title'])
-                    print(f"    [+] Đã tạo PDF thành công: {os.path.basename(pdf_path)}")
-                except Exception as e:
-                    print(f"    (!) Lỗi khi tạo PDF: {e}")
-                    print(f"    (!) Bạn vẫn có thể tạo PDF sau bằng file comments.json")
-                    pdf_path = None  # Set None nếu lỗi
-            else:
-                print(f"    (!) Không có dữ liệu để tạo PDF. Kiểm tra lại quá trình cào dữ liệu.")
-        else:
-            print(f"    [*] PDF generation đã được tắt trong config (GENERATE_PDF = False)")
+        # Bước 4: Lưu media items (tính đáp án tổng hợp) rồi tạo PDF
+        consensus = persist_question_data(job, all_question_data)
+        pdf_path = render_thread_pdf(
+            all_question_data, job['thread_save_path'], job['folder_name'], thread_info['title'],
+            session, consensus
+        )
         
         # Chuẩn bị data để return và lưu DB
-        media_items_data = []
-        for idx, q_data in enumerate(all_question_data):
-            media_items_data.append({
-                'media_id': q_data['media_id'],
-                'filename': os.path.basename(q_data['image_local_path']) if q_data.get('image_local_path') else None,
-                'image_path': make_relative_path(q_data.get('image_local_path')) if q_data.get('image_local_path') else None,
-                'image_url': q_data.get('image_url'),
-                'title': q_data.get('title'),
-                'comments': q_data.get('comments', []),
-                'question_order': idx + 1
-            })
-        
-        # Convert paths sang relative
-        result.update({
-            'folder_path': make_relative_path(thread_save_path),
-            'pdf_path': make_relative_path(pdf_path) if pdf_path else None,
-            'total_questions': len(all_question_data),
-            'media_items_data': media_items_data,
-            'success': True
-        })
-        
-        print(f"\n    -> Hoàn tất. Đã xử lý {len(all_question_data)}/{len(media_items)} media items.")
-        return result
+        return build_thread_result(job, all_question_data, failed_items, pdf_path)
 
     except requests.exceptions.RequestException as e:
         error_msg = f"Lỗi khi truy cập vào đề thi {thread_url}: {e}"
         print(f"(!) {error_msg}")
-        result['error'] = error_msg
-        return result
+        return empty_thread_result(error_msg)
     except Exception as e:
         error_msg = f"Lỗi không xác định: {e}"
         print(f"(!) {error_msg}")
-        result['error'] = error_msg
-        return result
+        return empty_thread_result(error_msg)
 
 def main():
     """Hàm chính điều khiển toàn bộ quá trình."""
@@ -0,0 +1,192 @@
+# scraper/timing.py
+
+import re
+import time
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, Sequence
+import requests
+
+# Thread (trong DB) mà code hiện tại đang xử lý, để gắn span HTTP vào đúng job
+_current_thread_id: contextvars.ContextVar = contextvars.ContextVar('timing_thread_id', default=None)
+
+# Phân loại URL cho span HTTP (không lưu URL đầy đủ để bảng gọn)
+_URL_CLASSES = (
+    ('media_json', re.compile(r'/media/[^/?]*\.\d+/?(\?|$)')),
+    ('thread_page', re.compile(r'/threads/')),
+    ('forum_page', re.compile(r'/forums/')),
+    ('image', re.compile(r'\.(png|jpe?g|gif|webp|bmp)(\?|$)|/attachments/|/data/', re.IGNORECASE)),
+)
+
+def classify_url(url: str) -> str:
+    """Phân loại URL: media_json, thread_page, forum_page, image hoặc other."""
+    for name, pattern in _URL_CLASSES:
+        if pattern.search(url):
+            return name
+    return 'other'
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """Percentile theo nearest-rank của list đã sắp xếp tăng dần (None nếu rỗng)."""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(q / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+class TimingRecorder:
+    """
+    Gom các span (stage, thời gian, thread, loại URL, status, bytes) trong bộ nhớ và ghi
+    theo lô vào bảng job_timings. An toàn khi gọi từ nhiều luồng.
+    """
+    
+    def __init__(self, db_manager, batch_size: int = 500):
+        """
+        Args:
+            db_manager: DatabaseManager để ghi bảng job_timings
+            batch_size: Tự ghi xuống DB khi buffer đạt số span này
+        """
+        self.db = db_manager
+        self.batch_size = batch_size
+        self._buffer: List[tuple] = []
+        self._lock = threading.Lock()
+    
+    def add(
+        self,
+        stage: str,
+        duration: float,
+        thread_id: Optional[int] = None,
+        url_class: Optional[str] = None,
+        status: Optional[int] = None,
+        nbytes: Optional[int] = None,
+        started_at: Optional[float] = None
+    ):
+        """Thêm một span (duration tính bằng giây, started_at là epoch seconds)."""
+        if thread_id is None:
+            thread_id = _current_thread_id.get()
+        if started_at is None:
+            started_at = time.time() - duration
+        with self._lock:
+            self._buffer.append((thread_id, stage, url_class, status, nbytes, duration * 1000, started_at))
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+    
+    def flush(self):
+        """Ghi các span đang chờ xuống DB."""
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if rows:
+            try:
+                self.db.save_job_timings(rows)
+            except Exception as e:
+                # Đo thời gian không được làm hỏng job
+                print(f"    (!) Không ghi được job_timings: {e}")
+
+_recorder: Optional[TimingRecorder] = None
+
+# Các hàm nhận mọi span ngay khi kết thúc (vd: metrics của worker), kể cả khi không ghi DB
+_listeners: List[Callable] = []
+
+def set_recorder(recorder: Optional[TimingRecorder]):
+    """Bật (hoặc tắt với None) việc ghi span cho toàn process."""
+    global _recorder
+    _recorder = recorder
+
+def get_recorder() -> Optional[TimingRecorder]:
+    return _recorder
+
+def add_listener(listener: Callable):
+    """
+    Đăng ký hàm listener(stage, duration, url_class, status, nbytes) được gọi với mỗi span
+    (duration tính bằng giây). Listener phải nhanh và an toàn khi gọi từ nhiều luồng.
+    """
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+def record_span(
+    stage: str,
+    duration: float,
+    thread_id: Optional[int] = None,
+    url_class: Optional[str] = None,
+    status: Optional[int] = None,
+    nbytes: Optional[int] = None,
+    started_at: Optional[float] = None
+):
+    """Ghi một span đã đo sẵn (duration tính bằng giây) cho recorder và các listener."""
+    if _recorder is not None:
+        _recorder.add(stage, duration, thread_id, url_class, status, nbytes, started_at)
+    for listener in _listeners:
+        listener(stage, duration, url_class, status, nbytes)
+
+@contextmanager
+def job_context(thread_id: Optional[int]) -> Iterator[None]:
+    """Đánh dấu các span (kể cả HTTP) trong khối này thuộc về thread_id."""
+    token = _current_thread_id.set(thread_id)
+    try:
+        yield
+    finally:
+        _current_thread_id.reset(token)
+
+@contextmanager
+def span(stage: str, thread_id: Optional[int] = None) -> Iterator[dict]:
+    """
+    Đo thời gian một stage. Không làm gì nếu chưa bật recorder hay listener nào.
+    
+    Yields:
+        Dict để code bên trong ghi thêm 'bytes' / 'status' cho span
+    """
+    attrs = {}
+    if _recorder is None and not _listeners:
+        yield attrs
+        return
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        record_span(
+            stage, time.perf_counter() - start, thread_id=thread_id,
+            status=attrs.get('status'), nbytes=attrs.get('bytes'), started_at=started_at
+        )
+
+def timed(stage: str) -> Callable:
+    """Decorator: đo mỗi lần gọi hàm như một span `stage`."""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def bind_job(thread_id: Optional[int], func: Callable) -> Callable:
+    """Bọc func để khi chạy ở luồng khác (thread pool) các span vẫn gắn với thread_id."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with job_context(thread_id):
+            return func(*args, **kwargs)
+    return wrapper
+
+def _record_response(response: requests.Response, *args, **kwargs):
+    """Response hook của requests: ghi một span 'http' cho mỗi request."""
+    if _recorder is None and not _listeners:
+        return
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit():
+        nbytes = int(content_length)
+    elif response._content_consumed and isinstance(response._content, bytes):
+        nbytes = len(response._content)
+    else:
+        nbytes = None
+    # elapsed = từ lúc gửi request đến khi nhận xong headers
+    record_span(
+        'http', response.elapsed.total_seconds(), url_class=classify_url(response.url),
+        status=response.status_code, nbytes=nbytes
+    )
+
+def install_http_timing(session: requests.Session):
+    """Gắn response hook ghi span cho mọi request của session (gọi nhiều lần không bị trùng)."""
+    hooks = session.hooks.setdefault('response', [])
+    if _record_response not in hooks:
+        hooks.append(_record_response)